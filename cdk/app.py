@@ -29,6 +29,42 @@ ingest_allowed_ips = getenv("INGEST_ALLOWED_IPS").split(',')
 default_publisher = getenv("DEFAULT_PUBLISHER", required=False) \
                     or getenv("NOTIFICATION_EMAIL")
 
+# optional tuning settings (see example.env), passed through to the
+# functions that read them when they're set
+ZOOM_API_SETTINGS = [
+    "ZOOM_API_POOL_SIZE",
+    "ZOOM_API_RATE",
+    "ZOOM_API_BURST",
+    "ZOOM_API_MAX_RETRY_WAIT",
+]
+DOWNLOADER_SETTINGS = ZOOM_API_SETTINGS + [
+    "HOST_NAME_TTL",
+    "HOST_NAME_NEGATIVE_TTL",
+    "SCHEDULE_INDEX_TTL",
+    "DOWNLOAD_FILE_WORKERS",
+    "PART_WINDOW_SIZE",
+    "PART_SIZE",
+    "MAX_PARTS_IN_FLIGHT",
+    "PART_COUNT_TARGET",
+    "PART_MEMORY_BUDGET",
+    "PART_UPLOAD_ATTEMPTS",
+    "PART_RETRY_BUDGET",
+]
+UPLOADER_SETTINGS = [
+    "OC_OP_COUNT_TTL",
+    "SERIES_CATALOG_TTL",
+    "OC_CONNECT_TIMEOUT",
+    "OC_READ_TIMEOUT",
+    "OC_INGEST_READ_TIMEOUT",
+    "OC_GET_ATTEMPTS",
+    "OC_WORKFLOW_PAGE_SIZE",
+    "OC_INGEST_STEP_ATTEMPTS",
+    "OC_INGEST_RETRY_DELAY",
+]
+
+def settings(names):
+    return {name: getenv(name, required=False) for name in names}
+
 stack_props = {
     "lambda_code_bucket": getenv("LAMBDA_CODE_BUCKET"),
     "notification_email": getenv("NOTIFICATION_EMAIL"),
@@ -37,6 +73,9 @@ stack_props = {
     "local_time_zone": getenv("LOCAL_TIME_ZONE"),
     "default_series_id": getenv("DEFAULT_SERIES_ID", required=False),
     "download_message_per_invocation": getenv("DOWNLOAD_MESSAGES_PER_INVOCATION"),
+    "download_batch_size": getenv("DOWNLOAD_BATCH_SIZE", required=False),
+    "download_sqs_batch_size": getenv("DOWNLOAD_SQS_BATCH_SIZE", required=False),
+    "download_sqs_max_concurrency": getenv("DOWNLOAD_SQS_MAX_CONCURRENCY", required=False),
     "opencast_api_user": getenv("OPENCAST_API_USER"),
     "opencast_api_password": getenv("OPENCAST_API_PASSWORD"),
     "default_publisher": default_publisher,
@@ -45,6 +84,12 @@ stack_props = {
     "oc_workflow": getenv("OC_WORKFLOW"),
     "oc_flavor": getenv("OC_FLAVOR"),
     "oc_track_upload_max": getenv("OC_TRACK_UPLOAD_MAX"),
+    "upload_batch_size": getenv("UPLOAD_BATCH_SIZE", required=False),
+    "series_catalog_prefix": getenv("SERIES_CATALOG_PREFIX", required=False),
+    "oc_ingest_mode": getenv("OC_INGEST_MODE", required=False),
+    "on_demand_settings": settings(ZOOM_API_SETTINGS),
+    "downloader_settings": settings(DOWNLOADER_SETTINGS),
+    "uploader_settings": settings(UPLOADER_SETTINGS),
     "downloader_event_rate": 2,
     "uploader_event_rate": 2,
     "ingest_allowed_ips": ingest_allowed_ips,
@@ -0,0 +1,28 @@
+from aws_cdk import core, aws_dynamodb as dynamodb
+from . import names
+
+class ZipCheckpoints(core.Construct):
+
+    def __init__(self, scope: core.Construct, id: str):
+        """
+        Progress of unfinished multipart uploads so the downloader can
+        resume a file transfer in a later invocation
+        """
+        super().__init__(scope, id)
+        stack_name = core.Stack.of(self).stack_name
+
+        self.table = dynamodb.Table(
+            self, "table",
+            table_name=f"{stack_name}-{names.CHECKPOINTS_TABLE}",
+            partition_key=dynamodb.Attribute(
+                name="meeting_uuid",
+                type=dynamodb.AttributeType.STRING
+            ),
+            sort_key=dynamodb.Attribute(
+                name="recording_id",
+                type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires",
+            removal_policy=core.RemovalPolicy.DESTROY
+        )
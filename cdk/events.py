@@ -1,7 +1,8 @@
 from aws_cdk import (
     core,
     aws_events as events,
-    aws_events_targets as events_targets
+    aws_events_targets as events_targets,
+    aws_lambda as _lambda
 )
 
 class ZipEvent(core.Construct):
@@ -15,3 +16,25 @@ class ZipEvent(core.Construct):
             schedule=events.Schedule.rate(core.Duration.minutes(event_rate)),
             targets=[events_targets.LambdaFunction(function)]
         )
+
+
+class ZipQueueEvent(core.Construct):
+
+    def __init__(self, scope: core.Construct, id: str, function, queue,
+                 batch_size, max_concurrency=None):
+        super().__init__(scope, id)
+        self.mapping = _lambda.CfnEventSourceMapping(self, "mapping",
+            enabled=True,
+            event_source_arn=queue.queue_arn,
+            function_name=function.function_name,
+            batch_size=int(batch_size)
+        )
+        # the function reports which messages of a batch failed
+        self.mapping.add_property_override(
+            "FunctionResponseTypes", ["ReportBatchItemFailures"]
+        )
+        if max_concurrency:
+            self.mapping.add_property_override(
+                "ScalingConfig.MaximumConcurrency", int(max_concurrency)
+            )
+        queue.grant_consume_messages(function)
@@ -179,6 +179,27 @@ class ZipUploaderFunction(ZipFunction):
             filter_pattern=logs.FilterPattern.literal("Workflow")
         )
 
+        opencast_request_latency = logs.MetricFilter(self,
+            "OpencastRequestSecondsLogMetric",
+            log_group=self.function.log_group,
+            metric_name="OpencastRequestSeconds",
+            metric_value="$.message.opencast_request.seconds",
+            metric_namespace=monitoring.custom_metric_namespace,
+            filter_pattern=logs.FilterPattern.all(
+                logs.JsonPattern(
+                    "$.message.opencast_request.seconds >= 0"
+                )
+            )
+        )
+        # one metric per opencast endpoint
+        opencast_request_latency.node.default_child.add_property_override(
+            "MetricTransformations.0.Dimensions",
+            [{
+                "Key": "Endpoint",
+                "Value": "$.message.opencast_request.endpoint"
+            }]
+        )
+
 
 class ZipOpCountsFunction(ZipFunction):
     pass
@@ -0,0 +1,23 @@
+from aws_cdk import core, aws_dynamodb as dynamodb
+from . import names
+
+class ZipHostNames(core.Construct):
+
+    def __init__(self, scope: core.Construct, id: str):
+        """
+        Cache of zoom host names shared by downloader invocations
+        """
+        super().__init__(scope, id)
+        stack_name = core.Stack.of(self).stack_name
+
+        self.table = dynamodb.Table(
+            self, "table",
+            table_name=f"{stack_name}-{names.HOST_NAMES_TABLE}",
+            partition_key=dynamodb.Attribute(
+                name="host_id",
+                type=dynamodb.AttributeType.STRING
+            ),
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
+            time_to_live_attribute="expires",
+            removal_policy=core.RemovalPolicy.DESTROY
+        )
@@ -5,14 +5,18 @@ NOTIFICATIONS_TOPIC="notifications"
 METRIC_NAMESPACE="log-metrics"
 
 SCHEDULE_TABLE="schedule"
+CHECKPOINTS_TABLE="download-checkpoints"
+HOST_NAMES_TABLE="host-names"
 
 DOWNLOAD_QUEUE="download"
 DOWNLOAD_DLQ="download-dlq"
+UNMATCHED_QUEUE="unmatched"
 UPLOAD_QUEUE="upload.fifo"
 UPLOAD_DLQ="upload-dlq.fifo"
 QUEUES = [
     DOWNLOAD_QUEUE,
     DOWNLOAD_DLQ,
+    UNMATCHED_QUEUE,
     UPLOAD_QUEUE,
     UPLOAD_DLQ
 ]
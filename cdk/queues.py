@@ -7,7 +7,8 @@ from . import names
 
 class ZipQueues(core.Construct):
 
-    def __init__(self, scope: core.Construct, id: str):
+    def __init__(self, scope: core.Construct, id: str,
+                 download_visibility_timeout=300):
         super().__init__(scope, id)
         self.stack_name = core.Stack.of(self).stack_name
 
@@ -23,10 +24,20 @@ class ZipQueues(core.Construct):
             self, "DownloadQueue",
             queue_name=f"{self.stack_name}-{names.DOWNLOAD_QUEUE}",
             retention_period=core.Duration.days(14),
-            visibility_timeout=core.Duration.seconds(300),
+            visibility_timeout=core.Duration.seconds(
+                download_visibility_timeout
+            ),
             dead_letter_queue=self.download_dlq
         )
 
+        # recordings with no matching opencast series, kept so they can be
+        # moved back to the download queue after a schedule update
+        self.unmatched_queue = sqs.Queue(
+            self, "UnmatchedQueue",
+            queue_name=f"{self.stack_name}-{names.UNMATCHED_QUEUE}",
+            retention_period=core.Duration.days(14)
+        )
+
         self.upload_dlq = sqs.DeadLetterQueue(
             max_receive_count=2,
             queue=sqs.Queue(
@@ -52,6 +63,7 @@ class ZipQueues(core.Construct):
         queues = {
             names.DOWNLOAD_QUEUE: self.download_queue,
             names.DOWNLOAD_DLQ: self.download_dlq.queue,
+            names.UNMATCHED_QUEUE: self.unmatched_queue,
             names.UPLOAD_QUEUE: self.upload_queue,
             names.UPLOAD_DLQ: self.upload_dlq.queue
         }
@@ -17,7 +17,8 @@ class ZipSchedule(core.Construct):
                 name="zoom_series_id",
                 type=dynamodb.AttributeType.STRING
             ),
-            read_capacity=1,
-            write_capacity=1,
+            # every downloader container scans the whole table to keep
+            # its copy of the schedule current
+            billing_mode=dynamodb.BillingMode.PAY_PER_REQUEST,
             removal_policy=core.RemovalPolicy.DESTROY
         )
@@ -6,6 +6,8 @@ from aws_cdk import (
 from .bucket import ZipRecordingsBucket
 from .queues import ZipQueues
 from .schedule import ZipSchedule
+from .checkpoints import ZipCheckpoints
+from .host_names import ZipHostNames
 from .function import (
     ZipDownloaderFunction,
     ZipOnDemandFunction,
@@ -15,11 +17,13 @@ from .function import (
     ZipLogNotificationsFunction
 )
 from .api import ZipApi
-from .events import ZipEvent
+from .events import ZipEvent, ZipQueueEvent
 from .codebuild import ZipCodebuildProject
 from .monitoring import ZipMonitoring
 from . import names
 
+DOWNLOADER_TIMEOUT = 900
+
 class ZipStack(core.Stack):
 
     def __init__(self, scope: core.Construct, id: str,
@@ -30,6 +34,9 @@ class ZipStack(core.Stack):
             local_time_zone,
             default_series_id,
             download_message_per_invocation,
+            download_batch_size,
+            download_sqs_batch_size,
+            download_sqs_max_concurrency,
             opencast_api_user,
             opencast_api_password,
             default_publisher,
@@ -38,12 +45,18 @@ class ZipStack(core.Stack):
             oc_workflow,
             oc_flavor,
             oc_track_upload_max,
+            upload_batch_size,
+            series_catalog_prefix,
+            oc_ingest_mode,
             oc_base_url,
             oc_db_url,
             ingest_allowed_ips,
             zoom_admin_id,
             oc_vpc_id,
             oc_security_group_id,
+            on_demand_settings,
+            downloader_settings,
+            uploader_settings,
             downloader_event_rate,
             uploader_event_rate,
             project_git_url,
@@ -62,16 +75,27 @@ class ZipStack(core.Stack):
 
         recordings_bucket = ZipRecordingsBucket(self, "RecordingsBucket")
 
-        queues = ZipQueues(self, "Queues")
+        # lambda won't map a queue to a function whose timeout is longer than
+        # the queue's visibility timeout
+        queues = ZipQueues(self, "Queues",
+            download_visibility_timeout=(
+                DOWNLOADER_TIMEOUT if download_sqs_batch_size else 300
+            )
+        )
 
         schedule = ZipSchedule(self, "Schedule")
 
+        checkpoints = ZipCheckpoints(self, "Checkpoints")
+
+        host_names = ZipHostNames(self, "HostNames")
+
         on_demand = ZipOnDemandFunction(self, "OnDemandFunction",
             name=names.ON_DEMAND_FUNCTION,
             lambda_code_bucket=lambda_code_bucket,
             environment={
                 "ZOOM_API_KEY": zoom_api_key,
-                "ZOOM_API_SECRET": zoom_api_secret
+                "ZOOM_API_SECRET": zoom_api_secret,
+                **on_demand_settings
             }
         )
 
@@ -93,14 +117,17 @@ class ZipStack(core.Stack):
         downloader = ZipDownloaderFunction(self, "DownloadFunction",
             name=names.DOWNLOAD_FUNCTION,
             lambda_code_bucket = lambda_code_bucket,
-            timeout=900,
+            timeout=DOWNLOADER_TIMEOUT,
             memory_size=500,
             environment={
                 "ZOOM_VIDEOS_BUCKET": recordings_bucket.bucket.bucket_name,
                 "DOWNLOAD_QUEUE_NAME": queues.download_queue.queue_name,
                 "DEADLETTER_QUEUE_NAME": queues.download_dlq.queue.queue_name,
+                "UNMATCHED_QUEUE_NAME": queues.unmatched_queue.queue_name,
                 "UPLOAD_QUEUE_NAME": queues.upload_queue.queue_name,
                 "CLASS_SCHEDULE_TABLE": schedule.table.table_name,
+                "DOWNLOAD_CHECKPOINT_TABLE": checkpoints.table.table_name,
+                "HOST_NAME_TABLE": host_names.table.table_name,
                 "DEBUG": "0",
                 "ZOOM_ADMIN_ID": zoom_admin_id,
                 "ZOOM_API_KEY": zoom_api_key,
@@ -108,13 +135,18 @@ class ZipStack(core.Stack):
                 "LOCAL_TIME_ZONE": local_time_zone,
                 "DEFAULT_SERIES_ID": default_series_id,
                 "DOWNLOAD_MESSAGES_PER_INVOCATION": download_message_per_invocation,
+                "DOWNLOAD_BATCH_SIZE": download_batch_size,
+                **downloader_settings
             }
         )
 
         # grant downloader function permissions
         queues.download_queue.grant_consume_messages(downloader.function)
         queues.upload_queue.grant_send_messages(downloader.function)
+        queues.unmatched_queue.grant_send_messages(downloader.function)
         schedule.table.grant_read_write_data(downloader.function)
+        checkpoints.table.grant_read_write_data(downloader.function)
+        host_names.table.grant_read_write_data(downloader.function)
         recordings_bucket.bucket.grant_write(downloader.function)
 
         op_counts = ZipOpCountsFunction(self, 'OpCountsFunction',
@@ -143,11 +175,15 @@ class ZipStack(core.Stack):
                 "OC_WORKFLOW": oc_workflow,
                 "OC_FLAVOR": oc_flavor,
                 "OC_TRACK_UPLOAD_MAX": oc_track_upload_max,
+                "UPLOAD_BATCH_SIZE": upload_batch_size,
+                "SERIES_CATALOG_PREFIX": series_catalog_prefix,
+                "OC_INGEST_MODE": oc_ingest_mode,
                 "OPENCAST_BASE_URL": oc_base_url,
                 "ZOOM_VIDEOS_BUCKET": recordings_bucket.bucket.bucket_name,
                 "UPLOAD_QUEUE_NAME": queues.upload_queue.queue_name,
                 "DEBUG": "0",
-                "OC_OP_COUNT_FUNCTION": op_counts.function.function_name
+                "OC_OP_COUNT_FUNCTION": op_counts.function.function_name,
+                **uploader_settings
             }
         )
 
@@ -161,6 +197,12 @@ class ZipStack(core.Stack):
         recordings_bucket.bucket.grant_read(downloader.function)
         recordings_bucket.bucket.grant_read(uploader.function)
 
+        # uploader functions share the series catalogs they fetch
+        if series_catalog_prefix:
+            recordings_bucket.bucket.grant_put(
+                uploader.function, f"{series_catalog_prefix}*"
+            )
+
         log_notify = ZipLogNotificationsFunction(self, 'LogNotificationFunction',
             name=names.LOG_NOTIFICATION_FUNCTION,
             lambda_code_bucket=lambda_code_bucket,
@@ -173,10 +215,20 @@ class ZipStack(core.Stack):
             ingest_allowed_ips=ingest_allowed_ips
         )
 
-        download_event = ZipEvent(self, "DownloadEvent",
-            function=downloader.function,
-            event_rate=downloader_event_rate
-        )
+        # the downloader is either invoked with batches of download queue
+        # messages or polls the queue on a schedule
+        if download_sqs_batch_size:
+            download_event = ZipQueueEvent(self, "DownloadQueueEvent",
+                function=downloader.function,
+                queue=queues.download_queue,
+                batch_size=download_sqs_batch_size,
+                max_concurrency=download_sqs_max_concurrency
+            )
+        else:
+            download_event = ZipEvent(self, "DownloadEvent",
+                function=downloader.function,
+                event_rate=downloader_event_rate
+            )
 
         uploader_event = ZipEvent(self, "UploadEvent",
             function=uploader.function,
@@ -1,9 +1,14 @@
 import jwt
 import time
+import boto3
 import logging
 import requests
+import threading
 import aws_lambda_logging
 from functools import wraps
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from os import getenv as env
 from dotenv import load_dotenv
 from os.path import join, dirname
@@ -18,12 +23,94 @@ ZOOM_API_BASE_URL = "https://api.zoom.us/v2/"
 ZOOM_API_KEY = env("ZOOM_API_KEY")
 ZOOM_API_SECRET = env("ZOOM_API_SECRET")
 TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+# Max connections kept open to the zoom api
+ZOOM_API_POOL_SIZE = int(env("ZOOM_API_POOL_SIZE") or 10)
+# Zoom api requests allowed per second, and how many can go out in a burst
+ZOOM_API_RATE = float(env("ZOOM_API_RATE") or 10)
+ZOOM_API_BURST = int(env("ZOOM_API_BURST") or 10)
+# Longest zoom asks us to wait on a rate limited request that we'll still
+# retry. Anything longer (e.g. the daily limit) fails the request.
+ZOOM_API_MAX_RETRY_WAIT = int(env("ZOOM_API_MAX_RETRY_WAIT") or 60)
+# Seconds a zoom host's name is reused before looking it up again
+HOST_NAME_TTL = int(env("HOST_NAME_TTL") or 7 * 86400)
+# Seconds to remember that zoom has no user for a host id
+HOST_NAME_NEGATIVE_TTL = int(env("HOST_NAME_NEGATIVE_TTL") or 3600)
+# Host names kept in memory by each lambda container
+HOST_NAME_CACHE_SIZE = 1000
+# Cached JWTs are replaced when they have less than this many seconds left
+JWT_REFRESH_MARGIN = 10
+# Zoom's ZAK tokens are good for two hours. They're replaced while they
+# still have longer left than a lambda can run so that a token handed out
+# at the start of an invocation lasts until the end of it.
+ZAK_SECONDS_VALID = 7200
+ZAK_REFRESH_MARGIN = 900
+
+# tokens by cache key -> (token, expiry timestamp). These live at module
+# scope so warm lambda invocations reuse them.
+_token_cache = {}
+_token_cache_lock = threading.Lock()
 
 
 class ZoomApiRequestError(Exception):
     pass
 
 
+class TokenBucket:
+    """
+    Client side rate limiting. Holds up to `capacity` tokens that refill
+    at `rate` per second and every request takes one. Requests can also be
+    held off altogether for a while when the server says we're over its
+    limits.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self._lock = threading.Lock()
+
+    def take(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(
+                self.paused_until, time.monotonic() + seconds
+            )
+
+
+def zoom_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=ZOOM_API_POOL_SIZE
+    )
+    session.mount("https://", adapter)
+    return session
+
+
+# shared by every zoom api request made in this lambda container so
+# connections are kept alive between requests and warm invocations
+ZOOM_SESSION = zoom_session()
+ZOOM_RATE_LIMITER = TokenBucket(ZOOM_API_RATE, ZOOM_API_BURST)
+
+
 def setup_logging(handler_func):
 
     @wraps(handler_func)
@@ -63,6 +150,95 @@ def gen_token(key, secret, seconds_valid=60):
     return jwt.encode(payload, secret, headers=header)
 
 
+def cached_token(cache_key, seconds_valid, refresh_margin, create):
+    """
+    Returns the token cached under `cache_key`, calling `create` for a new
+    one if there isn't one or it expires within `refresh_margin` seconds.
+    """
+    with _token_cache_lock:
+        token, expires = _token_cache.get(cache_key, (None, 0))
+    if expires - time.time() > refresh_margin:
+        return token
+
+    token = create()
+    with _token_cache_lock:
+        _token_cache[cache_key] = (token, time.time() + seconds_valid)
+    return token
+
+
+def clear_cached_token(cache_key):
+    with _token_cache_lock:
+        _token_cache.pop(cache_key, None)
+
+
+def zoom_jwt(key, secret, seconds_valid=60):
+    return cached_token(
+        ("jwt", key, secret, seconds_valid),
+        seconds_valid,
+        min(JWT_REFRESH_MARGIN, seconds_valid / 2),
+        lambda: gen_token(key, secret, seconds_valid).decode()
+    )
+
+
+def zoom_zak_token(user_id):
+    """
+    Zoom access (ZAK) token for `user_id`, used to download recordings.
+    """
+    def create():
+        r = zoom_api_request("users/{}/token?type=zak".format(user_id))
+        return r.json()["token"]
+
+    return cached_token(
+        ("zak", user_id), ZAK_SECONDS_VALID, ZAK_REFRESH_MARGIN, create
+    )
+
+
+def retry_after(response):
+    """
+    Seconds zoom asks us to wait before trying again, from the
+    Retry-After header. Zoom sends either a number of seconds or, for the
+    daily limit, the time the limit resets.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    if value.isdigit():
+        return int(value)
+
+    try:
+        retry_time = datetime.strptime(value, TIMESTAMP_FORMAT) \
+            .replace(tzinfo=timezone.utc)
+    except ValueError:
+        try:
+            retry_time = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+    return max(0, (retry_time - datetime.now(timezone.utc)).total_seconds())
+
+
+def follow_rate_limit_headers(response):
+    """
+    Hold off further requests when zoom says there's nothing left of
+    the current rate limit.
+    """
+    remaining = response.headers.get("X-RateLimit-Remaining")
+    if remaining is None or not remaining.isdigit() or int(remaining) > 0:
+        return
+
+    delay = retry_after(response)
+    if delay is None:
+        delay = 1
+    logger.warning({
+        "zoom_rate_limit_reached": {
+            "type": response.headers.get("X-RateLimit-Type"),
+            "category": response.headers.get("X-RateLimit-Category"),
+            "limit": response.headers.get("X-RateLimit-Limit"),
+            "pause_seconds": delay
+        }
+    })
+    ZOOM_RATE_LIMITER.pause(min(delay, ZOOM_API_MAX_RETRY_WAIT))
+
+
 def zoom_api_request(endpoint, key=ZOOM_API_KEY, secret=ZOOM_API_SECRET,
                      seconds_valid=60, ignore_failure=False, retries=3):
     required_params = [("endpoint", endpoint),
@@ -76,27 +252,168 @@ def zoom_api_request(endpoint, key=ZOOM_API_KEY, secret=ZOOM_API_SECRET,
             )
 
     url = "{}{}".format(ZOOM_API_BASE_URL, endpoint)
-    headers = {
-        "Authorization": "Bearer {}"
-        .format(gen_token(key, secret, seconds_valid).decode())
-    }
+    # a rejected token may just be a stale cached one, so try a new one once
+    token_retried = False
 
     while True:
+        headers = {
+            "Authorization": "Bearer {}"
+            .format(zoom_jwt(key, secret, seconds_valid))
+        }
+        ZOOM_RATE_LIMITER.take()
         try:
-            r = requests.get(url, headers=headers)
-            break
+            r = ZOOM_SESSION.get(url, headers=headers)
         except (requests.exceptions.ConnectionError,
                 requests.exceptions.ConnectTimeout) as e:
             if retries > 0:
                 logger.warning("Connection Error: {}".format(e))
                 retries -= 1
+                continue
             else:
                 logger.error("Connection Error: {}".format(e))
                 raise ZoomApiRequestError(
                     "Error requesting {}: {}".format(url, e)
                 )
 
+        follow_rate_limit_headers(r)
+
+        if r.status_code == 401 and not token_retried:
+            logger.warning("Zoom rejected cached token, "
+                           "generating a new one")
+            clear_cached_token(("jwt", key, secret, seconds_valid))
+            token_retried = True
+            continue
+
+        if r.status_code == 429 and retries > 0:
+            delay = retry_after(r)
+            if delay is None:
+                delay = 1
+            if delay <= ZOOM_API_MAX_RETRY_WAIT:
+                logger.warning({
+                    "zoom_rate_limited": {
+                        "url": url,
+                        "retry_after": delay,
+                        "retries_left": retries
+                    }
+                })
+                ZOOM_RATE_LIMITER.pause(delay)
+                retries -= 1
+                continue
+
+        break
+
     if not ignore_failure:
         r.raise_for_status()
 
     return r
+
+
+def zoom_users(status="active"):
+    """
+    Every zoom user on the account, a page at a time.
+    """
+    next_page_token = ""
+    while True:
+        r = zoom_api_request(
+            "users?status={}&page_size=300&next_page_token={}"
+            .format(status, next_page_token)
+        ).json()
+        yield from r["users"]
+        next_page_token = r.get("next_page_token")
+        if not next_page_token:
+            break
+
+
+def host_name_from_user(user):
+    return "{} {}".format(user["first_name"], user["last_name"])
+
+
+class HostNameCache:
+    """
+    Zoom host names by host id. Lookups try an in-process LRU cache, then
+    the DynamoDB table shared with other lambda containers (if there is
+    one), then the zoom api. Host ids zoom doesn't have a user for are
+    cached as None for a shorter time.
+    """
+
+    def __init__(self, table_name=None, size=HOST_NAME_CACHE_SIZE):
+        self.size = size
+        self._names = OrderedDict()
+        self._lock = threading.Lock()
+        if table_name:
+            self.table = boto3.resource("dynamodb").Table(table_name)
+        else:
+            self.table = None
+
+    def get(self, host_id):
+        now = time.time()
+        with self._lock:
+            if host_id in self._names:
+                name, expires = self._names[host_id]
+                if expires > now:
+                    self._names.move_to_end(host_id)
+                    return name
+                del self._names[host_id]
+
+        name, expires = self._lookup_table(host_id, now)
+        if expires is None:
+            name, expires = self._lookup_zoom(host_id, now)
+            self._save_to_table(host_id, name, expires)
+
+        self._remember(host_id, name, expires)
+        return name
+
+    def prewarm(self, users):
+        """
+        Cache the names of zoom users from a bulk `users` listing.
+        """
+        expires = int(time.time()) + HOST_NAME_TTL
+        count = 0
+        if self.table:
+            with self.table.batch_writer() as batch:
+                for user in users:
+                    name = host_name_from_user(user)
+                    batch.put_item(Item=self._item(user["id"], name, expires))
+                    self._remember(user["id"], name, expires)
+                    count += 1
+        else:
+            for user in users:
+                self._remember(user["id"], host_name_from_user(user), expires)
+                count += 1
+        return count
+
+    def _remember(self, host_id, name, expires):
+        with self._lock:
+            self._names[host_id] = (name, expires)
+            self._names.move_to_end(host_id)
+            while len(self._names) > self.size:
+                self._names.popitem(last=False)
+
+    def _lookup_table(self, host_id, now):
+        if not self.table:
+            return None, None
+        item = self.table.get_item(Key={"host_id": host_id}).get("Item")
+        # dynamo can take a while to remove expired items
+        if not item or item["expires"] <= now:
+            return None, None
+        return item.get("host_name"), int(item["expires"])
+
+    def _lookup_zoom(self, host_id, now):
+        r = zoom_api_request("users/{}".format(host_id), ignore_failure=True)
+        if r.status_code == 404:
+            logger.warning("No zoom user found for host {}".format(host_id))
+            return None, int(now) + HOST_NAME_NEGATIVE_TTL
+        r.raise_for_status()
+        resp = r.json()
+        logger.info({"Host details": resp})
+        return host_name_from_user(resp), int(now) + HOST_NAME_TTL
+
+    def _save_to_table(self, host_id, name, expires):
+        if self.table:
+            self.table.put_item(Item=self._item(host_id, name, expires))
+
+    def _item(self, host_id, name, expires):
+        item = {"host_id": host_id, "expires": expires}
+        if name is not None:
+            item["host_name"] = name
+        return item
@@ -9,6 +9,9 @@ logger = logging.getLogger()
 OPENCAST_DB_URL = env("OPENCAST_DB_URL");
 OPENCAST_RUNNING_JOB_STATUS = 2
 
+# kept open between warm invocations
+cnx = None
+
 
 def parse_db_url():
     db_url = urlparse.urlparse(OPENCAST_DB_URL);
@@ -21,6 +24,37 @@ def parse_db_url():
     }
 
 
+def get_connection():
+    """
+    Reuse the connection from a previous invocation if it's still alive,
+    otherwise connect (again).
+    """
+    global cnx
+    if cnx is not None:
+        try:
+            cnx.ping(reconnect=True, attempts=2, delay=0)
+            return cnx
+        except mysql.connector.Error as e:
+            logger.warning("Lost connection to the db: {}".format(str(e)))
+            close_connection()
+
+    cnx = mysql.connector.connect(**parse_db_url())
+    cnx.raise_on_warnings = True
+    # every query should see the current job statuses
+    cnx.autocommit = True
+    return cnx
+
+
+def close_connection():
+    global cnx
+    try:
+        if cnx is not None:
+            cnx.close()
+    except mysql.connector.Error:
+        pass
+    cnx = None
+
+
 @setup_logging
 def handler(event, context):
 
@@ -34,22 +68,21 @@ def handler(event, context):
             operation
     """.format(OPENCAST_RUNNING_JOB_STATUS)
 
+    res = None
     try:
-        cnx_params = parse_db_url()
-        cnx = mysql.connector.connect(**cnx_params)
-        cnx.raise_on_warnings = True
-        cursor = cnx.cursor()
-        cursor.execute(query)
-        res = dict(cursor.fetchall())
+        cursor = get_connection().cursor()
+        try:
+            cursor.execute(query)
+            res = dict(cursor.fetchall())
+        finally:
+            cursor.close()
         return res
     except mysql.connector.Error as e:
         logger.exception("Error communicating with the db: {}".format(str(e)))
+        # don't reuse a connection that's in an unknown state
+        close_connection()
     except Exception as e:
         logger.exception("Error establishing connection to the db: {}".format(str(e)))
+        close_connection()
     finally:
         logger.info({ "operation_counts": res})
-        cursor.close()
-        cnx.close()
-
-
-
@@ -1,15 +1,28 @@
 import boto3
 import json
+import base64
+import random
+import hashlib
+import time
 import requests
+from botocore.exceptions import (
+    ClientError, HTTPClientError, ConnectionError as BotocoreConnectionError
+)
 from os import getenv as env
 from pathlib import Path
-from common import setup_logging, zoom_api_request, TIMESTAMP_FORMAT
+from common import setup_logging, zoom_zak_token, \
+    HostNameCache, TIMESTAMP_FORMAT
 import subprocess
 from pytz import timezone
 from datetime import datetime
 from collections import OrderedDict
 import logging
+import resource
+import threading
+import itertools
 import concurrent.futures
+from math import ceil
+from struct import unpack_from
 
 logger = logging.getLogger()
 
@@ -17,6 +30,9 @@ ZOOM_VIDEOS_BUCKET = env("ZOOM_VIDEOS_BUCKET")
 DOWNLOAD_QUEUE_NAME = env("DOWNLOAD_QUEUE_NAME")
 UPLOAD_QUEUE_NAME = env("UPLOAD_QUEUE_NAME")
 DEADLETTER_QUEUE_NAME = env("DEADLETTER_QUEUE_NAME")
+# Recordings with no matching opencast series are moved here, if it's set,
+# so they can be re-evaluated later (e.g. after a schedule update)
+UNMATCHED_QUEUE_NAME = env("UNMATCHED_QUEUE_NAME")
 MIN_CHUNK_SIZE = 5242880
 MEETING_LOOKUP_RETRIES = 2
 MEETING_LOOKUP_RETRY_DELAY = 60
@@ -25,17 +41,406 @@ DEFAULT_SERIES_ID = env("DEFAULT_SERIES_ID")
 CLASS_SCHEDULE_TABLE = env("CLASS_SCHEDULE_TABLE")
 LOCAL_TIME_ZONE = env("LOCAL_TIME_ZONE")
 DOWNLOAD_MESSAGES_PER_INVOCATION = env("DOWNLOAD_MESSAGES_PER_INVOCATION")
+# DynamoDB table of zoom host names shared by downloader invocations
+HOST_NAME_TABLE = env("HOST_NAME_TABLE")
 # Recordings that happen within BUFFER_MINUTES a courses schedule
 # start time will be captured
 BUFFER_MINUTES = int(env("BUFFER_MINUTES", 30))
 # Ignore recordings that are less than MIN_DURATION (in minutes)
 MINIMUM_DURATION = int(env("MINIMUM_DURATION", 2))
+# Seconds the in-memory copy of the class schedule is used before it's
+# reloaded in the background
+SCHEDULE_INDEX_TTL = int(env("SCHEDULE_INDEX_TTL") or 300)
+# DynamoDB's limit on keys in a single BatchGetItem request
+BATCH_GET_MAX_KEYS = 100
+# Requests made for a BatchGetItem's unprocessed keys before giving up
+BATCH_GET_ATTEMPTS = 5
+# When greater than 1 the downloader receives this many messages at once
+# (SQS allows at most 10) and downloads every matched recording that fits
+# into the invocation's remaining run time
+DOWNLOAD_BATCH_SIZE = min(int(env("DOWNLOAD_BATCH_SIZE") or 1), 10)
+# Seconds of run time to hold back when deciding whether another
+# download can be started in batch mode
+DOWNLOAD_TIME_RESERVE = int(env("DOWNLOAD_TIME_RESERVE") or 60)
+# Batch messages must stay hidden for as long as the invocation might
+# still get around to them (function timeout is 900s)
+BATCH_VISIBILITY_TIMEOUT = 960
+# Number of a recording's files that are transferred to S3 in parallel
+DOWNLOAD_FILE_WORKERS = int(env("DOWNLOAD_FILE_WORKERS") or 3)
+# Limit on the number of multipart chunks held in memory at once across
+# all of a recording's file transfers
+MAX_PARTS_IN_FLIGHT = int(env("MAX_PARTS_IN_FLIGHT") or 12)
+# Smallest size in bytes of the multipart chunks streamed from zoom to S3
+PART_SIZE = max(
+    int(env("PART_SIZE") or MIN_CHUNK_SIZE), MIN_CHUNK_SIZE
+)
+# Bytes that all parts in flight may take up together. Parts are never
+# sized larger than PART_MEMORY_BUDGET / MAX_PARTS_IN_FLIGHT unless that's
+# the only way to stay under S3's part limit.
+PART_MEMORY_BUDGET = int(env("PART_MEMORY_BUDGET") or 300 * 1024 * 1024)
+# When zoom reports the file size parts are sized to aim for this many
+PART_COUNT_TARGET = int(env("PART_COUNT_TARGET") or 100)
+# When the file size is unknown the part size doubles every this many parts
+PART_SIZE_STEP = 100
+# S3 won't accept more parts than this for a single upload
+MAX_PARTS = 10000
+# DynamoDB table where the progress of unfinished multipart uploads is
+# saved so a later invocation can resume the transfer
+DOWNLOAD_CHECKPOINT_TABLE = env("DOWNLOAD_CHECKPOINT_TABLE")
+# Minimum seconds between checkpoint saves while a file is streaming
+CHECKPOINT_INTERVAL = int(env("CHECKPOINT_INTERVAL") or 30)
+# The recordings bucket aborts incomplete multipart uploads after a day
+CHECKPOINT_EXPIRY_SECONDS = 86400
+# Max number of a single file's parts uploading at once. Reading from the
+# zoom stream waits until one of these slots is free.
+PART_WINDOW_SIZE = int(env("PART_WINDOW_SIZE") or 4)
+# Times a part is sent before giving up on it when S3 throttles or fails
+# the request or the part arrives corrupted
+PART_UPLOAD_ATTEMPTS = int(env("PART_UPLOAD_ATTEMPTS") or 5)
+# Total part retries allowed for one file before its transfer fails
+PART_RETRY_BUDGET = int(env("PART_RETRY_BUDGET") or 20)
+# Seconds of backoff before the first part retry, doubling with every retry
+PART_RETRY_BASE_DELAY = 0.5
+PART_RETRY_MAX_DELAY = 20
+# S3 errors worth sending the part again for
+RETRYABLE_S3_ERRORS = ["SlowDown", "ServiceUnavailable", "InternalError",
+                       "RequestTimeout", "RequestTimeTooSkewed", "BadDigest"]
 
 
 class PermanentDownloadError(Exception):
     pass
 
 
+class TransferCancelled(Exception):
+    pass
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+# day codes used in the schedule, in datetime.weekday() order
+SCHEDULE_DAYS = OrderedDict([
+    ("M", "Mondays"),
+    ("T", "Tuesdays"),
+    ("W", "Wednesdays"),
+    ("R", "Thursdays"),
+    ("F", "Fridays"),
+    ("S", "Saturday"),
+    ("U", "Sunday")
+])
+
+
+class IntervalTree:
+    """
+    Static centered interval tree of open intervals `(low, high, value)`.
+    Finds the intervals containing a point in O(log n + matches).
+    """
+
+    def __init__(self, intervals):
+        self.center = None
+        self.left = self.right = None
+        # an empty interval never contains anything
+        intervals = [i for i in intervals if i[0] < i[1]]
+        if not intervals:
+            return
+
+        # splitting at the median midpoint always leaves at least one
+        # interval at this node, so the subtrees keep getting smaller
+        midpoints = sorted((low + high) / 2 for low, high, _ in intervals)
+        self.center = midpoints[len(midpoints) // 2]
+
+        left, right, here = [], [], []
+        for interval in intervals:
+            low, high, _ = interval
+            if high <= self.center:
+                left.append(interval)
+            elif low >= self.center:
+                right.append(interval)
+            else:
+                here.append(interval)
+        # the intervals containing the center, ordered for cutting the
+        # search short from either end
+        self.by_low = sorted(here, key=lambda i: i[0])
+        self.by_high = sorted(here, key=lambda i: i[1], reverse=True)
+        if left:
+            self.left = IntervalTree(left)
+        if right:
+            self.right = IntervalTree(right)
+
+    def query(self, point):
+        """
+        Values of the intervals that contain `point`.
+        """
+        node, found = self, []
+        while node is not None and node.center is not None:
+            if point < node.center:
+                for low, high, value in node.by_low:
+                    if low >= point:
+                        break
+                    found.append(value)
+                node = node.left
+            elif point > node.center:
+                for low, high, value in node.by_high:
+                    if high <= point:
+                        break
+                    found.append(value)
+                node = node.right
+            else:
+                found.extend(value for _, _, value in node.by_low)
+                break
+        return found
+
+
+def parse_schedule_date(value):
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+class ClassSchedule(dict):
+    """
+    A class schedule table item, compiled for matching recording start
+    times. `Days` and `Time` give the start times for every day the class
+    meets. Items can also have:
+
+    - `day_times`: start times by day code, used instead of `Days` and
+      `Time` for classes that start at different times on different days
+    - `start_date`, `end_date`: the term (YYYY-MM-DD)
+    - `holidays`: dates the class doesn't meet
+    - `exceptions`: start times by date for one-off changes, replacing
+      that day's usual times. An empty list cancels the class that day.
+    - `buffer_minutes`: how close to a start time a recording has to
+      start, instead of BUFFER_MINUTES
+    """
+
+    def __init__(self, item):
+        super().__init__(item)
+        # DynamoDB sometimes returns type decimal.Decimal
+        self["opencast_series_id"] = str(self["opencast_series_id"])
+        self.buffer_minutes = int(self.get("buffer_minutes", BUFFER_MINUTES))
+
+        self.start_date = self.end_date = None
+        if self.get("start_date"):
+            self.start_date = parse_schedule_date(self["start_date"])
+        if self.get("end_date"):
+            self.end_date = parse_schedule_date(self["end_date"])
+        self.holidays = {
+            parse_schedule_date(d) for d in self.get("holidays", [])
+        }
+
+        day_times = self.get("day_times") or {
+            day_code: self.get("Time", []) for day_code in self.get("Days", [])
+        }
+        self.weekday_starts = {
+            weekday: self._start_times(day_times[day_code])
+            for weekday, day_code in enumerate(SCHEDULE_DAYS)
+            if day_code in day_times
+        }
+        self.exceptions = {
+            parse_schedule_date(d): self._start_times(times)
+            for d, times in self.get("exceptions", {}).items()
+        }
+
+    def _start_times(self, times):
+        """
+        Tree of the windows around each start time (in minutes of the
+        day) that a recording can start in.
+        """
+        starts = [int(t.split(":")[0]) * 60 + int(t.split(":")[1])
+                  for t in times]
+        return IntervalTree([
+            (start - self.buffer_minutes, start + self.buffer_minutes, start)
+            for start in starts
+        ])
+
+    def _starts_on(self, day):
+        # a one-off change is more specific than the term and holidays
+        if day in self.exceptions:
+            return self.exceptions[day]
+        if self.start_date and day < self.start_date \
+                or self.end_date and day > self.end_date \
+                or day in self.holidays:
+            return None
+        return self.weekday_starts.get(day.weekday())
+
+    def meets_on(self, day):
+        starts = self._starts_on(day)
+        return starts is not None and starts.center is not None
+
+    def scheduled_start(self, local_time):
+        """
+        The scheduled start time, in minutes of the day, closest to
+        `local_time` and within the buffer, or None if there isn't one.
+        """
+        starts = self._starts_on(local_time.date())
+        if starts is None:
+            return None
+        minute = (local_time.hour * 60 + local_time.minute
+                  + local_time.second / 60)
+        return min(starts.query(minute),
+                   key=lambda start: abs(start - minute),
+                   default=None)
+
+
+class ScheduleIndex:
+    """
+    The whole class schedule table, loaded with a single paginated scan
+    and kept in memory between invocations. Once it's older than `ttl`
+    seconds a background thread reloads it while lookups carry on with
+    the copy they have.
+    """
+
+    def __init__(self, ttl=SCHEDULE_INDEX_TTL):
+        self.ttl = ttl
+        self._schedules = None
+        # series looked up by prefetch since the last reload that
+        # turned out not to be in the table
+        self._not_scheduled = set()
+        self._loaded = 0
+        self._load_failed = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def get(self, zoom_series_id):
+        if self._schedules is None:
+            if not self._initial_load():
+                return get_schedule(zoom_series_id)
+        elif time.time() - self._loaded > self.ttl:
+            self._refresh_in_background()
+        return self._schedules.get(str(zoom_series_id))
+
+    def _initial_load(self):
+        """
+        Load the index if it hasn't been. If the scan fails (e.g. it's
+        throttled) lookups go to the table one at a time, and the scan
+        isn't tried again until `ttl` seconds later.
+        """
+        if (self._load_failed is not None
+                and time.time() - self._load_failed < self.ttl):
+            return False
+        try:
+            self.refresh()
+            return True
+        except Exception:
+            logger.exception("Loading the class schedule failed")
+            self._load_failed = time.time()
+            return False
+
+    def refresh(self):
+        table = boto3.resource("dynamodb").Table(CLASS_SCHEDULE_TABLE)
+        schedules = {}
+        scan_args = {}
+        while True:
+            r = table.scan(**scan_args)
+            for item in r["Items"]:
+                schedules[str(item["zoom_series_id"])] = ClassSchedule(item)
+            if "LastEvaluatedKey" not in r:
+                break
+            scan_args["ExclusiveStartKey"] = r["LastEvaluatedKey"]
+
+        with self._lock:
+            self._schedules = schedules
+            self._not_scheduled = set()
+            self._loaded = time.time()
+        logger.info({"schedule_index_loaded": len(schedules)})
+
+    def prefetch(self, zoom_series_ids):
+        """
+        Look up a batch of series that aren't in the index with a single
+        BatchGetItem, so schedules added since the last reload are found
+        without waiting for the next one.
+        """
+        zoom_series_ids = {str(i) for i in zoom_series_ids if i is not None}
+        if not zoom_series_ids:
+            return
+        if self._schedules is None and not self._initial_load():
+            return
+
+        with self._lock:
+            missing = zoom_series_ids - set(self._schedules) \
+                - self._not_scheduled
+        if not missing:
+            return
+
+        found, unprocessed = batch_get_schedules(missing)
+        with self._lock:
+            self._schedules = {**self._schedules, **found}
+            self._not_scheduled |= missing - set(found) - unprocessed
+        logger.info({
+            "schedule_prefetch": {
+                "requested": len(missing),
+                "found": len(found),
+                "unprocessed": len(unprocessed)
+            }
+        })
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Reloading the class schedule failed")
+            finally:
+                with self._lock:
+                    self._refreshing = False
+
+        threading.Thread(target=run, daemon=True).start()
+
+
+def get_schedule(zoom_series_id):
+    """
+    Look up one series' schedule directly in the class schedule table.
+    """
+    table = boto3.resource("dynamodb").Table(CLASS_SCHEDULE_TABLE)
+    r = table.get_item(Key={"zoom_series_id": str(zoom_series_id)})
+    if "Item" not in r:
+        return None
+    return ClassSchedule(r["Item"])
+
+
+def batch_get_schedules(zoom_series_ids):
+    """
+    Fetch the schedules of `zoom_series_ids` with BatchGetItem. Keys DynamoDB
+    leaves unprocessed (e.g. when throttled) are requested again with
+    backoff. Returns the schedules found by series id and the series ids
+    that were still unprocessed after BATCH_GET_ATTEMPTS requests.
+    """
+    dynamodb = boto3.resource("dynamodb")
+    keys = [{"zoom_series_id": i} for i in sorted(zoom_series_ids)]
+    found = {}
+    unprocessed = set()
+
+    for start in range(0, len(keys), BATCH_GET_MAX_KEYS):
+        request = {
+            CLASS_SCHEDULE_TABLE: {"Keys": keys[start:start + BATCH_GET_MAX_KEYS]}
+        }
+        for attempt in range(1, BATCH_GET_ATTEMPTS + 1):
+            r = dynamodb.batch_get_item(RequestItems=request)
+            for item in r["Responses"].get(CLASS_SCHEDULE_TABLE, []):
+                found[str(item["zoom_series_id"])] = ClassSchedule(item)
+            request = r.get("UnprocessedKeys")
+            if not request:
+                break
+            if attempt < BATCH_GET_ATTEMPTS:
+                time.sleep(backoff_delay(attempt))
+        else:
+            left = request[CLASS_SCHEDULE_TABLE]["Keys"]
+            logger.warning("{} schedule lookups still unprocessed after {} "
+                           "attempts".format(len(left), BATCH_GET_ATTEMPTS))
+            unprocessed |= {k["zoom_series_id"] for k in left}
+
+    return found, unprocessed
+
+
+# kept at module scope so warm invocations reuse them
+HOST_NAMES = HostNameCache(HOST_NAME_TABLE)
+SCHEDULE_INDEX = ScheduleIndex()
+
+
 # abstraction for unit testing
 def sqs_resource():
     return boto3.resource("sqs")
@@ -44,42 +449,43 @@ def sqs_resource():
 @setup_logging
 def handler(event, context):
     """
-    This function receives an event on each new entry in the download urls
-    DyanmoDB table
+    This function is invoked on a schedule to poll the download queue, or
+    by the download queue's event source mapping with a batch of messages
     """
 
     ignore_schedule = event.get("ignore_schedule", False)
     override_series_id = event.get("override_series_id")
     sqs = sqs_resource()
+    download_queue = sqs.get_queue_by_name(QueueName=DOWNLOAD_QUEUE_NAME)
+
+    # invoked by the download queue's event source mapping
+    if "Records" in event:
+        return event_source_download(
+            sqs, download_queue, event["Records"], context,
+            ignore_schedule, override_series_id
+        )
+
+    # a manual override or schedule bypass only applies to one recording
+    if DOWNLOAD_BATCH_SIZE > 1 and not (ignore_schedule or override_series_id):
+        return batch_download(
+            sqs, download_queue, context, ignore_schedule, override_series_id
+        )
 
     # try DOWNLOAD_MESSAGES_PER_INVOCATION number of times to retrieve
     # a recording that matches the class schedule
     dl, download_message = None, None
-    download_queue = sqs.get_queue_by_name(QueueName=DOWNLOAD_QUEUE_NAME)
     for _ in range(int(DOWNLOAD_MESSAGES_PER_INVOCATION)):
         download_message = retrieve_message(download_queue)
         if not download_message:
             logger.info("No download queue messages available.")
             return
 
-        dl_data = json.loads(download_message.body)
-        dl = Download(sqs, dl_data)
-
-        # this is checking for ~total~ duration of the recording as reported
-        # by zoom in the webook payload data. There is a separate check later
-        # for the duration potentially different sets of files
-        if dl.duration >= MINIMUM_DURATION:
-            if dl.oc_series_found(ignore_schedule, override_series_id):
-                break
-            else:
-                failure_msg = {"no_oc_series_found": dl_data}
-        else:
-            failure_msg = {"recording_too_short": dl_data}
-
-        # discard and keep checking messages for schedule match
-        logger.info(failure_msg)
-        download_message.delete()
-        dl, download_message = None, None
+        dl = matched_download(
+            sqs, download_message, ignore_schedule, override_series_id
+        )
+        if dl:
+            break
+        download_message = None
 
     if not dl:
         logger.info("No available recordings match the class schedule.")
@@ -88,6 +494,255 @@ def handler(event, context):
     global ADMIN_TOKEN
     ADMIN_TOKEN = get_admin_token()
 
+    ingest_download(dl, download_message)
+
+
+def batch_download(sqs, download_queue, context,
+                   ignore_schedule=False, override_series_id=None):
+    """
+    Receive up to DOWNLOAD_BATCH_SIZE messages and download every matched
+    recording for as long as the invocation's remaining run time allows.
+    Messages that don't get processed are returned to the queue.
+    """
+    messages = retrieve_messages(download_queue, DOWNLOAD_BATCH_SIZE)
+    if not messages:
+        logger.info("No download queue messages available.")
+        return
+
+    failed, unprocessed = download_messages(
+        sqs, download_queue, messages, context,
+        ignore_schedule, override_series_id
+    )
+
+    if unprocessed:
+        return_messages(download_queue, unprocessed)
+
+    if failed:
+        raise failed[0][1]
+
+
+def event_source_download(sqs, download_queue, records, context,
+                          ignore_schedule=False, override_series_id=None):
+    """
+    Download the recordings of a batch of messages delivered by an SQS
+    event source mapping. Only the messages whose downloads failed are
+    reported back (`batchItemFailures`) to be retried, so one bad
+    recording doesn't send the whole batch around again.
+    """
+    messages = [RecordMessage(download_queue, record) for record in records]
+    failed, unprocessed = download_messages(
+        sqs, download_queue, messages, context,
+        ignore_schedule, override_series_id
+    )
+
+    # permanent failures have already gone to the deadletter queue
+    failed_messages = [
+        message for message, error in failed
+        if not isinstance(error, PermanentDownloadError)
+    ]
+    # Re-sending messages we ran out of time for doesn't count against
+    # the queue's max receive count the way reporting them failed would.
+    # The event source mapping deletes the originals.
+    if unprocessed:
+        failed_messages += requeue_messages(download_queue, unprocessed)
+
+    return {
+        "batchItemFailures": [
+            {"itemIdentifier": message.message_id}
+            for message in failed_messages
+        ]
+    }
+
+
+def download_messages(sqs, download_queue, messages, context,
+                      ignore_schedule=False, override_series_id=None):
+    """
+    Download every matched recording in `messages` for as long as the
+    invocation's remaining run time allows. Returns the (message, error)
+    pairs of downloads that failed and the matched messages there wasn't
+    time for.
+    """
+    if not ignore_schedule and not override_series_id:
+        SCHEDULE_INDEX.prefetch(
+            json.loads(m.body).get("zoom_series_id") for m in messages
+        )
+
+    matched, too_short, unmatched = classify_messages(
+        sqs, messages, ignore_schedule, override_series_id
+    )
+    delete_messages(download_queue, too_short)
+    move_unmatched(sqs, download_queue, unmatched)
+
+    global ADMIN_TOKEN
+    downloads, longest_download = 0, 0
+    failed, unprocessed = [], []
+
+    for i, (dl, download_message) in enumerate(matched):
+        # don't start a download unless there's at least as much time left
+        # as the slowest download so far has taken
+        time_left = (context.get_remaining_time_in_millis() / 1000
+                     - DOWNLOAD_TIME_RESERVE)
+        if downloads and time_left < longest_download:
+            logger.info({
+                "out_of_time": {
+                    "seconds_left": time_left,
+                    "longest_download": longest_download
+                }
+            })
+            unprocessed = [message for _, message in matched[i:]]
+            break
+
+        if not downloads:
+            ADMIN_TOKEN = get_admin_token()
+
+        start = time.time()
+        try:
+            ingest_download(dl, download_message)
+        except Exception as e:
+            # a failed download shouldn't hold up the rest of the batch.
+            # Non-permanent failures leave the message on the queue to be
+            # retried once its visibility timeout expires.
+            if not isinstance(e, PermanentDownloadError):
+                logger.exception("Download failed: {}".format(e))
+            failed.append((download_message, e))
+        downloads += 1
+        longest_download = max(longest_download, time.time() - start)
+
+    logger.info({
+        "batch_complete": {
+            "received": len(messages),
+            "too_short": len(too_short),
+            "unmatched": len(unmatched),
+            "downloaded": downloads,
+            "returned": len(unprocessed)
+        }
+    })
+
+    if not downloads:
+        logger.info("No available recordings match the class schedule.")
+
+    return failed, unprocessed
+
+
+def classify_download(dl, ignore_schedule=False, override_series_id=None):
+    """
+    Returns "matched" if the recording is long enough and can be matched
+    to an opencast series, otherwise "too_short" or "unmatched".
+    """
+    # this is checking for ~total~ duration of the recording as reported
+    # by zoom in the webook payload data. There is a separate check later
+    # for the duration potentially different sets of files
+    if dl.duration < MINIMUM_DURATION:
+        logger.info({"recording_too_short": dl.data})
+        return "too_short"
+    if not dl.oc_series_found(ignore_schedule, override_series_id):
+        logger.info({"no_oc_series_found": dl.data})
+        return "unmatched"
+    return "matched"
+
+
+def matched_download(sqs, download_message,
+                     ignore_schedule=False, override_series_id=None):
+    """
+    Returns a Download for the message if the recording is long enough and
+    can be matched to an opencast series. Otherwise the message is deleted,
+    after moving it to the unmatched queue if there's no series for it.
+    """
+    dl = Download(sqs, json.loads(download_message.body))
+    result = classify_download(dl, ignore_schedule, override_series_id)
+    if result == "matched":
+        return dl
+
+    # discard and keep checking messages for schedule match
+    if result == "unmatched" and UNMATCHED_QUEUE_NAME:
+        unmatched_queue = sqs.get_queue_by_name(QueueName=UNMATCHED_QUEUE_NAME)
+        SQSMessage(unmatched_queue, dl.data).send()
+    download_message.delete()
+    return None
+
+
+def classify_messages(sqs, messages,
+                      ignore_schedule=False, override_series_id=None):
+    """
+    Sort a batch of messages into (Download, message) pairs for matched
+    recordings and lists of the messages for recordings that are too
+    short or have no opencast series.
+    """
+    matched, too_short, unmatched = [], [], []
+    for message in messages:
+        dl = Download(sqs, json.loads(message.body))
+        result = classify_download(dl, ignore_schedule, override_series_id)
+        if result == "matched":
+            matched.append((dl, message))
+        elif result == "too_short":
+            too_short.append(message)
+        else:
+            unmatched.append(message)
+    return matched, too_short, unmatched
+
+
+class RecordMessage:
+    """
+    A message delivered in an SQS event, wrapped to look like the
+    sqs.Message resources the downloader receives when it polls.
+    """
+
+    def __init__(self, queue, record):
+        self.body = record["body"]
+        self.message_id = record["messageId"]
+        self.receipt_handle = record["receiptHandle"]
+        self._message = queue.Message(self.receipt_handle)
+
+    def delete(self):
+        return self._message.delete()
+
+    def change_visibility(self, **kwargs):
+        return self._message.change_visibility(**kwargs)
+
+
+def batch_entries(messages, **fields):
+    return [
+        {"Id": str(i), "ReceiptHandle": message.receipt_handle, **fields}
+        for i, message in enumerate(messages)
+    ]
+
+
+def log_batch_failures(action, response):
+    for failure in response.get("Failed", []):
+        logger.error({"sqs_batch_failure": {"action": action, **failure}})
+
+
+def delete_messages(queue, messages):
+    """
+    Delete messages with a single DeleteMessageBatch request.
+    """
+    if not messages:
+        return
+    r = queue.delete_messages(Entries=batch_entries(messages))
+    log_batch_failures("delete", r)
+
+
+def move_unmatched(sqs, queue, messages):
+    """
+    Move messages for recordings without an opencast series to the
+    unmatched queue, or just delete them if there isn't one. Messages
+    that fail to send stay put to be retried.
+    """
+    if not messages:
+        return
+    if UNMATCHED_QUEUE_NAME:
+        unmatched_queue = sqs.get_queue_by_name(QueueName=UNMATCHED_QUEUE_NAME)
+        r = unmatched_queue.send_messages(Entries=[
+            {"Id": str(i), "MessageBody": message.body}
+            for i, message in enumerate(messages)
+        ])
+        log_batch_failures("send_unmatched", r)
+        failed = {f["Id"] for f in r.get("Failed", [])}
+        messages = [m for i, m in enumerate(messages) if str(i) not in failed]
+    delete_messages(queue, messages)
+
+
+def ingest_download(dl, download_message):
     try:
         # upload matched recording to S3 and verify MP4 integrity
         dl.upload_to_s3()
@@ -115,10 +770,48 @@ def retrieve_message(queue):
     return messages[0]
 
 
+def retrieve_messages(queue, count):
+    return queue.receive_messages(
+        MaxNumberOfMessages=count,
+        VisibilityTimeout=BATCH_VISIBILITY_TIMEOUT
+    )
+
+
+def requeue_messages(queue, messages):
+    """
+    Send copies of messages to the back of the queue. Returns the
+    messages that couldn't be sent.
+    """
+    r = queue.send_messages(Entries=[
+        {"Id": str(i), "MessageBody": message.body}
+        for i, message in enumerate(messages)
+    ])
+    log_batch_failures("requeue", r)
+    failed = {f["Id"] for f in r.get("Failed", [])}
+    return [m for i, m in enumerate(messages) if str(i) in failed]
+
+
+def return_messages(queue, messages):
+    """
+    Send copies of messages to the back of the queue for the next
+    invocation and delete the originals. Making the originals visible
+    again would count each return as a receive toward the queue's
+    redrive policy. Messages that couldn't be copied are made visible
+    instead.
+    """
+    not_sent = requeue_messages(queue, messages)
+    delete_messages(queue, [m for m in messages if m not in not_sent])
+    if not_sent:
+        r = queue.change_message_visibility_batch(
+            Entries=batch_entries(not_sent, VisibilityTimeout=0)
+        )
+        log_batch_failures("return", r)
+
+
 def get_admin_token():
-    # get admin level zak token from admin id
-    r = zoom_api_request("users/{}/token?type=zak".format(ZOOM_ADMIN_ID))
-    return r.json()["token"]
+    # get admin level zak token from admin id, reused across invocations
+    # until it's close to expiring
+    return zoom_zak_token(ZOOM_ADMIN_ID)
 
 
 class Download:
@@ -133,13 +826,8 @@ class Download:
     @property
     def host_name(self):
         if not hasattr(self, "_host_name"):
-            resp = zoom_api_request(
-                    "users/{}".format(self.data["host_id"])
-                   ).json()
-            logger.info({"Host details": resp})
-            self._host_name = "{} {}".format(
-                                resp["first_name"], resp["last_name"]
-                                )
+            # hosts that are no longer zoom users get an empty name
+            self._host_name = HOST_NAMES.get(self.data["host_id"]) or ""
         return self._host_name
 
     @property
@@ -243,22 +931,9 @@ class Download:
     @property
     def _class_schedule(self):
         """
-        Retrieve the course schedule from DynamoDB.
+        Retrieve the course schedule from the in-memory schedule index.
         """
-        dynamodb = boto3.resource("dynamodb")
-        table = dynamodb.Table(CLASS_SCHEDULE_TABLE)
-
-        r = table.get_item(
-            Key={"zoom_series_id": str(self.data["zoom_series_id"])}
-        )
-
-        if "Item" not in r:
-            return None
-        else:
-            schedule = r["Item"]
-            # DynamoDB sometimes returns type decimal.Decimal
-            schedule["opencast_series_id"] = str(schedule["opencast_series_id"])
-            return schedule
+        return SCHEDULE_INDEX.get(self.data["zoom_series_id"])
 
     @property
     def _series_id_from_schedule(self):
@@ -271,37 +946,24 @@ class Download:
 
         if not schedule:
             return None
+        if not isinstance(schedule, ClassSchedule):
+            schedule = ClassSchedule(schedule)
 
         zoom_time = self._created_local
         logger.info({"meeting creation time": zoom_time,
                      "course schedule": schedule})
-        days = OrderedDict([
-            ("M", "Mondays"),
-            ("T", "Tuesdays"),
-            ("W", "Wednesdays"),
-            ("R", "Thursdays"),
-            ("F", "Fridays"),
-            ("S", "Saturday"),
-            ("U", "Sunday")
-        ])
-        day_code = list(days.keys())[zoom_time.weekday()]
-        if day_code not in schedule["Days"]:
-            logger.debug("No opencast recording scheduled on {}."
-                         .format(days[day_code]))
+        if not schedule.meets_on(zoom_time.date()):
+            day_code = list(SCHEDULE_DAYS)[zoom_time.weekday()]
+            logger.debug("No opencast recording scheduled on {} {}."
+                         .format(SCHEDULE_DAYS[day_code], zoom_time.date()))
             return None
 
-        for t in schedule["Time"]:
-            scheduled_time = datetime.strptime(t, "%H:%M")
-            timedelta = abs(zoom_time -
-                            zoom_time.replace(hour=scheduled_time.hour,
-                                              minute=scheduled_time.minute)
-                            ).total_seconds()
-            if timedelta < (BUFFER_MINUTES * 60):
-                return schedule["opencast_series_id"]
+        if schedule.scheduled_start(zoom_time) is not None:
+            return schedule["opencast_series_id"]
 
         logger.debug("Meeting started more than {} minutes before or after "
                      "opencast scheduled start time."
-                     .format(BUFFER_MINUTES))
+                     .format(schedule.buffer_minutes))
 
         print("reached end of function")
         return None
@@ -349,7 +1011,8 @@ class Download:
                     "recording_start": file.file_data["recording_start"],
                     "recording_end": file.file_data["recording_end"],
                     "ffprobe_bytes": file.file_data["ffprobe_bytes"],
-                    "ffprobe_seconds": file.file_data["ffprobe_seconds"]
+                    "ffprobe_seconds": file.file_data["ffprobe_seconds"],
+                    "md5": file.file_data.get("md5")
                 }
                 segment_durations[segment["recording_start"]] = segment["ffprobe_seconds"]
                 if file.recording_type in s3_files:
@@ -405,8 +1068,26 @@ class Download:
 
         logger.info("downloading {} files".format(len(self.recording_files)))
 
-        for file in self.recording_files:
-            file.stream_file_to_s3()
+        # the files are transferred in parallel but share a single limit on
+        # the number of parts held in memory. If any one file fails the
+        # others are cancelled, which aborts their multipart uploads.
+        part_slots = threading.BoundedSemaphore(MAX_PARTS_IN_FLIGHT)
+        cancelled = threading.Event()
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=DOWNLOAD_FILE_WORKERS) as executor:
+            futures = [
+                executor.submit(file.stream_file_to_s3, part_slots, cancelled)
+                for file in self.recording_files
+            ]
+            try:
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+            except Exception:
+                cancelled.set()
+                for future in futures:
+                    future.cancel()
+                raise
 
     def send_to_deadletter_queue(self, error):
         deadletter_queue = self.sqs.get_queue_by_name(
@@ -466,6 +1147,238 @@ class SQSMessage():
                       "FailedReason": error})
 
 
+def composite_md5(parts):
+    """
+    The checksum S3 gives a completed multipart upload: the MD5 of the
+    parts' concatenated MD5 digests, followed by the number of parts.
+    """
+    digests = b"".join(
+        bytes.fromhex(p["ETag"].strip('"')) for p in parts
+    )
+    return "{}-{}".format(hashlib.md5(digests).hexdigest(), len(parts))
+
+
+def contiguous_parts(parts):
+    """
+    Returns the run of uploaded parts that starts at part number 1. Only
+    the bytes covered by these parts can be resumed from.
+    """
+    run = []
+    for part_number in itertools.count(1):
+        if part_number not in parts:
+            return run
+        run.append(parts[part_number])
+
+
+class MP4Inspector:
+    """
+    Follows the box structure of an MP4 file as its bytes stream past so
+    the file can be checked for completeness, and its duration read from
+    the moov/mvhd box, without fetching it back from S3 afterwards.
+    Only the top level boxes and the children of moov are looked at.
+    """
+
+    # mvhd is around 100 bytes, anything this size is not an mvhd
+    MAX_MVHD_SIZE = 4096
+
+    def __init__(self):
+        self.size = 0
+        self.boxes = []
+        self.duration = None
+        self.error = None
+        self._header = bytearray()
+        self._header_ready = False
+        self._skip = 0
+        self._to_end = False
+        self._mvhd = None
+        self._mvhd_left = 0
+        # bytes left in the moov box while we're inside it
+        self._moov_left = None
+
+    def feed(self, data):
+        data = memoryview(data)
+        self.size += len(data)
+        pos = 0
+        while pos < len(data) and not self.error and not self._to_end:
+            inside_moov = self._moov_left is not None
+            if self._mvhd_left:
+                n = min(self._mvhd_left, len(data) - pos)
+                self._mvhd += data[pos:pos + n]
+                self._mvhd_left -= n
+                if not self._mvhd_left:
+                    self._parse_mvhd()
+            elif self._skip:
+                n = min(self._skip, len(data) - pos)
+                self._skip -= n
+            else:
+                n = self._read_header(data[pos:])
+            pos += n
+            # the moov header itself doesn't count against its contents
+            if inside_moov:
+                self._moov_left -= n
+            if self._header_ready:
+                self._start_box()
+            if self._moov_left == 0:
+                self._moov_left = None
+
+    def _read_header(self, data):
+        # a header is 8 bytes, or 16 if the size is in a 64-bit field
+        needed = 8
+        if len(self._header) >= 4 and unpack_from(">I", self._header)[0] == 1:
+            needed = 16
+        n = min(needed - len(self._header), len(data))
+        self._header += data[:n]
+        if len(self._header) == 8 and unpack_from(">I", self._header)[0] == 1:
+            return n
+        self._header_ready = len(self._header) == needed
+        return n
+
+    def _start_box(self):
+        size, box_type = unpack_from(">I4s", self._header)
+        box_type = box_type.decode("latin-1")
+        header_size = len(self._header)
+        if size == 1:
+            size = unpack_from(">Q", self._header, 8)[0]
+        self._header = bytearray()
+        self._header_ready = False
+        inside_moov = self._moov_left is not None
+
+        if size == 0:
+            # the box runs to the end of the file
+            if inside_moov:
+                self.error = "open ended {} box inside moov".format(box_type)
+                return
+            self.boxes.append(box_type)
+            self._to_end = True
+            return
+
+        if size < header_size:
+            self.error = "invalid size {} for {} box".format(size, box_type)
+            return
+        if inside_moov and size - header_size > self._moov_left:
+            self.error = "{} box overruns moov".format(box_type)
+            return
+
+        payload = size - header_size
+        if not inside_moov:
+            self.boxes.append(box_type)
+        if box_type == "moov" and not inside_moov:
+            self._moov_left = payload
+        elif box_type == "mvhd" and inside_moov:
+            if payload > self.MAX_MVHD_SIZE:
+                self.error = "invalid mvhd size {}".format(size)
+                return
+            self._mvhd = bytearray()
+            self._mvhd_left = payload
+            if not payload:
+                self._parse_mvhd()
+        else:
+            self._skip = payload
+
+    def _parse_mvhd(self):
+        mvhd = self._mvhd
+        try:
+            if mvhd[0] == 1:
+                timescale, duration = unpack_from(">IQ", mvhd, 20)
+                unknown = duration == 0xFFFFFFFFFFFFFFFF
+            else:
+                timescale, duration = unpack_from(">II", mvhd, 12)
+                unknown = duration == 0xFFFFFFFF
+        except Exception:
+            self.error = "truncated mvhd box"
+            return
+        if not timescale or unknown:
+            self.error = "mvhd box has no duration"
+            return
+        self.duration = duration / timescale
+
+    def finish(self):
+        """
+        Returns True if everything fed so far adds up to a complete MP4.
+        Otherwise `error` says what's wrong with it.
+        """
+        if self.error:
+            return False
+        if self._header or self._skip or self._mvhd_left \
+                or self._moov_left is not None:
+            self.error = "file is truncated"
+        elif not self.boxes or self.boxes[0] != "ftyp":
+            self.error = "file does not start with an ftyp box"
+        elif "moov" not in self.boxes or self.duration is None:
+            self.error = "no moov box with a duration"
+        elif "mdat" not in self.boxes:
+            self.error = "no mdat box"
+        return self.error is None
+
+
+class RetryBudget:
+    """
+    Retries shared by all the parts of a file transfer so that a file
+    failing over and over gives up instead of retrying each part in turn.
+    """
+
+    def __init__(self, retries):
+        self.remaining = retries
+        self._lock = threading.Lock()
+
+    def spend(self):
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+def retryable_part_error(e):
+    # connection errors (EndpointConnectionError, ConnectTimeoutError,
+    # SSLError, ...) aren't HTTPClientErrors
+    if isinstance(e, (ChecksumMismatch, HTTPClientError,
+                      BotocoreConnectionError)):
+        return True
+    if isinstance(e, ClientError):
+        error = e.response.get("Error", {})
+        status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        return error.get("Code") in RETRYABLE_S3_ERRORS \
+            or (status is not None and status >= 500)
+    return False
+
+
+def backoff_delay(attempt):
+    """
+    Full jitter: a random delay up to an exponentially growing cap so
+    that parts throttled together don't all retry together.
+    """
+    cap = min(PART_RETRY_MAX_DELAY, PART_RETRY_BASE_DELAY * 2 ** attempt)
+    return random.uniform(0, cap)
+
+
+class BufferPool:
+    """
+    Reusable fixed-size buffers for reading multipart chunks so that a
+    file transfer doesn't allocate a new buffer for every part.
+    """
+
+    def __init__(self):
+        self.size = None
+        self._free = []
+        self._lock = threading.Lock()
+
+    def get(self, size):
+        with self._lock:
+            # the part size has changed, old buffers are no use anymore
+            if size != self.size:
+                self.size = size
+                self._free = []
+            if self._free:
+                return self._free.pop()
+        return bytearray(size)
+
+    def put(self, buffer):
+        with self._lock:
+            if len(buffer) == self.size:
+                self._free.append(buffer)
+
+
 class ZoomFile:
 
     def __init__(self, file_data, track_set):
@@ -475,6 +1388,11 @@ class ZoomFile:
             file_data["recording_type"]
         )
         self.s3 = boto3.client("s3")
+        if DOWNLOAD_CHECKPOINT_TABLE:
+            self.checkpoints = boto3.resource("dynamodb") \
+                .Table(DOWNLOAD_CHECKPOINT_TABLE)
+        else:
+            self.checkpoints = None
 
     def __standardized_recording_type(self, name):
         """
@@ -553,6 +1471,43 @@ class ZoomFile:
                                 )
         return self._s3_filename
 
+    def verify_mp4(self, inspector=None):
+        """
+        Check the transferred file using what the inspector saw of it as
+        it streamed past. Transfers that resumed part way through never saw
+        the start of the file, so those fall back to running ffprobe.
+        """
+        if inspector is None:
+            return self.valid_mp4_file()
+
+        valid = inspector.finish()
+        if valid and self.content_length \
+                and inspector.size != self.content_length:
+            inspector.error = "expected {} bytes, got {}".format(
+                self.content_length, inspector.size
+            )
+            valid = False
+
+        logger.info({
+            "mp4_inspection": {
+                "s3_filename": self.s3_filename,
+                "boxes": inspector.boxes,
+                "duration": inspector.duration,
+                "size": inspector.size,
+                "error": inspector.error
+            }
+        })
+
+        if not valid:
+            logger.warning("Corrupt MP4, need to retry download "
+                           "from zoom to S3. {}: {}"
+                           .format(self.s3_filename, inspector.error))
+            return False
+
+        self.file_data["ffprobe_seconds"] = inspector.duration
+        self.file_data["ffprobe_bytes"] = inspector.size
+        return True
+
     def valid_mp4_file(self):
         # TODO: if file not found, add appropriate error
         url = self.s3.generate_presigned_url(
@@ -588,34 +1543,282 @@ class ZoomFile:
         logger.debug("Successfully verified mp4 {}".format(url))
         return True
 
+    def already_in_s3(self):
+        """
+        Checks whether an earlier attempt already transferred and verified
+        this file. The S3 object has to be the size zoom reports, belong to
+        the same recording and carry the verification results that get
+        saved as object tags.
+        """
+        file_size = self.file_data.get("file_size")
+        if not file_size:
+            return False
+
+        try:
+            head = self.s3.head_object(
+                Bucket=ZOOM_VIDEOS_BUCKET, Key=self.s3_filename
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ["404", "NoSuchKey"]:
+                return False
+            raise
+
+        if head["ContentLength"] != int(file_size) \
+                or head["Metadata"].get("file_id") \
+                != str(self.file_data["recording_id"]):
+            return False
+
+        tag_set = self.s3.get_object_tagging(
+            Bucket=ZOOM_VIDEOS_BUCKET, Key=self.s3_filename
+        )["TagSet"]
+        tags = {tag["Key"]: tag["Value"] for tag in tag_set}
+        if "ffprobe_seconds" not in tags or "ffprobe_bytes" not in tags:
+            return False
+
+        self.file_data["ffprobe_seconds"] = float(tags["ffprobe_seconds"])
+        self.file_data["ffprobe_bytes"] = int(tags["ffprobe_bytes"])
+        self.file_data["md5"] = head["ETag"].strip('"')
+        return True
+
+    def save_verification(self):
+        """
+        Record the verification results on the S3 object so a retry can
+        skip transferring this file again.
+        """
+        self.s3.put_object_tagging(
+            Bucket=ZOOM_VIDEOS_BUCKET,
+            Key=self.s3_filename,
+            Tagging={"TagSet": [
+                {"Key": key, "Value": str(self.file_data[key])}
+                for key in ["ffprobe_seconds", "ffprobe_bytes", "md5"]
+                if key in self.file_data
+            ]}
+        )
+
     @property
     def stream(self):
         if not hasattr(self, "_stream"):
-            logger.info("requesting {}".format(self.file_data["download_url"]))
-            url = "{}?zak={}".format(
-                self.file_data["download_url"], ADMIN_TOKEN
-            )
-            r = requests.get(url, stream=True)
-            r.raise_for_status
+            self.open_stream()
+        return self._stream
 
-            self._stream = r
+    def open_stream(self, offset=0):
+        """
+        Request the file from zoom, starting `offset` bytes in.
+        """
+        logger.info({"requesting": self.file_data["download_url"],
+                     "offset": offset})
+        url = "{}?zak={}".format(
+            self.file_data["download_url"], ADMIN_TOKEN
+        )
+        headers = {}
+        if offset:
+            headers["Range"] = "bytes={}-".format(offset)
+        r = requests.get(url, stream=True, headers=headers)
+        r.raise_for_status()
+        # chunks are read straight from the raw stream so have it undo
+        # any content-encoding the way iter_content would
+        r.raw.decode_content = True
 
-        return self._stream
+        self._stream = r
 
     @property
     def file_extension(self):
         return Path(self.zoom_filename).suffix[1:]
 
-    def upload_part(self, upload_id, part_number, chunk):
-        part = self.s3.upload_part(Body=chunk,
-                              Bucket=ZOOM_VIDEOS_BUCKET,
-                              Key=self.s3_filename,
-                              PartNumber=part_number,
-                              UploadId=upload_id)
+    def upload_part(self, upload_id, part_number, chunk, retry_budget=None):
+        """
+        Upload a part along with the MD5 of what we read from zoom. S3
+        rejects the part if what it receives doesn't match.
 
-        return part
+        Throttling, server errors and corrupted parts are retried with
+        jittered exponential backoff. The chunk stays in memory until the
+        part succeeds so only this part is sent again. Retries come out of
+        the file's `retry_budget`.
+        """
+        if retry_budget is None:
+            retry_budget = RetryBudget(PART_RETRY_BUDGET)
+
+        md5 = hashlib.md5(chunk)
+        content_md5 = base64.b64encode(md5.digest()).decode()
+
+        for attempt in range(1, PART_UPLOAD_ATTEMPTS + 1):
+            try:
+                part = self.s3.upload_part(Body=chunk,
+                                           Bucket=ZOOM_VIDEOS_BUCKET,
+                                           Key=self.s3_filename,
+                                           PartNumber=part_number,
+                                           UploadId=upload_id,
+                                           ContentMD5=content_md5)
+                if part["ETag"].strip('"') != md5.hexdigest():
+                    raise ChecksumMismatch(
+                        "Part {} of {} has ETag {}, expected {}".format(
+                            part_number, self.s3_filename,
+                            part["ETag"], md5.hexdigest()
+                        )
+                    )
+                return part
+            except Exception as e:
+                if not retryable_part_error(e) \
+                        or attempt == PART_UPLOAD_ATTEMPTS \
+                        or not retry_budget.spend():
+                    raise
+                delay = backoff_delay(attempt)
+                logger.warning({
+                    "part_retry": {
+                        "s3_filename": self.s3_filename,
+                        "part_number": part_number,
+                        "attempt": attempt,
+                        "delay": round(delay, 2),
+                        "retries_left": retry_budget.remaining,
+                        "error": str(e)
+                    }
+                })
+                time.sleep(delay)
 
-    def stream_file_to_s3(self):
+    @property
+    def content_length(self):
+        length = self.stream.headers.get("Content-Length")
+        return int(length) if length else None
+
+    def part_sizes(self, first_part=1):
+        """
+        Returns an iterator of the sizes to use for successive parts.
+        When zoom tells us the file size every part gets the same size,
+        picked to aim for PART_COUNT_TARGET parts within the memory budget
+        and S3's part limit. Otherwise sizes start at PART_SIZE and double
+        every PART_SIZE_STEP parts up to the memory budget limit.
+        """
+        max_size = max(PART_SIZE, PART_MEMORY_BUDGET // MAX_PARTS_IN_FLIGHT)
+        length = self.content_length
+
+        if not length:
+            logger.info("File size unknown, using progressive part sizes")
+            return (
+                min(PART_SIZE * 2 ** (n // PART_SIZE_STEP), max_size)
+                for n in itertools.count()
+            )
+
+        mib = 1024 * 1024
+        size = ceil(length / PART_COUNT_TARGET / mib) * mib
+        size = min(max(size, PART_SIZE), max_size)
+        # going over the memory budget is better than failing the upload
+        size = max(size, ceil(length / (MAX_PARTS - first_part + 1)))
+
+        logger.info({
+            "part_sizing": {
+                "file_size": length,
+                "part_size": size,
+                "parts": ceil(length / size)
+            }
+        })
+        return itertools.repeat(size)
+
+    def read_chunk(self, buffer):
+        """
+        Fill `buffer` from the zoom stream. Returns the number of bytes
+        read, which is only less than the buffer size at the end of the
+        stream.
+        """
+        raw = self.stream.raw
+        view = memoryview(buffer)
+        filled = 0
+        while filled < len(buffer):
+            n = raw.readinto(view[filled:])
+            if not n:
+                break
+            filled += n
+        return filled
+
+    @property
+    def checkpoint_key(self):
+        return {
+            "meeting_uuid": str(self.file_data["meeting_uuid"]),
+            "recording_id": str(self.file_data["recording_id"])
+        }
+
+    def load_checkpoint(self):
+        """
+        Returns the upload id and resumable parts of an unfinished earlier
+        transfer of this file, or None if there isn't one.
+        """
+        if not self.checkpoints:
+            return None
+
+        item = self.checkpoints.get_item(Key=self.checkpoint_key).get("Item")
+        if not item or item["s3_key"] != self.s3_filename:
+            return None
+
+        # S3 has the final word on which parts made it. The checkpoint lags
+        # behind and the invocation may have timed out between saves.
+        uploaded = {}
+        try:
+            paginator = self.s3.get_paginator("list_parts")
+            for page in paginator.paginate(Bucket=ZOOM_VIDEOS_BUCKET,
+                                           Key=self.s3_filename,
+                                           UploadId=item["upload_id"]):
+                for part in page.get("Parts", []):
+                    uploaded[part["PartNumber"]] = {
+                        "PartNumber": part["PartNumber"],
+                        "ETag": part["ETag"],
+                        "Size": int(part["Size"])
+                    }
+        except self.s3.exceptions.NoSuchUpload:
+            logger.info("Multipart upload {} no longer exists"
+                        .format(item["upload_id"]))
+            self.delete_checkpoint()
+            return None
+
+        return {
+            "upload_id": item["upload_id"],
+            "parts": contiguous_parts(uploaded)
+        }
+
+    def save_checkpoint(self, upload_id, parts):
+        self.checkpoints.put_item(Item={
+            **self.checkpoint_key,
+            "s3_key": self.s3_filename,
+            "upload_id": upload_id,
+            "parts": parts,
+            "offset": sum(p["Size"] for p in parts),
+            "expires": int(time.time()) + CHECKPOINT_EXPIRY_SECONDS
+        })
+
+    def delete_checkpoint(self):
+        if self.checkpoints:
+            self.checkpoints.delete_item(Key=self.checkpoint_key)
+
+    def abort_upload(self, upload_id):
+        self.s3.abort_multipart_upload(
+            Bucket=ZOOM_VIDEOS_BUCKET,
+            Key=self.s3_filename,
+            UploadId=upload_id
+        )
+        self.delete_checkpoint()
+
+    def stream_file_to_s3(self, part_slots=None, cancelled=None):
+        """
+        Stream the file from zoom to S3 as a multipart upload.
+        `part_slots` limits how many parts can be held in memory at once
+        and may be shared with other files being transferred at the same
+        time. Setting the `cancelled` event aborts the transfer.
+
+        If checkpoints are enabled a failed transfer keeps its multipart
+        upload and the next attempt continues from the last uploaded part.
+        A cancelled transfer is always aborted.
+        """
+        if part_slots is None:
+            part_slots = threading.BoundedSemaphore(MAX_PARTS_IN_FLIGHT)
+        if cancelled is None:
+            cancelled = threading.Event()
+
+        if cancelled.is_set():
+            raise TransferCancelled(
+                "Transfer of {} file cancelled".format(self.recording_type)
+            )
+
+        if self.already_in_s3():
+            logger.info({"already_in_s3": self.s3_filename})
+            return
 
         metadata = {
             "uuid": self.file_data["meeting_uuid"],
@@ -627,57 +1830,200 @@ class ZoomFile:
             {"uploading file to S3": self.s3_filename,
              "metadata": metadata}
         )
-        parts = []
-        mpu = self.s3.create_multipart_upload(
-                    Bucket=ZOOM_VIDEOS_BUCKET,
-                    Key=self.s3_filename,
-                    Metadata=metadata)
+
+        # completed parts by part number
+        parts = {}
+        upload_id = None
+
+        # set when an earlier attempt already uploaded every byte
+        stream_done = False
+
+        checkpoint = self.load_checkpoint()
+        if checkpoint:
+            offset = sum(p["Size"] for p in checkpoint["parts"])
+            if offset:
+                try:
+                    self.open_stream(offset)
+                except requests.HTTPError as e:
+                    if e.response.status_code != 416:
+                        raise
+                    self._stream = e.response
+                    stream_done = True
+            if not offset or stream_done or self.stream.status_code == 206:
+                upload_id = checkpoint["upload_id"]
+                parts = {p["PartNumber"]: p for p in checkpoint["parts"]}
+                logger.info({
+                    "resuming_upload": {
+                        "s3_filename": self.s3_filename,
+                        "upload_id": upload_id,
+                        "parts": len(parts),
+                        "offset": offset
+                    }
+                })
+            else:
+                # we got the whole file back so start over with it
+                logger.warning("Zoom ignored range request, restarting "
+                               "upload of {}".format(self.s3_filename))
+                self.abort_upload(checkpoint["upload_id"])
+
+        if upload_id is None:
+            mpu = self.s3.create_multipart_upload(
+                        Bucket=ZOOM_VIDEOS_BUCKET,
+                        Key=self.s3_filename,
+                        Metadata=metadata)
+            upload_id = mpu["UploadId"]
+            if self.checkpoints:
+                self.save_checkpoint(upload_id, [])
+
+        # at most PART_WINDOW_SIZE of this file's parts are uploading at
+        # once; the reader blocks on a free slot before reading further
+        window = threading.BoundedSemaphore(PART_WINDOW_SIZE)
+        buffers = BufferPool()
+        retry_budget = RetryBudget(PART_RETRY_BUDGET)
+        first_part = len(parts) + 1
+        # mp4s are checked as they stream past, unless we're resuming
+        # and won't see the beginning of the file
+        if self.file_extension == "mp4" and first_part == 1:
+            inspector = MP4Inspector()
+        else:
+            inspector = None
+        part_sizes = self.part_sizes(first_part)
+        parts_lock = threading.Lock()
+        part_failed = threading.Event()
+        last_checkpoint = time.time()
+
+        def release(buffer):
+            buffers.put(buffer)
+            part_slots.release()
+            window.release()
+
+        def part_done(future, buffer, part_number, length):
+            release(buffer)
+            if future.exception() is not None:
+                part_failed.set()
+                return
+            with parts_lock:
+                parts[part_number] = {
+                    "PartNumber": part_number,
+                    "ETag": future.result()["ETag"],
+                    "Size": length
+                }
+
+        def committed_parts():
+            with parts_lock:
+                return contiguous_parts(parts)
 
         try:
-            chunks = enumerate(
-                        self.stream.iter_content(chunk_size=MIN_CHUNK_SIZE), 1
-                     )
-            with concurrent.futures.ThreadPoolExecutor() as executor:
-                future_map = {}
-                for part_number, chunk in chunks:
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=PART_WINDOW_SIZE) as executor:
+                futures = []
+                for part_number in itertools.count(first_part):
+                    if cancelled.is_set():
+                        raise TransferCancelled(
+                            "Transfer of {} cancelled".format(self.s3_filename)
+                        )
+                    # stop reading, the failure gets raised below
+                    if part_failed.is_set() or stream_done:
+                        break
+
+                    window.acquire()
+                    part_slots.acquire()
+                    buffer = buffers.get(next(part_sizes))
+                    try:
+                        length = self.read_chunk(buffer)
+                    except Exception:
+                        release(buffer)
+                        raise
+
+                    if length == 0:
+                        release(buffer)
+                        break
+
+                    if inspector:
+                        inspector.feed(memoryview(buffer)[:length])
+
+                    if length == len(buffer):
+                        chunk = buffer
+                    else:
+                        chunk = bytes(memoryview(buffer)[:length])
+
                     f = executor.submit(
-                        self.upload_part, mpu["UploadId"], part_number, chunk
+                        self.upload_part, upload_id, part_number, chunk,
+                        retry_budget
                     )
-                    future_map[f] = part_number
-                
-                for future in concurrent.futures.as_completed(future_map):
-                    part_number = future_map[future]
-                    part = future.result()
-                    parts.append({
-                        "PartNumber": part_number,
-                        "ETag": part["ETag"]
-                    })
+                    f.add_done_callback(
+                        lambda future, buffer=buffer, part_number=part_number,
+                        length=length: part_done(
+                            future, buffer, part_number, length
+                        )
+                    )
+                    futures.append(f)
+
+                    if (self.checkpoints and
+                            time.time() - last_checkpoint > CHECKPOINT_INTERVAL):
+                        self.save_checkpoint(upload_id, committed_parts())
+                        last_checkpoint = time.time()
+
+                    # a short read means we've reached the end of the stream
+                    if length < len(buffer):
+                        break
+
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
 
             # complete_multipart_upload requires parts in order by part number
-            parts = sorted(parts, key=lambda i: i["PartNumber"])
+            completed = [
+                {"PartNumber": p["PartNumber"], "ETag": p["ETag"]}
+                for p in committed_parts()
+            ]
 
-            self.s3.complete_multipart_upload(
+            md5 = composite_md5(completed)
+            response = self.s3.complete_multipart_upload(
                 Bucket=ZOOM_VIDEOS_BUCKET,
                 Key=self.s3_filename,
-                UploadId=mpu["UploadId"],
-                MultipartUpload={"Parts": parts}
+                UploadId=upload_id,
+                MultipartUpload={"Parts": completed}
             )
+            self.delete_checkpoint()
             print("Completed multipart upload of {}.".format(self.s3_filename))
+            # ru_maxrss is the high water mark (in KB) for the whole process
+            logger.info({
+                "transfer_complete": {
+                    "s3_filename": self.s3_filename,
+                    "parts": len(completed),
+                    "part_size": buffers.size,
+                    "md5": md5,
+                    "peak_rss_mb": resource.getrusage(
+                        resource.RUSAGE_SELF).ru_maxrss // 1024
+                }
+            })
         except Exception as e:
             logger.exception(
                 "Something went wrong with upload of {}:{}"
                 .format(self.s3_filename, e)
             )
-            self.s3.abort_multipart_upload(
-                Bucket=ZOOM_VIDEOS_BUCKET,
-                Key=self.s3_filename,
-                UploadId=mpu["UploadId"]
-            )
+            if self.checkpoints and not isinstance(
+                    e, (PermanentDownloadError, TransferCancelled)):
+                # keep the multipart upload so a retry can pick up from here
+                self.save_checkpoint(upload_id, committed_parts())
+            else:
+                self.abort_upload(upload_id)
             raise
 
+        # the upload is complete by now so there's nothing to resume
+        if response["ETag"].strip('"') != md5:
+            self.stream.close()
+            raise ChecksumMismatch(
+                "{} has checksum {}, expected {}".format(
+                    self.s3_filename, response["ETag"], md5
+                )
+            )
+        self.file_data["md5"] = md5
+
         if self.file_extension == "mp4":
-            if not self.valid_mp4_file():
+            if not self.verify_mp4(inspector):
                 self.stream.close()
                 raise Exception("MP4 failed to transfer.")
+            self.save_verification()
 
         self.stream.close()
@@ -1,14 +1,20 @@
 import json
+import time
+import random
 import boto3
 import requests
 from requests.auth import HTTPDigestAuth
-from urllib.parse import urljoin
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib.parse import urljoin, urlparse
 from os import getenv as env
 import xml.etree.ElementTree as ET
 from xml.sax.saxutils import escape
 from datetime import datetime
 from hashlib import md5
 from uuid import UUID, uuid4
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, local
 from common import TIMESTAMP_FORMAT, setup_logging
 
 
@@ -28,21 +34,130 @@ OVERRIDE_PUBLISHER = env("OVERRIDE_PUBLISHER")
 OVERRIDE_CONTRIBUTOR = env("OVERRIDE_CONTRIBUTOR")
 OC_OP_COUNT_FUNCTION = env("OC_OP_COUNT_FUNCTION")
 OC_TRACK_UPLOAD_MAX = int(env("OC_TRACK_UPLOAD_MAX", 5))
+# when greater than 1, ingest up to this many queued recordings at once,
+# bounded by how far the current upload count is below OC_TRACK_UPLOAD_MAX
+UPLOAD_BATCH_SIZE = int(env("UPLOAD_BATCH_SIZE") or 1)
+# seconds an opencast upload count is reused before it's fetched again,
+# longer than the uploader's 2 minute schedule so that the next invocation
+# in a warm container can use it
+OC_OP_COUNT_TTL = int(env("OC_OP_COUNT_TTL") or 300)
+# seconds a series catalog is used before it's revalidated with opencast
+SERIES_CATALOG_TTL = int(env("SERIES_CATALOG_TTL") or 300)
+# when set, series catalogs are also cached under this prefix in the
+# recordings bucket so other uploader containers can use them
+SERIES_CATALOG_PREFIX = env("SERIES_CATALOG_PREFIX")
+# seconds to wait for opencast to accept a connection and to respond.
+# Ingest requests get longer to respond since opencast fetches the tracks.
+OC_CONNECT_TIMEOUT = float(env("OC_CONNECT_TIMEOUT") or 5)
+OC_READ_TIMEOUT = float(env("OC_READ_TIMEOUT") or 30)
+OC_INGEST_READ_TIMEOUT = float(env("OC_INGEST_READ_TIMEOUT") or 240)
+# attempts at an opencast GET that fails to connect, times out or gets a
+# 502, 503 or 504
+OC_GET_ATTEMPTS = int(env("OC_GET_ATTEMPTS") or 3)
+# "staged" ingests a recording in steps (create the mediapackage, add its
+# catalogs, add the tracks in parallel, then start the workflow), each of
+# which is retried on its own. Otherwise it's ingested in a single request.
+OC_INGEST_MODE = env("OC_INGEST_MODE") or "single"
+OC_INGEST_STEP_ATTEMPTS = int(env("OC_INGEST_STEP_ATTEMPTS") or 3)
+OC_INGEST_RETRY_DELAY = float(env("OC_INGEST_RETRY_DELAY") or 1)
+# Seconds of run time to hold back from an ingest for finishing up before
+# the function times out
+OC_INGEST_TIME_RESERVE = int(env("OC_INGEST_TIME_RESERVE") or 15)
+# workflows per page when listing a series' ingested mediapackages
+OC_WORKFLOW_PAGE_SIZE = int(env("OC_WORKFLOW_PAGE_SIZE") or 100)
+# most messages sqs will return per receive
+SQS_MAX_MESSAGES = 10
 
 s3 = boto3.resource("s3")
 aws_lambda = boto3.client("lambda")
 sqs = boto3.resource('sqs')
 
-session = requests.Session()
-session.auth = HTTPDigestAuth(OPENCAST_API_USER, OPENCAST_API_PASSWORD)
-session.headers.update({
-    "X-REQUESTED-AUTH": "Digest",
-    # TODO: it's possible this header is not necessary for the endpoints being
-    # used here. It seems like for Opencast endpoints where the header *is*
-    # necessary the correct value is actually
-    # "X-Opencast-Matterhorn-Authorization"
-    "X-Opencast-Matterhorn-Authentication": "true",
-})
+
+class SharedDigestState(local):
+    """
+    Per-thread digest auth state, except for the server's challenge and
+    nonce, which all threads share.
+    """
+
+    def __init__(self, shared):
+        self.shared = shared
+
+    def _shared_attr(name):
+        return property(
+            lambda self: self.shared[name],
+            lambda self, value: self.shared.__setitem__(name, value)
+        )
+
+    chal = _shared_attr("chal")
+    last_nonce = _shared_attr("last_nonce")
+    nonce_count = _shared_attr("nonce_count")
+    del _shared_attr
+
+
+class SharedNonceDigestAuth(HTTPDigestAuth):
+    """
+    `HTTPDigestAuth` keeps the nonce from the server's last challenge per
+    thread, so every new thread's first request is answered with a 401
+    and has to be sent again. This shares the nonce between threads so
+    that only the first request anywhere pays for the challenge.
+    """
+
+    def __init__(self, username, password):
+        super().__init__(username, password)
+        self._lock = Lock()
+        self._thread_local = SharedDigestState({
+            "chal": {},
+            "last_nonce": "",
+            "nonce_count": 0
+        })
+
+    def init_per_thread_state(self):
+        if not hasattr(self._thread_local, "init"):
+            self._thread_local.init = True
+            self._thread_local.pos = None
+            self._thread_local.num_401_calls = None
+
+    def build_digest_header(self, method, url):
+        # the nonce count is incremented for each request
+        with self._lock:
+            return super().build_digest_header(method, url)
+
+
+def opencast_session():
+    session = requests.Session()
+    session.auth = SharedNonceDigestAuth(
+        OPENCAST_API_USER, OPENCAST_API_PASSWORD
+    )
+    session.headers.update({
+        "X-REQUESTED-AUTH": "Digest",
+        # TODO: it's possible this header is not necessary for the endpoints being
+        # used here. It seems like for Opencast endpoints where the header *is*
+        # necessary the correct value is actually
+        # "X-Opencast-Matterhorn-Authorization"
+        "X-Opencast-Matterhorn-Authentication": "true",
+    })
+    # urllib3 only retries reads and error statuses for idempotent
+    # methods; an ingest POST is only retried when it couldn't connect
+    retries = Retry(
+        total=OC_GET_ATTEMPTS - 1,
+        backoff_factor=0.5,
+        status_forcelist=[502, 503, 504],
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=max(10, 2 * UPLOAD_BATCH_SIZE),
+        max_retries=retries
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# shared by every opencast request made in this lambda container so
+# connections and the digest auth nonce are kept between requests and
+# warm invocations
+session = opencast_session()
 
 UPLOAD_OP_TYPES = [
     'track',
@@ -50,13 +165,450 @@ UPLOAD_OP_TYPES = [
 ]
 
 
-def oc_api_request(method, endpoint, **kwargs):
+class UploadCount:
+    """
+    The number of track uploads running in opencast, fetched at most once
+    per `ttl` seconds and shared by every upload in the (warm) container.
+    Callers that arrive while a fetch is in progress wait for its result
+    rather than making their own. Tracks we ingest in the meantime are
+    added to the count so it doesn't go stale in our favor.
+    """
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._lock = Lock()
+        self.clear()
+
+    def clear(self):
+        self._count = None
+        self._fetched = 0
+
+    def get(self):
+        with self._lock:
+            if (self._count is None
+                    or time.monotonic() - self._fetched > self.ttl):
+                self._count = get_current_upload_count()
+                self._fetched = time.monotonic()
+            else:
+                logger.info(
+                    "Using cached upload count: {}".format(self._count)
+                )
+            return self._count
+
+    def add(self, tracks):
+        with self._lock:
+            if self._count is not None:
+                self._count += tracks
+
+
+UPLOAD_COUNT = UploadCount(OC_OP_COUNT_TTL)
+
+
+class SeriesCatalog:
+    """
+    An opencast series' catalog json along with the validators opencast
+    sent with it.
+    """
+
+    def __init__(self, text, etag=None, last_modified=None, fetched=None):
+        self.text = text
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = fetched or time.time()
+
+    @classmethod
+    def from_response(cls, resp):
+        return cls(
+            resp.text,
+            etag=resp.headers.get("ETag"),
+            last_modified=resp.headers.get("Last-Modified")
+        )
+
+    def to_json(self):
+        return json.dumps({
+            "text": self.text,
+            "etag": self.etag,
+            "last_modified": self.last_modified,
+            "fetched": self.fetched
+        })
+
+    def expired(self, ttl):
+        return time.time() - self.fetched > ttl
+
+    def revalidation_headers(self):
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    @property
+    def dublin_core(self):
+        """
+        The catalog as dublin core xml, for the staged ingest.
+        """
+        terms = json.loads(self.text)["http://purl.org/dc/terms/"]
+        return dublin_core_xml(
+            (term, value["value"])
+            for term, values in terms.items() for value in values
+        )
+
+    @property
+    def publisher(self):
+        if not hasattr(self, "_publisher"):
+            series_data = {
+                k: v[0]["value"] for k, v in
+                json.loads(self.text)["http://purl.org/dc/terms/"].items()
+            }
+            if OVERRIDE_PUBLISHER and OVERRIDE_PUBLISHER != "None":
+                self._publisher = OVERRIDE_PUBLISHER
+            elif "publisher" in series_data:
+                self._publisher = series_data["publisher"]
+            else:
+                self._publisher = DEFAULT_PUBLISHER
+        return self._publisher
+
+
+class SeriesCatalogCache:
+    """
+    Series catalogs by opencast series id. A catalog older than `ttl`
+    seconds is revalidated with a conditional request, so an unchanged
+    series costs opencast a 304 rather than the whole catalog. When
+    `prefix` is set catalogs are also kept in S3 for other containers.
+    """
+
+    def __init__(self, ttl, prefix=None):
+        self.ttl = ttl
+        self.prefix = prefix
+        self._catalogs = {}
+        self._locks = {}
+        self._lock = Lock()
+
+    def clear(self):
+        with self._lock:
+            self._catalogs.clear()
+            self._locks.clear()
+
+    def get(self, series_id):
+        with self._lock:
+            series_lock = self._locks.setdefault(series_id, Lock())
+
+        # one lookup per series at a time
+        with series_lock:
+            catalog = self._catalogs.get(series_id)
+            if catalog is None and self.prefix:
+                catalog = self._load(series_id)
+            if catalog is None or catalog.expired(self.ttl):
+                catalog = self._fetch(series_id, catalog)
+                if self.prefix:
+                    self._save(series_id, catalog)
+            self._catalogs[series_id] = catalog
+            return catalog
+
+    def _fetch(self, series_id, catalog=None):
+        logger.info("Getting series catalog for series: {}"
+                    .format(series_id))
+
+        endpoint = "/series/{}.json".format(series_id)
+        headers = catalog.revalidation_headers() if catalog else {}
+        resp = oc_api_request(
+            "GET", endpoint, endpoint_name="series", headers=headers
+        )
+
+        if resp.status_code == 304:
+            logger.info("Series catalog for {} unchanged".format(series_id))
+            catalog.fetched = time.time()
+            return catalog
+
+        logger.debug({"series_catalog": resp.text})
+        return SeriesCatalog.from_response(resp)
+
+    def _key(self, series_id):
+        return "{}{}.json".format(self.prefix, series_id)
+
+    def _load(self, series_id):
+        # called from upload threads; clients are thread safe, resources
+        # aren't
+        try:
+            obj = s3.meta.client.get_object(
+                Bucket=ZOOM_VIDEOS_BUCKET, Key=self._key(series_id)
+            )
+            return SeriesCatalog(**json.loads(obj["Body"].read()))
+        except s3.meta.client.exceptions.NoSuchKey:
+            return None
+        except Exception as e:
+            # the shared copy is only ever a shortcut
+            logger.warning(
+                "Unable to load cached series catalog: {}".format(e)
+            )
+            return None
+
+    def _save(self, series_id, catalog):
+        try:
+            s3.meta.client.put_object(
+                Bucket=ZOOM_VIDEOS_BUCKET,
+                Key=self._key(series_id),
+                Body=catalog.to_json(),
+                ContentType="application/json"
+            )
+        except Exception as e:
+            logger.warning(
+                "Unable to save cached series catalog: {}".format(e)
+            )
+
+
+SERIES_CATALOGS = SeriesCatalogCache(
+    SERIES_CATALOG_TTL, SERIES_CATALOG_PREFIX
+)
+
+
+DUBLIN_CORE_NS = "http://www.opencastproject.org/xsd/1.0/dublincore/"
+DC_TERMS_NS = "http://purl.org/dc/terms/"
+MEDIAPACKAGE_NS = "http://mediapackage.opencastproject.org"
+ET.register_namespace("", MEDIAPACKAGE_NS)
+
+
+def dublin_core_xml(terms):
+    catalog = ET.Element("dublincore", {
+        "xmlns": DUBLIN_CORE_NS,
+        "xmlns:dcterms": DC_TERMS_NS
+    })
+    for term, value in terms:
+        ET.SubElement(catalog, "dcterms:" + term).text = str(value)
+    return ET.tostring(catalog, encoding="unicode")
+
+
+def merge_tracks(mediapackage_xml, track_mediapackages):
+    """
+    Add the tracks from mediapackages that were each given one track (by
+    parallel addTrack requests) to `mediapackage_xml`, in order.
+    """
+    mediapackage = ET.fromstring(mediapackage_xml)
+    media = mediapackage.find("{%s}media" % MEDIAPACKAGE_NS)
+    if media is None:
+        media = ET.SubElement(mediapackage, "{%s}media" % MEDIAPACKAGE_NS)
+    track_ids = {t.get("id") for t in media}
+
+    for track_mediapackage in track_mediapackages:
+        for track in ET.fromstring(track_mediapackage).iterfind(
+                "{%s}media/{%s}track" % (MEDIAPACKAGE_NS, MEDIAPACKAGE_NS)):
+            if track.get("id") not in track_ids:
+                media.append(track)
+                track_ids.add(track.get("id"))
+
+    return ET.tostring(mediapackage, encoding="unicode")
+
+
+def retryable_ingest_error(e, idempotent=True):
+    """
+    Whether a failed ingest step can be tried again. A step that isn't
+    `idempotent` may have taken effect if opencast got the request, even
+    if a gateway answered with an error, so it's only retried if the
+    connection failed.
+    """
+    if isinstance(e, requests.HTTPError):
+        if e.response is None or not idempotent:
+            return False
+        return e.response.status_code >= 500
+    if idempotent:
+        return isinstance(e, requests.RequestException)
+    return isinstance(e, requests.ConnectionError)
+
+
+def ingest_timeout(endpoint_name, deadline=None):
+    """
+    The connect and read timeouts for an ingest request, with the read
+    timeout cut down to the time left before `deadline`, a time.monotonic()
+    value.
+    """
+    if deadline is None:
+        return (OC_CONNECT_TIMEOUT, OC_INGEST_READ_TIMEOUT)
+    time_left = deadline - time.monotonic()
+    if time_left <= 0:
+        raise TimeoutError("No time left for {}".format(endpoint_name))
+    return (OC_CONNECT_TIMEOUT, min(OC_INGEST_READ_TIMEOUT, time_left))
+
+
+def ingest_step(method, endpoint_name, endpoint, idempotent=True,
+                deadline=None, **kwargs):
+    """
+    Request one step of a staged ingest, retrying connection errors,
+    timeouts and server errors with backoff. Returns the response text.
+    No attempt waits past the `deadline` and there's no retry after it.
+    """
+    for attempt in range(1, OC_INGEST_STEP_ATTEMPTS + 1):
+        timeout = ingest_timeout(endpoint_name, deadline)
+        try:
+            resp = oc_api_request(
+                method, endpoint, endpoint_name=endpoint_name,
+                timeout=timeout, **kwargs
+            )
+            logger.debug({endpoint_name: resp.text})
+            return resp.text
+        except Exception as e:
+            delay = random.uniform(0, OC_INGEST_RETRY_DELAY * 2 ** attempt)
+            if (attempt == OC_INGEST_STEP_ATTEMPTS
+                    or not retryable_ingest_error(e, idempotent)
+                    or deadline is not None
+                    and time.monotonic() + delay >= deadline):
+                raise
+            logger.warning({
+                "ingest_step_retry": {
+                    "step": endpoint_name,
+                    "attempt": attempt,
+                    "error": str(e),
+                    "delay": round(delay, 2)
+                }
+            })
+            time.sleep(delay)
+
+
+def deterministic_mediapackage_id(meeting_uuid):
+    return str(UUID(md5(meeting_uuid.encode()).hexdigest()))
+
+
+class IngestedIndex:
+    """
+    The mediapackage ids opencast has workflows for, listed a whole series
+    at a time so a batch of uploads can be checked for duplicates with one
+    request per series instead of one per mediapackage.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._mpids = {}
+
+    def load(self, series_ids):
+        series_ids = set(series_ids) - set(self._mpids)
+        if not series_ids:
+            return
+        with ThreadPoolExecutor(max_workers=len(series_ids)) as executor:
+            list(executor.map(self._load_series, series_ids))
+
+    def _load_series(self, series_id):
+        try:
+            mpids = series_mediapackage_ids(series_id)
+        except Exception as e:
+            # the uploads fall back to checking one at a time
+            logger.warning(
+                "Unable to list workflows for series {}: {}"
+                .format(series_id, e)
+            )
+            return
+        with self._lock:
+            self._mpids[series_id] = mpids
+
+    def ingested(self, series_id, mpid):
+        """
+        Whether `mpid` has been ingested into `series_id`, or None if the
+        series hasn't been loaded.
+        """
+        with self._lock:
+            if series_id not in self._mpids:
+                return None
+            return mpid in self._mpids[series_id]
+
+    def add(self, series_id, mpid):
+        with self._lock:
+            if series_id in self._mpids:
+                self._mpids[series_id].add(mpid)
+
+
+INGESTED = IngestedIndex()
+
+
+def series_mediapackage_ids(series_id):
+    """
+    The ids of every mediapackage with a workflow in the series.
+    """
+    mpids, page = set(), 0
+    while True:
+        endpoint = (
+            "/workflow/instances.json?seriesId={}&count={}&startPage={}"
+            .format(series_id, OC_WORKFLOW_PAGE_SIZE, page)
+        )
+        resp = oc_api_request(
+            "GET", endpoint, endpoint_name="workflow/instances"
+        )
+        workflows = resp.json()["workflows"]
+        instances = workflows.get("workflow", [])
+        # a single workflow isn't wrapped in a list
+        if isinstance(instances, dict):
+            instances = [instances]
+        mpids.update(wf["mediapackage"]["id"] for wf in instances)
+
+        page += 1
+        if (not instances
+                or page * OC_WORKFLOW_PAGE_SIZE >= int(workflows["totalCount"])):
+            return mpids
+
+
+def reject_duplicates(messages):
+    """
+    Delete the messages for recordings that have already been ingested
+    and don't allow multiple ingests. Returns the rest.
+    """
+    uploads = []
+    for message in messages:
+        try:
+            uploads.append((message, json.loads(message.body)))
+        except ValueError:
+            # left to fail in upload_message
+            uploads.append((message, None))
+
+    INGESTED.load(
+        data["opencast_series_id"] for _, data in uploads
+        if data and data.get("opencast_series_id")
+    )
+
+    remaining = []
+    for message, data in uploads:
+        if (data and "uuid" in data
+                and not data.get("allow_multiple_ingests")
+                and INGESTED.ingested(
+                    data.get("opencast_series_id"),
+                    deterministic_mediapackage_id(data["uuid"])
+                )):
+            logger.warning(
+                "Recording {} already ingested".format(data["uuid"])
+            )
+            message.delete()
+        else:
+            remaining.append(message)
+    return remaining
+
+
+def oc_api_request(method, endpoint, endpoint_name=None, **kwargs):
+    """
+    Make an opencast api request and log how long it took. Latencies are
+    logged under `endpoint_name`, which defaults to the endpoint's path
+    and shouldn't include ids.
+    """
     url = urljoin(OPENCAST_BASE_URL, endpoint)
     logger.info({"url": url, "kwargs": kwargs})
+    kwargs.setdefault("timeout", (OC_CONNECT_TIMEOUT, OC_READ_TIMEOUT))
+
+    status, start = None, time.monotonic()
     try:
         resp = session.request(method, url, **kwargs)
-    except requests.RequestException:
+        status = resp.status_code
+    except requests.RequestException as e:
+        status = type(e).__name__
         raise
+    finally:
+        logger.info({
+            "opencast_request": {
+                "method": method,
+                "endpoint": endpoint_name or urlparse(endpoint).path,
+                "status": status,
+                "seconds": round(time.monotonic() - start, 3)
+            }
+        })
     resp.raise_for_status()
     return resp
 
@@ -66,6 +618,14 @@ def handler(event, context):
 
     upload_queue = sqs.get_queue_by_name(QueueName=UPLOAD_QUEUE_NAME)
 
+    # the ingest has to be done before the function times out
+    deadline = (time.monotonic()
+                + context.get_remaining_time_in_millis() / 1000
+                - OC_INGEST_TIME_RESERVE)
+
+    if UPLOAD_BATCH_SIZE > 1:
+        return batch_upload(upload_queue, deadline)
+
     messages = upload_queue.receive_messages(
         MaxNumberOfMessages=1,
         VisibilityTimeout=300
@@ -77,7 +637,7 @@ def handler(event, context):
         logger.info("{} upload messages in queue".format(len(messages)))
 
     # don't ingest of opencast is overloaded
-    current_uploads = get_current_upload_count()
+    current_uploads = UPLOAD_COUNT.get()
     if current_uploads is None:
         logger.error("Unable to determine number of existing upload ops")
         return
@@ -102,7 +662,7 @@ def handler(event, context):
         upload_data = json.loads(upload_message.body)
         logger.debug({"processing": upload_data})
 
-        wf_id = process_upload(upload_data)
+        wf_id = process_upload(upload_data, deadline)
         upload_message.delete()
         if wf_id:
             logger.info(f"Workflow id {wf_id} initiated.")
@@ -115,6 +675,90 @@ def handler(event, context):
         raise
 
 
+def batch_upload(upload_queue, deadline=None):
+    """
+    Ingest as many queued recordings at once as opencast has room for.
+    """
+    current_uploads = UPLOAD_COUNT.get()
+    if current_uploads is None:
+        logger.error("Unable to determine number of existing upload ops")
+        return
+
+    headroom = min(
+        OC_TRACK_UPLOAD_MAX - current_uploads,
+        UPLOAD_BATCH_SIZE,
+        SQS_MAX_MESSAGES
+    )
+    if headroom <= 0:
+        logger.warning(
+            "Too many current track uploads: {}".format(current_uploads)
+        )
+        return
+
+    messages = upload_queue.receive_messages(
+        MaxNumberOfMessages=headroom,
+        VisibilityTimeout=300
+    )
+    if len(messages) == 0:
+        logger.warning("No upload queue messages available.")
+        return
+
+    # check the batch for duplicates a series at a time
+    INGESTED.clear()
+    uploads = reject_duplicates(messages)
+
+    logger.info({
+        "batch_upload": {
+            "current_uploads": current_uploads,
+            "headroom": headroom,
+            "messages": len(messages),
+            "duplicates": len(messages) - len(uploads)
+        }
+    })
+    if not uploads:
+        return
+
+    with ThreadPoolExecutor(max_workers=len(uploads)) as executor:
+        results = list(executor.map(
+            lambda message: upload_message(message, deadline), uploads
+        ))
+
+    # a failed upload's message is left for retry once its visibility
+    # timeout expires
+    errors = [e for e in results if isinstance(e, Exception)]
+    logger.info({
+        "batch_complete": {
+            "ingested": len(results) - len(errors) - results.count(None),
+            "skipped": results.count(None),
+            "failed": len(errors)
+        }
+    })
+    if errors:
+        raise errors[0]
+
+
+def upload_message(message, deadline=None):
+    """
+    Ingest the recording in an upload queue message, deleting the message
+    once it's done with. Returns the workflow id, or the exception if the
+    upload failed.
+    """
+    try:
+        upload_data = json.loads(message.body)
+        logger.debug({"processing": upload_data})
+
+        wf_id = process_upload(upload_data, deadline)
+        message.delete()
+        if wf_id:
+            logger.info(f"Workflow id {wf_id} initiated.")
+        else:
+            logger.info("No workflow initiated.")
+        return wf_id
+    except Exception as e:
+        logger.exception(e)
+        return e
+
+
 def minutes_in_pipeline(webhook_received_time):
     start_time = datetime.strptime(webhook_received_time, TIMESTAMP_FORMAT)
     ingest_time = datetime.utcnow()
@@ -136,16 +780,18 @@ def get_current_upload_count():
         return None
 
 
-def process_upload(upload_data):
-    upload = Upload(upload_data)
+def process_upload(upload_data, deadline=None):
+    upload = Upload(upload_data, deadline)
     wf_id = upload.upload()
     return wf_id
 
 
 class Upload:
 
-    def __init__(self, data):
+    def __init__(self, data, deadline=None):
         self.data = data
+        # time.monotonic() by which the ingest has to be done
+        self.deadline = deadline
 
     @property
     def creator(self):
@@ -165,8 +811,15 @@ class Upload:
 
             # first uuid generated should be deterministic
             # regardless of the allow_multiple_ingests flag
-            mpid = str(UUID(md5(self.meeting_uuid.encode()).hexdigest()))
-            if self.already_ingested(mpid):
+            mpid = deterministic_mediapackage_id(self.meeting_uuid)
+            # the index only lists this series, so an mpid that isn't
+            # there may still have been ingested into another one
+            ingested = INGESTED.ingested(
+                self.data.get("opencast_series_id"), mpid
+            )
+            if not ingested:
+                ingested = self.already_ingested(mpid)
+            if ingested:
                 if self.data["allow_multiple_ingests"]:
                     # random uuid
                     mpid = str(uuid4())
@@ -210,15 +863,7 @@ class Upload:
 
     @property
     def publisher(self):
-        series_data = {k: v[0]["value"] for k, v in
-                       json.loads(self.series_catalog)["http://purl.org/dc/terms/"].items()}
-
-        if OVERRIDE_PUBLISHER and OVERRIDE_PUBLISHER != "None":
-            return OVERRIDE_PUBLISHER
-        elif "publisher" in series_data:
-            return series_data["publisher"]
-        elif DEFAULT_PUBLISHER:
-            return DEFAULT_PUBLISHER
+        return self._series_catalog.publisher
 
     @property
     def workflow_definition_id(self):
@@ -246,10 +891,18 @@ class Upload:
     def upload(self):
         if not self.opencast_series_id:
             raise Exception("No opencast series id found!")
-        if not self.mediapackage_id:
+
+        # neither lookup depends on the other
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            series_catalog = executor.submit(self.get_series_catalog)
+            mediapackage_id = self.mediapackage_id
+            series_catalog.result()
+
+        if not mediapackage_id:
             return None
-        self.get_series_catalog()
         self.ingest()
+        UPLOAD_COUNT.add(self.track_count)
+        INGESTED.add(self.opencast_series_id, mediapackage_id)
 
         wf_id = self.workflow_id
         logger.info({
@@ -264,7 +917,9 @@ class Upload:
     def already_ingested(self, mpid):
         endpoint = "/workflow/instances.json?mp={}".format(mpid)
         try:
-            resp = oc_api_request("GET", endpoint)
+            resp = oc_api_request(
+                "GET", endpoint, endpoint_name="workflow/instances"
+            )
             logger.debug("Lookup for mpid: {}, {}"
                          .format(mpid, resp.json()))
             return int(resp.json()["workflows"]["totalCount"]) > 0
@@ -273,50 +928,119 @@ class Upload:
                 return False
 
     def get_series_catalog(self):
+        self._series_catalog = SERIES_CATALOGS.get(self.opencast_series_id)
+        self.series_catalog = self._series_catalog.text
 
-        logger.info("Getting series catalog for series: {}"
-                    .format(self.opencast_series_id))
-
-        endpoint = "/series/{}.json".format(self.opencast_series_id)
-        resp = oc_api_request("GET", endpoint)
-
-        logger.debug({"series_catalog": resp.text})
+    @property
+    def episode_metadata(self):
+        return [
+            ("creator", self.creator),
+            ("identifier", self.mediapackage_id),
+            ("title", "Lecture"),
+            ("type", self.type_num),
+            ("isPartOf", self.opencast_series_id),
+            ("license", "Creative Commons 3.0: Attribution-NonCommercial-NoDerivs"),
+            ("publisher", self.publisher),
+            ("created", self.created),
+            ("language", "en"),
+            ("source", "Zoom Ingester Pipeline"),
+            ("spatial", "Zoom {}".format(self.zoom_series_id))
+        ]
 
-        self.series_catalog = resp.text
+    def file_params(self):
+        fpg = FileParamGenerator(self.s3_filenames)
+        try:
+            return fpg.generate()
+        except Exception as e:
+            logger.exception("Failed to generate file upload params")
+            raise
 
     def ingest(self):
+        if OC_INGEST_MODE == "staged":
+            return self.staged_ingest()
+
         logger.info("Adding mediapackage and ingesting.")
 
         endpoint = ("/ingest/addMediaPackage/{}"
                     .format(self.workflow_definition_id))
 
         params = [
-            ("creator", (None, escape(self.creator))),
-            ("identifier", (None, self.mediapackage_id)),
-            ("title", (None, "Lecture")),
-            ("type", (None, self.type_num)),
-            ("isPartOf", (None, self.opencast_series_id)),
-            ("license", (None, "Creative Commons 3.0: Attribution-NonCommercial-NoDerivs")),
-            ("publisher", (None, escape(self.publisher))),
-            ("created", (None, self.created)),
-            ("language", (None, "en")),
-            ("seriesDCCatalog", (None, self.series_catalog)),
-            ("source", (None, "Zoom Ingester Pipeline")),
-            ("spatial", (None, "Zoom {}".format(self.zoom_series_id)))
+            (k, (None, escape(v) if k in ["creator", "publisher"] else v))
+            for k, v in self.episode_metadata
         ]
+        params.append(("seriesDCCatalog", (None, self.series_catalog)))
 
-        fpg = FileParamGenerator(self.s3_filenames)
-        try:
-            file_params = fpg.generate()
-        except Exception as e:
-            logger.exception("Failed to generate file upload params")
-            raise
-
+        file_params = self.file_params()
         params.extend(file_params)
-        resp = oc_api_request("POST", endpoint, files=params)
+        self.track_count = sum(1 for k, _ in file_params if k == "mediaUri")
+        resp = oc_api_request(
+            "POST", endpoint,
+            endpoint_name="ingest/addMediaPackage",
+            files=params,
+            timeout=ingest_timeout("ingest/addMediaPackage", self.deadline)
+        )
         logger.debug({"addMediaPackage": resp.text})
         self.workflow_xml = resp.text
 
+    def staged_ingest(self):
+        """
+        Ingest the mediapackage a step at a time so that a step that fails
+        can be retried without starting over. The tracks are added in
+        parallel so opencast fetches them all at once.
+        """
+        logger.info("Creating mediapackage and ingesting in steps.")
+
+        file_params = self.file_params()
+        tracks = [
+            (flavor[1][1], uri[1][1])
+            for flavor, uri in zip(file_params[0::2], file_params[1::2])
+        ]
+
+        mediapackage = ingest_step(
+            "PUT", "ingest/createMediaPackageWithID",
+            "/ingest/createMediaPackageWithID/{}".format(self.mediapackage_id),
+            deadline=self.deadline
+        )
+        for flavor, catalog in [
+                ("dublincore/episode", dublin_core_xml(self.episode_metadata)),
+                ("dublincore/series", self._series_catalog.dublin_core)]:
+            mediapackage = ingest_step(
+                "POST", "ingest/addDCCatalog", "/ingest/addDCCatalog",
+                deadline=self.deadline,
+                data={
+                    "mediaPackage": mediapackage,
+                    "dublinCore": catalog,
+                    "flavor": flavor
+                }
+            )
+
+        def add_track(track):
+            flavor, uri = track
+            # opencast may already be fetching a track whose response
+            # timed out
+            return ingest_step(
+                "POST", "ingest/addTrack", "/ingest/addTrack",
+                idempotent=False, deadline=self.deadline,
+                data={
+                    "mediaPackage": mediapackage,
+                    "flavor": flavor,
+                    "url": uri
+                }
+            )
+
+        with ThreadPoolExecutor(max_workers=len(tracks)) as executor:
+            track_mediapackages = list(executor.map(add_track, tracks))
+        mediapackage = merge_tracks(mediapackage, track_mediapackages)
+        self.track_count = len(tracks)
+
+        # retrying after opencast started the workflow would start another
+        self.workflow_xml = ingest_step(
+            "POST", "ingest/ingest",
+            "/ingest/ingest/{}".format(self.workflow_definition_id),
+            idempotent=False, deadline=self.deadline,
+            data={"mediaPackage": mediapackage}
+        )
+
 
 class FileParamGenerator(object):
 
@@ -182,14 +182,18 @@ def construct_sqs_message(payload, context, zoom_event):
     recording_files = []
     for file in payload["object"]["recording_files"]:
         if file["file_type"].lower() == "mp4":
-            recording_files.append({
+            recording_file = {
                 "recording_id": file["id"],
                 "recording_start": file["recording_start"],
                 "recording_end": file["recording_end"],
                 "download_url": file["download_url"],
                 "file_type": file["file_type"],
                 "recording_type": file["recording_type"]
-            })
+            }
+            # lets the downloader tell whether a file is already in S3
+            if "file_size" in file:
+                recording_file["file_size"] = file["file_size"]
+            recording_files.append(recording_file)
 
     sqs_message = {
         "uuid": payload["object"]["uuid"],
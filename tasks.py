@@ -16,7 +16,7 @@ from dotenv import load_dotenv
 from os.path import join, dirname, exists, relpath
 from tabulate import tabulate
 from pprint import pprint
-from functions.common import zoom_api_request
+from functions.common import zoom_api_request, zoom_users, HostNameCache
 from multiprocessing import Process
 from urllib.parse import urlparse, quote
 from cdk import names
@@ -474,6 +474,24 @@ def retry_uploads(ctx, limit=1, uuid=None):
     __move_messages(uploads_dql, uploads_queue, limit=limit, uuid=uuid)
 
 
+@task(pre=[production_failsafe])
+def retry_unmatched(ctx, limit=1, uuid=None):
+    """
+    Move unmatched recordings back to the download queue, e.g. after a schedule update. Optional: --limit (default 1).
+    """
+    unmatched_queue = queue_url(names.UNMATCHED_QUEUE)
+    downloads_queue = queue_url(names.DOWNLOAD_QUEUE)
+    __move_messages(unmatched_queue, downloads_queue, limit=limit, uuid=uuid)
+
+
+@task(pre=[production_failsafe])
+def view_unmatched(ctx, limit=20):
+    """
+    View recordings that didn't match an opencast series. Optional: --limit (default 20).
+    """
+    __view_messages(queue_url(names.UNMATCHED_QUEUE), limit=limit)
+
+
 @task(pre=[production_failsafe])
 def view_downloads(ctx, limit=20):
     """
@@ -659,6 +677,18 @@ def import_schedule_from_csv(ctx, filepath):
                 split_by = ","
             days = [day.strip() for day in days_value.split(split_by)]
 
+        schedule_data[zoom_series_id].setdefault("Time", set())
+        time_object = datetime.strptime(row["start"], "%H:%M")
+        times = [
+            datetime.strftime(time_object, "%H:%M"),
+            (time_object + timedelta(minutes=30)).strftime("%H:%M"),
+            (time_object + timedelta(hours=1)).strftime("%H:%M")
+        ]
+        schedule_data[zoom_series_id]["Time"].update(times)
+
+        # the times for each day the row is for, so sections meeting at
+        # different times on different days don't match each other's times
+        day_times = schedule_data[zoom_series_id].setdefault("day_times", {})
         for day in days:
             if day not in valid_days:
                 print(
@@ -666,22 +696,35 @@ def import_schedule_from_csv(ctx, filepath):
                 )
                 continue
             schedule_data[zoom_series_id]["Days"].add(day)
+            day_times.setdefault(day, set()).update(times)
 
-        schedule_data[zoom_series_id].setdefault("Time", set())
-        time_object = datetime.strptime(row["start"], "%H:%M")
-        schedule_data[zoom_series_id]["Time"].update([
-            datetime.strftime(time_object, "%H:%M"),
-            (time_object + timedelta(minutes=30)).strftime("%H:%M"),
-            (time_object + timedelta(hours=1)).strftime("%H:%M")
-        ])
+        # optional term dates
+        for col in ["start date", "end date"]:
+            if row.get(col):
+                date_value = datetime.strptime(row[col].strip(), "%Y-%m-%d")
+                schedule_data[zoom_series_id][col.replace(" ", "_")] = \
+                    date_value.strftime("%Y-%m-%d")
 
     for id, item in schedule_data.items():
         item["Days"] = list(item["Days"])
         item["Time"] = list(item["Time"])
+        item["day_times"] = {
+            day: sorted(times) for day, times in item["day_times"].items()
+        }
 
     __schedule_json_to_dynamo(ctx, schedule_data=schedule_data)
 
 
+@task(pre=[production_failsafe])
+def prewarm_host_names(ctx):
+    """
+    Load the names of all active zoom users into the downloader's host name cache.
+    """
+    table_name = f"{STACK_NAME}-{names.HOST_NAMES_TABLE}"
+    count = HostNameCache(table_name).prewarm(zoom_users())
+    print("Cached {} host names in {}".format(count, table_name))
+
+
 @task
 def logs(ctx, function=None, watch=False):
 
@@ -780,6 +823,8 @@ queue_ns.add_task(view_downloads, 'downloads')
 queue_ns.add_task(view_uploads, 'uploads')
 queue_ns.add_task(retry_downloads, 'retry-downloads')
 queue_ns.add_task(retry_uploads, 'retry-uploads')
+queue_ns.add_task(view_unmatched, 'unmatched')
+queue_ns.add_task(retry_unmatched, 'retry-unmatched')
 ns.add_collection(queue_ns)
 
 schedule_ns = Collection('schedule')
@@ -787,6 +832,10 @@ schedule_ns.add_task(import_schedule_from_opencast, 'oc-import')
 schedule_ns.add_task(import_schedule_from_csv, 'csv-import')
 ns.add_collection(schedule_ns)
 
+host_names_ns = Collection('host-names')
+host_names_ns.add_task(prewarm_host_names, 'prewarm')
+ns.add_collection(host_names_ns)
+
 logs_ns = Collection('logs')
 logs_ns.add_task(logs, 'all')
 logs_ns.add_task(logs_on_demand, 'on-demand')
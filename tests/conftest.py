@@ -18,7 +18,10 @@ def handler(mocker, aws_request_id):
     """
     def _handler(func_module, event, context=None):
         if context is None:
-            context = mocker.Mock(aws_request_id=aws_request_id)
+            context = mocker.Mock(
+                aws_request_id=aws_request_id,
+                get_remaining_time_in_millis=mocker.Mock(return_value=300000)
+            )
         else:
             context.aws_request_id = aws_request_id
         return getattr(func_module, 'handler')(event, context)
@@ -7,9 +7,16 @@ import jwt
 import time
 import requests
 import requests_mock
+import common
 from common import gen_token, zoom_api_request, ZoomApiRequestError
 
 
+@pytest.fixture(autouse=True)
+def clear_token_cache():
+    common._token_cache.clear()
+    common.ZOOM_RATE_LIMITER.paused_until = 0
+
+
 @pytest.mark.parametrize("key,secret,seconds_valid", [
     ('foo', 'bar', 10),
     ('abcd-1234', 'my-secret-key', 60),
@@ -85,3 +92,188 @@ def test_zoom_api_request_failures():
         error_msg = "Error requesting https://api.zoom.us/v2/meetings"
         with pytest.raises(ZoomApiRequestError, match=error_msg):
             zoom_api_request("meetings")
+
+
+def test_cached_token(mocker):
+    create = mocker.Mock(side_effect=["token1", "token2"])
+    mocker.patch.object(common.time, "time", return_value=1000)
+    assert common.cached_token("key", 60, 10, create) == "token1"
+    assert common.cached_token("key", 60, 10, create) == "token1"
+    assert create.call_count == 1
+
+    # refreshed shortly before it expires
+    common.time.time.return_value = 1051
+    assert common.cached_token("key", 60, 10, create) == "token2"
+    assert create.call_count == 2
+
+
+def test_zoom_api_request_reuses_jwt():
+    with requests_mock.mock() as req_mock:
+        req_mock.get(requests_mock.ANY, status_code=200, json={})
+        zoom_api_request("meetings")
+        zoom_api_request("users")
+        auth = [r.headers["Authorization"] for r in req_mock.request_history]
+        assert auth[0] == auth[1]
+
+
+def test_zoom_api_request_rejected_jwt():
+    with requests_mock.mock() as req_mock:
+        req_mock.get(requests_mock.ANY, [
+            {"status_code": 401}, {"status_code": 200, "json": {}}
+        ])
+        common._token_cache[("jwt", common.ZOOM_API_KEY,
+                             common.ZOOM_API_SECRET, 60)] = \
+            ("stale", time.time() + 60)
+        r = zoom_api_request("meetings")
+        assert r.status_code == 200
+        auth = [r.headers["Authorization"] for r in req_mock.request_history]
+        assert auth[0] == "Bearer stale"
+        assert auth[1] != "Bearer stale"
+
+
+def test_zoom_zak_token(mocker):
+    mocker.patch.object(common, "zoom_api_request", return_value=mocker.Mock(
+        json=mocker.Mock(return_value={"token": "zak"})
+    ))
+    assert common.zoom_zak_token("admin") == "zak"
+    assert common.zoom_zak_token("admin") == "zak"
+    assert common.zoom_api_request.call_count == 1
+    assert common.zoom_api_request.call_args[0][0] \
+        == "users/admin/token?type=zak"
+
+
+def test_zoom_api_request_rate_limited(mocker):
+    with requests_mock.mock() as req_mock:
+        req_mock.get(requests_mock.ANY, [
+            {"status_code": 429, "headers": {"Retry-After": "0"}},
+            {"status_code": 200, "json": {"mock_payload": 123}}
+        ])
+        r = zoom_api_request("meetings")
+        assert r.status_code == 200
+        assert req_mock.call_count == 2
+
+    # daily limit resets too far in the future to wait for
+    mocker.patch.object(common.ZOOM_RATE_LIMITER, "pause")
+    with requests_mock.mock() as req_mock:
+        req_mock.get(requests_mock.ANY, status_code=429, headers={
+            "Retry-After": "2099-01-01T00:00:00Z",
+            "X-RateLimit-Type": "Daily-limit",
+            "X-RateLimit-Remaining": "0"
+        })
+        with pytest.raises(requests.exceptions.HTTPError, match="429"):
+            zoom_api_request("meetings")
+        assert req_mock.call_count == 1
+        # held off as long as we're willing to
+        common.ZOOM_RATE_LIMITER.pause.assert_called_once_with(
+            common.ZOOM_API_MAX_RETRY_WAIT
+        )
+
+
+@pytest.mark.parametrize("header,expected", [
+    (None, None),
+    ("5", 5),
+    ("2000-01-01T00:00:00Z", 0),
+    ("Sat, 01 Jan 2000 00:00:00 GMT", 0),
+    ("soon", None)
+])
+def test_retry_after(mocker, header, expected):
+    headers = {"Retry-After": header} if header else {}
+    assert common.retry_after(mocker.Mock(headers=headers)) == expected
+
+
+def test_token_bucket(mocker):
+    sleep = mocker.patch.object(common.time, "sleep")
+    mocker.patch.object(common.time, "monotonic", return_value=100)
+    bucket = common.TokenBucket(rate=10, capacity=2)
+    bucket.tokens = 0
+    # nothing left so it has to wait for a token to refill
+    sleep.side_effect = lambda seconds: setattr(bucket, "tokens", 1)
+    bucket.take()
+    assert sleep.call_count == 1
+    assert sleep.call_args[0][0] == pytest.approx(0.1)
+
+    sleep.reset_mock()
+    bucket.tokens = 2
+    bucket.pause(30)
+    sleep.side_effect = lambda seconds: setattr(bucket, "paused_until", 0)
+    bucket.take()
+    assert sleep.call_args[0][0] == 30
+
+
+def test_host_name_cache(mocker):
+    zoom = mocker.patch.object(common, "zoom_api_request")
+    zoom.return_value.status_code = 200
+    zoom.return_value.json.return_value = {
+        "first_name": "Jane", "last_name": "Doe"
+    }
+    cache = common.HostNameCache(size=2)
+    assert cache.get("host1") == "Jane Doe"
+    assert cache.get("host1") == "Jane Doe"
+    assert zoom.call_count == 1
+    assert zoom.call_args[0][0] == "users/host1"
+
+    # least recently used host falls out
+    cache.get("host2")
+    cache.get("host3")
+    assert list(cache._names) == ["host2", "host3"]
+
+    # expired
+    cache._names["host3"] = ("Jane Doe", time.time() - 1)
+    cache.get("host3")
+    assert zoom.call_count == 4
+
+
+def test_host_name_cache_not_found(mocker):
+    zoom = mocker.patch.object(common, "zoom_api_request")
+    zoom.return_value.status_code = 404
+    cache = common.HostNameCache()
+    cache.table = mocker.Mock()
+    cache.table.get_item.return_value = {}
+    assert cache.get("host1") is None
+    assert cache.get("host1") is None
+    assert zoom.call_count == 1
+    item = cache.table.put_item.call_args[1]["Item"]
+    assert "host_name" not in item
+    assert item["expires"] - time.time() <= common.HOST_NAME_NEGATIVE_TTL
+
+
+def test_host_name_cache_table(mocker):
+    zoom = mocker.patch.object(common, "zoom_api_request")
+    cache = common.HostNameCache()
+    cache.table = mocker.Mock()
+    cache.table.get_item.return_value = {"Item": {
+        "host_id": "host1", "host_name": "Jane Doe",
+        "expires": int(time.time()) + 100
+    }}
+    assert cache.get("host1") == "Jane Doe"
+    assert zoom.call_count == 0
+
+    # expired but not yet removed from the table
+    cache.table.get_item.return_value = {"Item": {
+        "host_id": "host2", "host_name": "John Doe",
+        "expires": int(time.time()) - 100
+    }}
+    zoom.return_value.status_code = 200
+    zoom.return_value.json.return_value = {
+        "first_name": "Jon", "last_name": "Doe"
+    }
+    assert cache.get("host2") == "Jon Doe"
+    assert cache.table.put_item.call_args[1]["Item"]["host_name"] == "Jon Doe"
+
+
+def test_host_name_cache_prewarm(mocker):
+    zoom = mocker.patch.object(common, "zoom_api_request")
+    zoom.return_value.json.side_effect = [
+        {"users": [{"id": "host1", "first_name": "Jane", "last_name": "Doe"}],
+         "next_page_token": "abc"},
+        {"users": [{"id": "host2", "first_name": "John", "last_name": "Doe"}],
+         "next_page_token": ""}
+    ]
+    cache = common.HostNameCache()
+    cache.table = mocker.MagicMock()
+    assert cache.prewarm(common.zoom_users()) == 2
+    assert "next_page_token=abc" in zoom.call_args_list[1][0][0]
+    batch = cache.table.batch_writer.return_value.__enter__.return_value
+    assert batch.put_item.call_count == 2
+    assert cache.get("host2") == "John Doe"
+    assert cache.table.get_item.call_count == 0
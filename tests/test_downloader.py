@@ -1,6 +1,14 @@
+import io
 import site
+import base64
+import random
+import struct
+import hashlib
+import itertools
 import os
 import json
+import time
+import threading
 from os.path import dirname, join
 import pytest
 from importlib import import_module
@@ -11,6 +19,9 @@ from mock import patch
 import unittest
 from freezegun import freeze_time
 import copy
+from botocore.exceptions import (
+    EndpointConnectionError, ConnectTimeoutError, SSLError, ReadTimeoutError
+)
 
 site.addsitedir(join(dirname(dirname(__file__)), 'functions'))
 
@@ -102,7 +113,7 @@ class TestHandler(unittest.TestCase):
             downloader, "retrieve_message", return_value=message
         )
         self.mocker.patch.object(
-            downloader.Download, "_class_schedule", return_value={}
+            downloader.Download, "_class_schedule", {}
         )
 
         with self.assertLogs(level="INFO") as cm:
@@ -471,7 +482,7 @@ def test_zoom_filename(mocker):
 
 def test_handler_duration_check(handler, mocker):
     downloader.DOWNLOAD_MESSAGES_PER_INVOCATION = 1
-    mocker.patch.object(downloader, 'sqs_resource', mocker.Mock())
+    mocker.patch.object(downloader, 'sqs_resource', sqs_resource(mocker))
     mocker.patch.object(downloader.Download, 'oc_series_found', mocker.Mock(
         return_value=False))
 
@@ -501,6 +512,143 @@ def test_handler_duration_check(handler, mocker):
     assert mock_msg.delete.call_count == 1
 
 
+def sqs_resource(mocker):
+    """
+    Mock sqs resource whose queues' batch actions succeed.
+    """
+    queue = mocker.Mock()
+    for action in ["delete_messages", "change_message_visibility_batch",
+                   "send_messages"]:
+        getattr(queue, action).return_value = {"Successful": []}
+    return mocker.Mock(return_value=mocker.Mock(
+        get_queue_by_name=mocker.Mock(return_value=queue)
+    ))
+
+
+def test_batch_download(handler, mocker):
+    mocker.patch.object(downloader, 'DOWNLOAD_BATCH_SIZE', 3)
+    mocker.patch.object(downloader, 'sqs_resource', sqs_resource(mocker))
+    mocker.patch.object(downloader, 'get_admin_token', mocker.Mock())
+    mocker.patch.object(downloader.Download, 'oc_series_found',
+                        mocker.Mock(side_effect=[True, False, True]))
+    mocker.patch.object(downloader.Download, 'upload_to_s3')
+    mocker.patch.object(downloader.Download, 'send_to_uploader_queue')
+
+    messages = [
+        mocker.Mock(body=json.dumps({"duration": 10}), receipt_handle=str(i))
+        for i in range(3)
+    ]
+    mocker.patch.object(downloader, 'retrieve_messages',
+                        mocker.Mock(return_value=messages))
+    context = mocker.Mock(get_remaining_time_in_millis=mocker.Mock(
+        return_value=600000
+    ))
+    handler(downloader, {}, context)
+
+    # both matched recordings downloaded, unmatched one discarded
+    assert downloader.Download.upload_to_s3.call_count == 2
+    assert messages[0].delete.call_count == 1
+    assert messages[2].delete.call_count == 1
+    queue = downloader.sqs_resource.return_value \
+        .get_queue_by_name.return_value
+    queue.delete_messages.assert_called_once_with(
+        Entries=[{"Id": "0", "ReceiptHandle": "1"}]
+    )
+    assert downloader.get_admin_token.call_count == 1
+
+
+def test_batch_download_out_of_time(handler, mocker):
+    mocker.patch.object(downloader, 'DOWNLOAD_BATCH_SIZE', 3)
+    mocker.patch.object(downloader, 'sqs_resource', sqs_resource(mocker))
+    mocker.patch.object(downloader, 'get_admin_token', mocker.Mock())
+    mocker.patch.object(downloader.Download, 'oc_series_found',
+                        mocker.Mock(return_value=True))
+    mocker.patch.object(downloader.Download, 'send_to_uploader_queue')
+
+    # first download takes 500 seconds
+    mocker.patch.object(downloader, 'time', mocker.Mock(
+        time=mocker.Mock(side_effect=[0, 500])
+    ))
+    mocker.patch.object(downloader.Download, 'upload_to_s3')
+
+    messages = [
+        mocker.Mock(body=json.dumps({"duration": 10}), receipt_handle=str(i))
+        for i in range(3)
+    ]
+    mocker.patch.object(downloader, 'retrieve_messages',
+                        mocker.Mock(return_value=messages))
+    context = mocker.Mock(get_remaining_time_in_millis=mocker.Mock(
+        side_effect=[890000, 390000]
+    ))
+    handler(downloader, {}, context)
+
+    # only time for one download, the rest go back to the queue as
+    # copies so returning them doesn't count toward the redrive policy
+    assert downloader.Download.upload_to_s3.call_count == 1
+    assert messages[0].delete.call_count == 1
+    for m in messages[1:]:
+        assert m.delete.call_count == 0
+    queue = downloader.sqs_resource.return_value \
+        .get_queue_by_name.return_value
+    queue.send_messages.assert_called_once_with(Entries=[
+        {"Id": "0", "MessageBody": messages[1].body},
+        {"Id": "1", "MessageBody": messages[2].body}
+    ])
+    queue.delete_messages.assert_called_once_with(Entries=[
+        {"Id": "0", "ReceiptHandle": "1"},
+        {"Id": "1", "ReceiptHandle": "2"}
+    ])
+    assert queue.change_message_visibility_batch.call_count == 0
+
+
+def test_return_messages_copy_failed(mocker):
+    queue = mocker.Mock()
+    queue.send_messages.return_value = {
+        "Successful": [{"Id": "0"}],
+        "Failed": [{"Id": "1", "Code": "InternalError"}]
+    }
+    queue.delete_messages.return_value = {"Successful": []}
+    queue.change_message_visibility_batch.return_value = {"Successful": []}
+    messages = [
+        mocker.Mock(body="{}", receipt_handle=str(i)) for i in range(2)
+    ]
+
+    downloader.return_messages(queue, messages)
+
+    # the original of a message that couldn't be copied is kept
+    queue.delete_messages.assert_called_once_with(
+        Entries=[{"Id": "0", "ReceiptHandle": "0"}]
+    )
+    queue.change_message_visibility_batch.assert_called_once_with(
+        Entries=[{"Id": "0", "ReceiptHandle": "1", "VisibilityTimeout": 0}]
+    )
+
+
+def test_batch_download_error_continues(handler, mocker):
+    mocker.patch.object(downloader, 'DOWNLOAD_BATCH_SIZE', 2)
+    mocker.patch.object(downloader, 'sqs_resource', sqs_resource(mocker))
+    mocker.patch.object(downloader, 'get_admin_token', mocker.Mock())
+    mocker.patch.object(downloader.Download, 'oc_series_found',
+                        mocker.Mock(return_value=True))
+    mocker.patch.object(downloader.Download, 'send_to_uploader_queue')
+    mocker.patch.object(downloader.Download, 'upload_to_s3', mocker.Mock(
+        side_effect=[Exception("boom!"), None]
+    ))
+
+    messages = [
+        mocker.Mock(body=json.dumps({"duration": 10})) for _ in range(2)
+    ]
+    mocker.patch.object(downloader, 'retrieve_messages',
+                        mocker.Mock(return_value=messages))
+    context = mocker.Mock(get_remaining_time_in_millis=mocker.Mock(
+        return_value=600000
+    ))
+    with pytest.raises(Exception, match="boom!"):
+        handler(downloader, {}, context)
+
+    # failed message is left for retry, second one still gets downloaded
+    assert messages[0].delete.call_count == 0
+    assert messages[1].delete.call_count == 1
 
 
 @pytest.fixture
@@ -576,6 +724,54 @@ def test_recording_files_multi_set_false_start(download):
     assert len(zoom_files) == 3
     assert sum(1 for x in zoom_files if x._track_set == 1) == 3
 
+
+def test_upload_to_s3_parallel(download, mocker):
+    mocker.patch.object(downloader, 'DOWNLOAD_FILE_WORKERS', 2)
+    lock = threading.Lock()
+    overlapped = threading.Event()
+    active, most_active = [0], [0]
+
+    def transfer(part_slots, cancelled):
+        with lock:
+            active[0] += 1
+            most_active[0] = max(most_active[0], active[0])
+            if active[0] > 1:
+                overlapped.set()
+        # hold on to the worker until another transfer is running too
+        overlapped.wait(5)
+        time.sleep(0.01)
+        with lock:
+            active[0] -= 1
+
+    files = [mocker.Mock() for _ in range(5)]
+    for f in files:
+        f.stream_file_to_s3.side_effect = transfer
+    download._recording_files = files
+    download.upload_to_s3()
+
+    # transfers overlap, but no more than DOWNLOAD_FILE_WORKERS at once
+    assert overlapped.is_set()
+    assert most_active[0] == 2
+    assert all(f.stream_file_to_s3.call_count == 1 for f in files)
+
+    # every file shares the same part slots and cancellation event
+    args = [f.stream_file_to_s3.call_args[0] for f in files]
+    assert all(a == args[0] for a in args)
+    assert not args[0][1].is_set()
+
+
+def test_upload_to_s3_failure_cancels(download, mocker):
+    files = [mocker.Mock() for _ in range(3)]
+    files[1].stream_file_to_s3.side_effect = \
+        downloader.PermanentDownloadError("boom!")
+    download._recording_files = files
+
+    with pytest.raises(downloader.PermanentDownloadError, match="boom!"):
+        download.upload_to_s3()
+    cancelled = files[1].stream_file_to_s3.call_args[0][1]
+    assert cancelled.is_set()
+
+
 @pytest.fixture
 def zoomfile(mocker):
     return downloader.ZoomFile({"recording_type": "speaker"}, 0)
@@ -591,3 +787,814 @@ def test_zoom_filename_ext(mocker, zoomfile):
         zoomfile._zoom_filename = filename
         assert zoomfile.file_extension == expected
 
+
+def s3_upload_part(**kwargs):
+    return {"ETag": '"{}"'.format(hashlib.md5(kwargs["Body"]).hexdigest())}
+
+
+def s3_complete(**kwargs):
+    parts = kwargs["MultipartUpload"]["Parts"]
+    digests = b"".join(bytes.fromhex(p["ETag"].strip('"')) for p in parts)
+    return {"ETag": '"{}-{}"'.format(
+        hashlib.md5(digests).hexdigest(), len(parts)
+    )}
+
+
+def test_stream_file_to_s3_cancelled(mocker, zoomfile):
+    zoomfile.s3 = mocker.Mock()
+    cancelled = downloader.threading.Event()
+    cancelled.set()
+    with pytest.raises(downloader.TransferCancelled):
+        zoomfile.stream_file_to_s3(cancelled=cancelled)
+    assert zoomfile.s3.create_multipart_upload.call_count == 0
+
+
+def test_stream_file_to_s3_window(mocker, zoomfile):
+    data = os.urandom(1000)
+    zoomfile.file_data.update({"meeting_uuid": "abcd", "recording_id": "1234"})
+    zoomfile._zoom_filename = "file.m4a"
+    zoomfile._s3_filename = "series/1234/000-speaker.m4a"
+    zoomfile._stream = mocker.Mock(raw=io.BytesIO(data), headers={})
+    mocker.patch.object(downloader, 'PART_SIZE', 100)
+    mocker.patch.object(downloader, 'PART_WINDOW_SIZE', 2)
+
+    lock = downloader.threading.Lock()
+    in_flight = {"now": 0, "max": 0}
+    bodies = {}
+
+    def upload_part(**kwargs):
+        with lock:
+            in_flight["now"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        bodies[kwargs["PartNumber"]] = bytes(kwargs["Body"])
+        time.sleep(0.01)
+        with lock:
+            in_flight["now"] -= 1
+        return s3_upload_part(**kwargs)
+
+    zoomfile.s3 = mocker.Mock()
+    zoomfile.s3.create_multipart_upload.return_value = {"UploadId": "abc"}
+    zoomfile.s3.upload_part.side_effect = upload_part
+    zoomfile.s3.complete_multipart_upload.side_effect = s3_complete
+    zoomfile.stream_file_to_s3()
+
+    assert in_flight["max"] <= 2
+    assert b"".join(bodies[n] for n in sorted(bodies)) == data
+    parts = zoomfile.s3.complete_multipart_upload \
+        .call_args[1]["MultipartUpload"]["Parts"]
+    assert [p["PartNumber"] for p in parts] == list(range(1, 11))
+    assert zoomfile.s3.abort_multipart_upload.call_count == 0
+
+
+def test_stream_file_to_s3_part_failure(mocker, zoomfile):
+    zoomfile.file_data.update({"meeting_uuid": "abcd", "recording_id": "1234"})
+    zoomfile._zoom_filename = "file.m4a"
+    zoomfile._s3_filename = "series/1234/000-speaker.m4a"
+    zoomfile._stream = mocker.Mock(
+        raw=io.BytesIO(os.urandom(1000)), headers={}
+    )
+    mocker.patch.object(downloader, 'PART_SIZE', 100)
+
+    zoomfile.s3 = mocker.Mock()
+    zoomfile.s3.create_multipart_upload.return_value = {"UploadId": "abc"}
+    zoomfile.s3.upload_part.side_effect = Exception("boom!")
+    part_slots = downloader.threading.BoundedSemaphore(3)
+    with pytest.raises(Exception, match="boom!"):
+        zoomfile.stream_file_to_s3(part_slots=part_slots)
+
+    assert zoomfile.s3.abort_multipart_upload.call_count == 1
+    # all the shared part slots were given back
+    assert all(part_slots.acquire(blocking=False) for _ in range(3))
+
+
+def test_stream_file_to_s3_cancelled_aborts_upload(mocker, zoomfile):
+    zoomfile.file_data.update({"meeting_uuid": "abcd", "recording_id": "1234"})
+    zoomfile._zoom_filename = "file.m4a"
+    zoomfile._s3_filename = "series/1234/000-speaker.m4a"
+    zoomfile._stream = mocker.Mock(
+        raw=io.BytesIO(os.urandom(1000)), headers={}
+    )
+    mocker.patch.object(downloader, 'PART_SIZE', 100)
+    mocker.patch.object(downloader, 'PART_WINDOW_SIZE', 1)
+    cancelled = downloader.threading.Event()
+
+    def upload_part(**kwargs):
+        # another file failed while this one was transferring
+        cancelled.set()
+        return s3_upload_part(**kwargs)
+
+    zoomfile.checkpoints = mocker.Mock()
+    zoomfile.checkpoints.get_item.return_value = {}
+    zoomfile.s3 = mocker.Mock()
+    zoomfile.s3.create_multipart_upload.return_value = {"UploadId": "abc"}
+    zoomfile.s3.upload_part.side_effect = upload_part
+    with pytest.raises(downloader.TransferCancelled):
+        zoomfile.stream_file_to_s3(cancelled=cancelled)
+
+    assert zoomfile.s3.abort_multipart_upload.call_count == 1
+    assert zoomfile.checkpoints.delete_item.call_count == 1
+    assert zoomfile.s3.complete_multipart_upload.call_count == 0
+
+
+def test_part_sizes(mocker, zoomfile):
+    mib = 1024 * 1024
+    mocker.patch.object(downloader, 'PART_SIZE', 5 * mib)
+    mocker.patch.object(downloader, 'PART_COUNT_TARGET', 100)
+    mocker.patch.object(downloader, 'PART_MEMORY_BUDGET', 300 * mib)
+    mocker.patch.object(downloader, 'MAX_PARTS_IN_FLIGHT', 12)
+
+    cases = [
+        # small files use the minimum part size
+        (100 * mib, 5 * mib),
+        # aim for the target part count
+        (1000 * mib, 10 * mib),
+        # capped by the memory budget
+        (4000 * mib, 25 * mib),
+        # S3's part limit wins over the memory budget
+        (500000 * mib, 50 * mib),
+    ]
+    for length, expected in cases:
+        zoomfile._stream = mocker.Mock(
+            headers={"Content-Length": str(length)}
+        )
+        sizes = zoomfile.part_sizes()
+        assert next(sizes) == expected
+        assert next(sizes) == expected
+
+
+def test_part_sizes_unknown_length(mocker, zoomfile):
+    mib = 1024 * 1024
+    mocker.patch.object(downloader, 'PART_SIZE', 5 * mib)
+    mocker.patch.object(downloader, 'PART_SIZE_STEP', 2)
+    mocker.patch.object(downloader, 'PART_MEMORY_BUDGET', 300 * mib)
+    mocker.patch.object(downloader, 'MAX_PARTS_IN_FLIGHT', 12)
+    zoomfile._stream = mocker.Mock(headers={})
+
+    sizes = [x // mib for x in itertools.islice(zoomfile.part_sizes(), 8)]
+    assert sizes == [5, 5, 10, 10, 20, 20, 25, 25]
+
+
+def test_contiguous_parts():
+    parts = {n: {"PartNumber": n} for n in [1, 2, 3, 5, 6]}
+    assert [p["PartNumber"] for p in downloader.contiguous_parts(parts)] \
+        == [1, 2, 3]
+    assert downloader.contiguous_parts({2: {}, 3: {}}) == []
+
+
+def test_stream_file_to_s3_resume(mocker, zoomfile):
+    data = os.urandom(1000)
+    downloader.ADMIN_TOKEN = "super-secret-admin-token"
+    zoomfile.file_data.update({
+        "meeting_uuid": "abcd",
+        "recording_id": "1234",
+        "download_url": "https://example.com/stream"
+    })
+    zoomfile._zoom_filename = "file.m4a"
+    zoomfile._s3_filename = "series/1234/000-speaker.m4a"
+    mocker.patch.object(downloader, 'PART_SIZE', 100)
+
+    zoomfile.checkpoints = mocker.Mock()
+    zoomfile.checkpoints.get_item.return_value = {"Item": {
+        "s3_key": zoomfile._s3_filename,
+        "upload_id": "abc"
+    }}
+    zoomfile.s3 = mocker.Mock()
+    # part 4 made it but part 3 didn't, so resume from part 3
+    zoomfile.s3.get_paginator.return_value.paginate.return_value = [{
+        "Parts": [
+            {"PartNumber": n, "Size": 100,
+             **s3_upload_part(Body=data[(n - 1) * 100:n * 100])}
+            for n in [1, 2, 4]
+        ]
+    }]
+    zoomfile.s3.upload_part.side_effect = s3_upload_part
+    zoomfile.s3.complete_multipart_upload.side_effect = s3_complete
+
+    with requests_mock.mock() as req_mock:
+        req_mock.get(requests_mock.ANY, status_code=206, content=data[200:])
+        zoomfile.stream_file_to_s3()
+        assert req_mock.last_request.headers["Range"] == "bytes=200-"
+
+    assert zoomfile.s3.create_multipart_upload.call_count == 0
+    uploaded = [c[1]["PartNumber"]
+                for c in zoomfile.s3.upload_part.call_args_list]
+    assert sorted(uploaded) == list(range(3, 11))
+    parts = zoomfile.s3.complete_multipart_upload \
+        .call_args[1]["MultipartUpload"]["Parts"]
+    assert [p["PartNumber"] for p in parts] == list(range(1, 11))
+    assert zoomfile.checkpoints.delete_item.call_count == 1
+    assert zoomfile.file_data["md5"] == s3_complete(
+        MultipartUpload={"Parts": [
+            s3_upload_part(Body=data[i:i + 100]) for i in range(0, 1000, 100)
+        ]}
+    )["ETag"].strip('"')
+
+
+def test_stream_file_to_s3_failure_keeps_upload(mocker, zoomfile):
+    zoomfile.file_data.update({"meeting_uuid": "abcd", "recording_id": "1234"})
+    zoomfile._zoom_filename = "file.m4a"
+    zoomfile._s3_filename = "series/1234/000-speaker.m4a"
+    zoomfile._stream = mocker.Mock(
+        raw=io.BytesIO(os.urandom(1000)), headers={}
+    )
+    mocker.patch.object(downloader, 'PART_SIZE', 100)
+
+    zoomfile.checkpoints = mocker.Mock()
+    zoomfile.checkpoints.get_item.return_value = {}
+    zoomfile.s3 = mocker.Mock()
+    zoomfile.s3.create_multipart_upload.return_value = {"UploadId": "abc"}
+    zoomfile.s3.upload_part.side_effect = Exception("boom!")
+    with pytest.raises(Exception, match="boom!"):
+        zoomfile.stream_file_to_s3()
+
+    assert zoomfile.s3.abort_multipart_upload.call_count == 0
+    saved = zoomfile.checkpoints.put_item.call_args[1]["Item"]
+    assert saved["upload_id"] == "abc"
+    assert saved["parts"] == []
+
+
+def test_already_in_s3(mocker, zoomfile):
+    zoomfile.file_data.update({"recording_id": "1234", "file_size": 1000})
+    zoomfile._s3_filename = "series/1234/000-speaker.mp4"
+    zoomfile.s3 = mocker.Mock()
+    tags = {"TagSet": [
+        {"Key": "ffprobe_seconds", "Value": "60.5"},
+        {"Key": "ffprobe_bytes", "Value": "1000"}
+    ]}
+
+    cases = [
+        # matches and was verified
+        ({"ContentLength": 1000, "Metadata": {"file_id": "1234"},
+          "ETag": '"abc-2"'}, tags, True),
+        # size mismatch
+        ({"ContentLength": 999, "Metadata": {"file_id": "1234"}}, tags, False),
+        # different recording
+        ({"ContentLength": 1000, "Metadata": {"file_id": "5678"}}, tags, False),
+        # never verified
+        ({"ContentLength": 1000, "Metadata": {"file_id": "1234"}},
+         {"TagSet": []}, False),
+    ]
+    for head, tag_set, expected in cases:
+        zoomfile.s3.head_object.return_value = head
+        zoomfile.s3.get_object_tagging.return_value = tag_set
+        assert zoomfile.already_in_s3() == expected
+
+    assert zoomfile.file_data["ffprobe_seconds"] == 60.5
+    assert zoomfile.file_data["ffprobe_bytes"] == 1000
+    assert zoomfile.file_data["md5"] == "abc-2"
+
+    # not in S3 at all
+    zoomfile.s3.head_object.side_effect = downloader.ClientError(
+        {"Error": {"Code": "404"}}, "HeadObject"
+    )
+    assert not zoomfile.already_in_s3()
+
+    # no size reported by zoom
+    del zoomfile.file_data["file_size"]
+    assert not zoomfile.already_in_s3()
+
+
+def test_stream_file_to_s3_already_in_s3(mocker, zoomfile):
+    mocker.patch.object(downloader.ZoomFile, 'already_in_s3',
+                        mocker.Mock(return_value=True))
+    zoomfile._s3_filename = "series/1234/000-speaker.mp4"
+    zoomfile.s3 = mocker.Mock()
+    zoomfile.stream_file_to_s3()
+    assert zoomfile.s3.create_multipart_upload.call_count == 0
+
+
+def mp4_box(box_type, payload=b"", large=False):
+    if large:
+        return struct.pack(">I4sQ", 1, box_type, len(payload) + 16) + payload
+    return struct.pack(">I4s", len(payload) + 8, box_type) + payload
+
+
+def mp4_bytes(duration=60500, timescale=1000, mvhd_version=0,
+              mdat_size=5000):
+    if mvhd_version == 1:
+        mvhd = struct.pack(">B3xQQIQ", 1, 0, 0, timescale, duration)
+    else:
+        mvhd = struct.pack(">B3xIIII", 0, 0, 0, timescale, duration)
+    mvhd += bytes(80)
+    moov = mp4_box(b"moov", mp4_box(b"mvhd", mvhd) + mp4_box(b"trak", bytes(50)))
+    return (mp4_box(b"ftyp", b"isom" + bytes(12))
+            + moov
+            + mp4_box(b"mdat", os.urandom(mdat_size), large=True))
+
+
+def test_mp4_inspector():
+    cases = [
+        # complete files
+        (mp4_bytes(), True, 60.5),
+        (mp4_bytes(duration=90000, timescale=600, mvhd_version=1), True, 150),
+        # truncated
+        (mp4_bytes()[:-100], False, None),
+        # no moov box
+        (mp4_box(b"ftyp", bytes(16)) + mp4_box(b"mdat", bytes(100)),
+         False, None),
+        # garbage
+        (os.urandom(1000), False, None),
+    ]
+    for data, valid, duration in cases:
+        # feed it in odd sized chunks to cross box boundaries
+        for chunk_size in [1, 7, 100, len(data)]:
+            inspector = downloader.MP4Inspector()
+            for i in range(0, len(data), chunk_size):
+                inspector.feed(data[i:i + chunk_size])
+            assert inspector.finish() == valid
+            assert inspector.size == len(data)
+            if valid:
+                assert inspector.duration == duration
+                assert inspector.boxes == ["ftyp", "moov", "mdat"]
+
+
+def test_stream_file_to_s3_verifies_mp4(mocker, zoomfile):
+    zoomfile.file_data.update({"meeting_uuid": "abcd", "recording_id": "1234"})
+    zoomfile._zoom_filename = "file.mp4"
+    zoomfile._s3_filename = "series/1234/000-speaker.mp4"
+    mocker.patch.object(downloader, 'PART_SIZE', 1000)
+    mocker.patch.object(downloader.ZoomFile, 'valid_mp4_file')
+    zoomfile.s3 = mocker.Mock()
+    zoomfile.s3.create_multipart_upload.return_value = {"UploadId": "abc"}
+    zoomfile.s3.upload_part.side_effect = s3_upload_part
+    zoomfile.s3.complete_multipart_upload.side_effect = s3_complete
+
+    data = mp4_bytes()
+    zoomfile._stream = mocker.Mock(
+        raw=io.BytesIO(data), headers={"Content-Length": str(len(data))}
+    )
+    zoomfile.stream_file_to_s3()
+    assert zoomfile.file_data["ffprobe_seconds"] == 60.5
+    assert zoomfile.file_data["ffprobe_bytes"] == len(data)
+    assert downloader.ZoomFile.valid_mp4_file.call_count == 0
+
+    data = mp4_bytes()[:-100]
+    zoomfile._stream = mocker.Mock(raw=io.BytesIO(data), headers={})
+    with pytest.raises(Exception, match="MP4 failed to transfer"):
+        zoomfile.stream_file_to_s3()
+
+
+def test_upload_part_bad_digest(mocker, zoomfile):
+    mocker.patch.object(downloader, "backoff_delay", return_value=0)
+    zoomfile._s3_filename = "series/1234/000-speaker.m4a"
+    chunk = os.urandom(100)
+    bad_digest = downloader.ClientError(
+        {"Error": {"Code": "BadDigest"}}, "UploadPart"
+    )
+    zoomfile.s3 = mocker.Mock()
+    zoomfile.s3.upload_part.side_effect = [
+        bad_digest, {"ETag": '"wrong"'}, s3_upload_part(Body=chunk)
+    ]
+    part = zoomfile.upload_part("abc", 1, chunk)
+    assert part == s3_upload_part(Body=chunk)
+    assert zoomfile.s3.upload_part.call_count == 3
+    content_md5 = zoomfile.s3.upload_part.call_args[1]["ContentMD5"]
+    assert base64.b64decode(content_md5) == hashlib.md5(chunk).digest()
+
+    # gives up eventually
+    zoomfile.s3.upload_part.side_effect = bad_digest
+    with pytest.raises(downloader.ClientError):
+        zoomfile.upload_part("abc", 1, chunk)
+
+    # other errors aren't retried
+    zoomfile.s3.upload_part.reset_mock()
+    zoomfile.s3.upload_part.side_effect = downloader.ClientError(
+        {"Error": {"Code": "AccessDenied"}}, "UploadPart"
+    )
+    with pytest.raises(downloader.ClientError):
+        zoomfile.upload_part("abc", 1, chunk)
+    assert zoomfile.s3.upload_part.call_count == 1
+
+
+def test_stream_file_to_s3_composite_mismatch(mocker, zoomfile):
+    zoomfile.file_data.update({"meeting_uuid": "abcd", "recording_id": "1234"})
+    zoomfile._zoom_filename = "file.m4a"
+    zoomfile._s3_filename = "series/1234/000-speaker.m4a"
+    zoomfile._stream = mocker.Mock(
+        raw=io.BytesIO(os.urandom(1000)), headers={}
+    )
+    mocker.patch.object(downloader, 'PART_SIZE', 100)
+
+    zoomfile.s3 = mocker.Mock()
+    zoomfile.s3.create_multipart_upload.return_value = {"UploadId": "abc"}
+    zoomfile.s3.upload_part.side_effect = s3_upload_part
+    zoomfile.s3.complete_multipart_upload.return_value = {"ETag": '"abc-10"'}
+    with pytest.raises(downloader.ChecksumMismatch):
+        zoomfile.stream_file_to_s3()
+    assert "md5" not in zoomfile.file_data
+
+
+def test_upload_part_retry(mocker, zoomfile):
+    sleep = mocker.patch.object(downloader.time, "sleep")
+    zoomfile._s3_filename = "series/1234/000-speaker.m4a"
+    chunk = os.urandom(100)
+    slow_down = downloader.ClientError(
+        {"Error": {"Code": "SlowDown"},
+         "ResponseMetadata": {"HTTPStatusCode": 503}}, "UploadPart"
+    )
+    zoomfile.s3 = mocker.Mock()
+    zoomfile.s3.upload_part.side_effect = [
+        slow_down, slow_down, s3_upload_part(Body=chunk)
+    ]
+    budget = downloader.RetryBudget(5)
+    assert zoomfile.upload_part("abc", 1, chunk, budget) \
+        == s3_upload_part(Body=chunk)
+    assert sleep.call_count == 2
+    assert budget.remaining == 3
+    # every attempt sends the same bytes
+    assert all(c[1]["Body"] is chunk
+               for c in zoomfile.s3.upload_part.call_args_list)
+
+    # the file's budget runs out before the part's attempts do
+    zoomfile.s3.upload_part.reset_mock()
+    zoomfile.s3.upload_part.side_effect = slow_down
+    with pytest.raises(downloader.ClientError):
+        zoomfile.upload_part("abc", 2, chunk, budget)
+    assert zoomfile.s3.upload_part.call_count == 4
+    assert budget.remaining == 0
+
+
+def test_retryable_part_error():
+    cases = [
+        (EndpointConnectionError(endpoint_url="https://s3"), True),
+        (ConnectTimeoutError(endpoint_url="https://s3"), True),
+        (SSLError(endpoint_url="https://s3", error="bad handshake"), True),
+        (ReadTimeoutError(endpoint_url="https://s3"), True),
+        (downloader.ChecksumMismatch("bad etag"), True),
+        (downloader.ClientError(
+            {"Error": {"Code": "AccessDenied"},
+             "ResponseMetadata": {"HTTPStatusCode": 403}}, "UploadPart"
+        ), False),
+        (ValueError(), False),
+    ]
+    for error, retryable in cases:
+        assert downloader.retryable_part_error(error) == retryable, error
+
+
+def test_backoff_delay(mocker):
+    mocker.patch.object(downloader, "PART_RETRY_BASE_DELAY", 1)
+    mocker.patch.object(downloader, "PART_RETRY_MAX_DELAY", 10)
+    for attempt, cap in [(1, 2), (2, 4), (3, 8), (4, 10), (10, 10)]:
+        delays = [downloader.backoff_delay(attempt) for _ in range(100)]
+        assert all(0 <= d <= cap for d in delays)
+
+
+def test_class_schedule():
+    schedule = downloader.ClassSchedule({
+        "Days": ["M", "W"],
+        "Time": ["14:00", "09:30", "11:00"],
+        "opencast_series_id": 12345
+    })
+    assert schedule["opencast_series_id"] == "12345"
+
+    cases = [
+        # monday
+        (datetime(2020, 1, 6, 9, 1), 570),
+        (datetime(2020, 1, 6, 9, 0), None),
+        (datetime(2020, 1, 6, 9, 0, 30), 570),
+        (datetime(2020, 1, 6, 9, 59), 570),
+        (datetime(2020, 1, 6, 9, 59, 30), 570),
+        (datetime(2020, 1, 6, 10, 0), None),
+        (datetime(2020, 1, 6, 10, 15), None),
+        (datetime(2020, 1, 6, 10, 31), 660),
+        (datetime(2020, 1, 6, 12, 0), None),
+        (datetime(2020, 1, 6, 14, 29), 840),
+        (datetime(2020, 1, 6, 23, 0), None),
+        # tuesday
+        (datetime(2020, 1, 7, 9, 30), None),
+        # wednesday
+        (datetime(2020, 1, 8, 0, 0), None),
+        (datetime(2020, 1, 8, 13, 31), 840),
+    ]
+    for local_time, expected in cases:
+        assert schedule.scheduled_start(local_time) == expected
+
+
+def test_class_schedule_irregular():
+    schedule = downloader.ClassSchedule({
+        "day_times": {"M": ["09:00"], "R": ["13:00", "13:20"]},
+        "start_date": "2020-01-27",
+        "end_date": "2020-05-15",
+        "holidays": ["2020-02-17"],
+        "exceptions": {"2020-03-02": ["15:00"], "2020-03-05": [],
+                       "2020-06-01": ["09:00"]},
+        "buffer_minutes": 15,
+        "opencast_series_id": "abc"
+    })
+
+    cases = [
+        # per day times
+        (datetime(2020, 2, 3, 9, 10), 540),
+        (datetime(2020, 2, 3, 13, 0), None),
+        (datetime(2020, 2, 6, 13, 0), 780),
+        (datetime(2020, 2, 6, 9, 0), None),
+        # closest of overlapping windows
+        (datetime(2020, 2, 6, 13, 11), 800),
+        (datetime(2020, 2, 6, 13, 9), 780),
+        # tighter buffer
+        (datetime(2020, 2, 3, 9, 15), None),
+        (datetime(2020, 2, 3, 8, 45, 30), 540),
+        # outside the term
+        (datetime(2020, 1, 20, 9, 0), None),
+        (datetime(2020, 5, 18, 9, 0), None),
+        # holiday
+        (datetime(2020, 2, 17, 9, 0), None),
+        # moved
+        (datetime(2020, 3, 2, 9, 0), None),
+        (datetime(2020, 3, 2, 15, 5), 900),
+        # cancelled
+        (datetime(2020, 3, 5, 13, 0), None),
+        # makeup class after the term
+        (datetime(2020, 6, 1, 9, 0), 540),
+    ]
+    for local_time, expected in cases:
+        assert schedule.scheduled_start(local_time) == expected
+
+    assert schedule.meets_on(datetime(2020, 2, 3).date())
+    assert not schedule.meets_on(datetime(2020, 2, 4).date())
+    assert not schedule.meets_on(datetime(2020, 3, 5).date())
+
+
+def test_interval_tree():
+    intervals = []
+    for _ in range(200):
+        low = random.uniform(0, 1000)
+        intervals.append((low, low + random.uniform(0, 50), len(intervals)))
+    # duplicates and empty intervals
+    intervals += [(10, 20, "a"), (10, 20, "b"), (0, 10, "c"), (5, 5, "d")]
+    tree = downloader.IntervalTree(intervals)
+    for point in [random.uniform(-10, 1060) for _ in range(500)] + [5, 10]:
+        expected = [v for low, high, v in intervals if low < point < high]
+        assert sorted(map(str, tree.query(point))) \
+            == sorted(map(str, expected))
+
+    assert downloader.IntervalTree([]).query(5) == []
+
+
+def test_schedule_index(mocker):
+    table = mocker.Mock()
+    mocker.patch.object(downloader.boto3, "resource").return_value \
+        .Table.return_value = table
+    table.scan.side_effect = [
+        {"Items": [{"zoom_series_id": "1", "Days": ["M"], "Time": ["10:00"],
+                    "opencast_series_id": "a"}],
+         "LastEvaluatedKey": {"zoom_series_id": "1"}},
+        {"Items": [{"zoom_series_id": "2", "Days": ["T"], "Time": ["10:00"],
+                    "opencast_series_id": "b"}]},
+    ]
+
+    index = downloader.ScheduleIndex(ttl=300)
+    assert index.get(1)["opencast_series_id"] == "a"
+    assert index.get("2")["opencast_series_id"] == "b"
+    assert index.get("3") is None
+    assert table.scan.call_count == 2
+    assert table.scan.call_args[1] == {
+        "ExclusiveStartKey": {"zoom_series_id": "1"}
+    }
+
+    # stale, reloaded in the background while the old copy is used
+    thread = mocker.patch.object(downloader.threading, "Thread")
+    index._loaded -= 301
+    assert index.get("1")["opencast_series_id"] == "a"
+    assert index.get("1")["opencast_series_id"] == "a"
+    assert thread.call_count == 1
+    table.scan.side_effect = [{"Items": []}]
+    thread.call_args[1]["target"]()
+    assert index.get("1") is None
+    assert not index._refreshing
+
+
+def test_schedule_index_scan_fails(mocker):
+    table = mocker.Mock()
+    mocker.patch.object(downloader.boto3, "resource").return_value \
+        .Table.return_value = table
+    table.scan.side_effect = Exception("ProvisionedThroughputExceeded")
+    table.get_item.side_effect = [
+        {"Item": {"zoom_series_id": "1", "Days": ["M"], "Time": ["10:00"],
+                  "opencast_series_id": "a"}},
+        {},
+    ]
+
+    # lookups go to the table one at a time
+    index = downloader.ScheduleIndex(ttl=300)
+    assert index.get("1")["opencast_series_id"] == "a"
+    assert index.get("2") is None
+    assert table.get_item.call_args[1] == {"Key": {"zoom_series_id": "2"}}
+    # without scanning again until the ttl is up
+    assert table.scan.call_count == 1
+    index.prefetch(["3"])
+    assert table.scan.call_count == 1
+
+    index._load_failed -= 301
+    table.scan.side_effect = [{"Items": []}]
+    assert index.get("1") is None
+    assert table.scan.call_count == 2
+    assert table.get_item.call_count == 2
+
+
+def test_batch_get_schedules(mocker):
+    mocker.patch.object(downloader.time, "sleep")
+    dynamodb = mocker.patch.object(downloader.boto3, "resource").return_value
+    table = downloader.CLASS_SCHEDULE_TABLE
+
+    def item(series_id):
+        return {"zoom_series_id": series_id, "Days": ["M"],
+                "Time": ["10:00"], "opencast_series_id": "oc" + series_id}
+
+    dynamodb.batch_get_item.side_effect = [
+        {"Responses": {table: [item("1")]},
+         "UnprocessedKeys": {table: {"Keys": [{"zoom_series_id": "3"}]}}},
+        {"Responses": {table: [item("3")]}, "UnprocessedKeys": {}},
+    ]
+    found, unprocessed = downloader.batch_get_schedules({"1", "2", "3"})
+    assert set(found) == {"1", "3"}
+    assert found["3"]["opencast_series_id"] == "oc3"
+    assert unprocessed == set()
+    retry = dynamodb.batch_get_item.call_args[1]["RequestItems"]
+    assert retry == {table: {"Keys": [{"zoom_series_id": "3"}]}}
+
+    # never processed
+    mocker.patch.object(downloader, "BATCH_GET_ATTEMPTS", 2)
+    dynamodb.batch_get_item.reset_mock()
+    dynamodb.batch_get_item.side_effect = None
+    dynamodb.batch_get_item.return_value = {
+        "Responses": {},
+        "UnprocessedKeys": {table: {"Keys": [{"zoom_series_id": "1"}]}}
+    }
+    found, unprocessed = downloader.batch_get_schedules({"1"})
+    assert found == {}
+    assert unprocessed == {"1"}
+    assert dynamodb.batch_get_item.call_count == 2
+
+    # split into requests of at most 100 keys
+    dynamodb.batch_get_item.reset_mock()
+    dynamodb.batch_get_item.return_value = {"Responses": {}}
+    downloader.batch_get_schedules({str(i) for i in range(250)})
+    assert [len(c[1]["RequestItems"][table]["Keys"])
+            for c in dynamodb.batch_get_item.call_args_list] == [100, 100, 50]
+
+
+def test_schedule_index_prefetch(mocker):
+    index = downloader.ScheduleIndex()
+    index._schedules = {"1": downloader.ClassSchedule(
+        {"Days": ["M"], "Time": ["10:00"], "opencast_series_id": "a"}
+    )}
+    index._loaded = time.time()
+    batch_get = mocker.patch.object(
+        downloader, "batch_get_schedules", return_value=({
+            "2": downloader.ClassSchedule(
+                {"Days": ["M"], "Time": ["10:00"], "opencast_series_id": "b"}
+            )
+        }, {"4"})
+    )
+
+    index.prefetch(["1", "2", "3", "4", 2, None])
+    assert batch_get.call_args[0][0] == {"2", "3", "4"}
+    assert index.get("2")["opencast_series_id"] == "b"
+    assert index._not_scheduled == {"3"}
+
+    # only series still unknown get looked up again
+    batch_get.return_value = ({}, set())
+    index.prefetch(["1", "2", "3", "4"])
+    assert batch_get.call_args[0][0] == {"4"}
+
+
+def test_batch_download_prefetches_schedules(handler, mocker):
+    mocker.patch.object(downloader, 'DOWNLOAD_BATCH_SIZE', 3)
+    mocker.patch.object(downloader, 'sqs_resource', sqs_resource(mocker))
+    mocker.patch.object(downloader, 'SCHEDULE_INDEX')
+    mocker.patch.object(downloader, 'classify_messages',
+                        return_value=([], [], []))
+    messages = [
+        mocker.Mock(body=json.dumps({"zoom_series_id": i})) for i in [1, 2, 1]
+    ]
+    mocker.patch.object(downloader, 'retrieve_messages',
+                        mocker.Mock(return_value=messages))
+    handler(downloader, {}, mocker.Mock())
+    series_ids = downloader.SCHEDULE_INDEX.prefetch.call_args[0][0]
+    assert list(series_ids) == [1, 2, 1]
+
+
+def test_batch_download_classifies_batch(handler, mocker):
+    mocker.patch.object(downloader, 'DOWNLOAD_BATCH_SIZE', 4)
+    mocker.patch.object(downloader, 'UNMATCHED_QUEUE_NAME', "unmatched")
+    mocker.patch.object(downloader, 'sqs_resource', sqs_resource(mocker))
+    mocker.patch.object(downloader, 'get_admin_token', mocker.Mock())
+    mocker.patch.object(downloader.Download, 'oc_series_found',
+                        mocker.Mock(side_effect=[False, True, False]))
+    mocker.patch.object(downloader.Download, 'upload_to_s3')
+    mocker.patch.object(downloader.Download, 'send_to_uploader_queue')
+
+    queues = {
+        "unmatched": downloader.sqs_resource().get_queue_by_name(),
+        None: sqs_resource(mocker)().get_queue_by_name()
+    }
+    downloader.sqs_resource.return_value.get_queue_by_name.side_effect = \
+        lambda QueueName: queues.get(QueueName, queues[None])
+    queues["unmatched"].send_messages.return_value = {
+        "Failed": [{"Id": "1", "Code": "InternalError"}]
+    }
+
+    durations = [10, 10, 0, 10]
+    messages = [
+        mocker.Mock(body=json.dumps({"duration": d}), receipt_handle=str(i))
+        for i, d in enumerate(durations)
+    ]
+    mocker.patch.object(downloader, 'retrieve_messages',
+                        mocker.Mock(return_value=messages))
+    context = mocker.Mock(get_remaining_time_in_millis=mocker.Mock(
+        return_value=600000
+    ))
+    handler(downloader, {}, context)
+
+    # too short and unmatched messages settled in batches, not one by one
+    assert all(m.delete.call_count == 0
+               for i, m in enumerate(messages) if i != 1)
+    assert messages[1].delete.call_count == 1
+    queues["unmatched"].send_messages.assert_called_once_with(Entries=[
+        {"Id": "0", "MessageBody": messages[0].body},
+        {"Id": "1", "MessageBody": messages[3].body}
+    ])
+    # the message that failed to move stays on the download queue
+    assert queues[None].delete_messages.call_args_list == [
+        mocker.call(Entries=[{"Id": "0", "ReceiptHandle": "2"}]),
+        mocker.call(Entries=[{"Id": "0", "ReceiptHandle": "0"}])
+    ]
+
+
+def test_matched_download_unmatched_queue(mocker):
+    mocker.patch.object(downloader, 'UNMATCHED_QUEUE_NAME', "unmatched")
+    mocker.patch.object(downloader.Download, 'oc_series_found',
+                        mocker.Mock(return_value=False))
+    sqs = mocker.Mock()
+    sqs.get_queue_by_name.return_value.url = "https://sqs/unmatched"
+    message = mocker.Mock(body=json.dumps({"duration": 10, "uuid": "abc"}))
+    assert downloader.matched_download(sqs, message) is None
+    sqs.get_queue_by_name.assert_called_once_with(QueueName="unmatched")
+    sent = sqs.get_queue_by_name.return_value.send_message.call_args[1]
+    assert json.loads(sent["MessageBody"]) == {"duration": 10, "uuid": "abc"}
+    assert message.delete.call_count == 1
+
+
+def test_event_source_download(handler, mocker):
+    mocker.patch.object(downloader, 'sqs_resource', sqs_resource(mocker))
+    mocker.patch.object(downloader, 'get_admin_token', mocker.Mock())
+    mocker.patch.object(downloader.Download, 'oc_series_found',
+                        mocker.Mock(return_value=True))
+    mocker.patch.object(downloader.Download, 'send_to_uploader_queue')
+    mocker.patch.object(downloader.Download, 'send_to_deadletter_queue')
+    mocker.patch.object(downloader.Download, 'upload_to_s3', mocker.Mock(
+        side_effect=[Exception("boom!"),
+                     downloader.PermanentDownloadError("gone"),
+                     None]
+    ))
+    # the third download takes too long for there to be time for a fourth
+    mocker.patch.object(downloader, 'time', mocker.Mock(
+        time=mocker.Mock(side_effect=[0, 1, 2, 3, 4, 500])
+    ))
+    queue = downloader.sqs_resource().get_queue_by_name()
+
+    durations = [10, 0, 10, 10, 10]
+    records = [
+        {"messageId": "id{}".format(i), "receiptHandle": "rh{}".format(i),
+         "body": json.dumps({"duration": d})}
+        for i, d in enumerate(durations)
+    ]
+    context = mocker.Mock(get_remaining_time_in_millis=mocker.Mock(
+        side_effect=[890000, 880000, 870000, 390000]
+    ))
+    resp = handler(downloader, {"Records": records}, context)
+
+    # only the download that failed is retried
+    assert resp == {"batchItemFailures": [{"itemIdentifier": "id0"}]}
+    # too short
+    queue.delete_messages.assert_called_once_with(
+        Entries=[{"Id": "0", "ReceiptHandle": "rh1"}]
+    )
+    # out of time, sent back around without counting as a failure
+    queue.send_messages.assert_called_once_with(
+        Entries=[{"Id": "0", "MessageBody": records[4]["body"]}]
+    )
+    # successful and permanently failed downloads deleted
+    deleted = [c[0][0] for c in queue.Message.call_args_list
+               if c[0][0] in ["rh2", "rh3"]]
+    assert deleted == ["rh2", "rh3"]
+    assert queue.Message.return_value.delete.call_count == 2
+
+
+def test_batch_download_not_for_overrides(handler, mocker):
+    mocker.patch.object(downloader, 'DOWNLOAD_BATCH_SIZE', 3)
+    mocker.patch.object(downloader, 'sqs_resource', sqs_resource(mocker))
+    batch_download = mocker.patch.object(downloader, 'batch_download')
+    retrieve_message = mocker.patch.object(
+        downloader, 'retrieve_message', mocker.Mock(return_value=None)
+    )
+
+    for event in [{"override_series_id": "20200299999"},
+                  {"ignore_schedule": True}]:
+        handler(downloader, event)
+    assert batch_download.call_count == 0
+    assert retrieve_message.call_count == 2
+
+    handler(downloader, {})
+    assert batch_download.call_count == 1
@@ -3,12 +3,17 @@ import os
 import site
 import json
 import pytest
+import requests
+import requests_mock
 import inspect
+import threading
 from os.path import dirname, join
 from importlib import import_module
 from datetime import datetime
 from uuid import UUID
 from hashlib import md5
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
 
 TIMESTAMP_FORMAT = os.getenv('TIMESTAMP_FORMAT')
 
@@ -17,6 +22,13 @@ site.addsitedir(join(dirname(dirname(__file__)), 'functions'))
 uploader = import_module('zoom-uploader')
 
 
+@pytest.fixture(autouse=True)
+def clear_upload_count():
+    uploader.UPLOAD_COUNT.clear()
+    uploader.SERIES_CATALOGS.clear()
+    uploader.INGESTED.clear()
+
+
 def test_too_many_uploads(handler, mocker):
     mocker.patch.object(uploader, 'sqs', mocker.Mock())
     uploader.sqs.get_queue_by_name = mocker.Mock()
@@ -393,3 +405,638 @@ def test_file_param_generator_multi_set():
         fpg._generate_presigned_url = lambda f: "signed-{}".format(f)
         upload_params = fpg.generate()
         assert upload_params == expected
+
+
+def test_batch_upload_headroom(handler, mocker, upload_message):
+    mocker.patch.object(uploader, 'sqs', mocker.Mock())
+    mocker.patch.object(uploader, 'UPLOAD_BATCH_SIZE', 5)
+    mocker.patch.object(uploader, 'OC_TRACK_UPLOAD_MAX', 5)
+    mocker.patch.object(uploader, 'get_current_upload_count',
+                        mocker.Mock(return_value=2))
+    messages = [upload_message() for _ in range(3)]
+    receive_messages = uploader.sqs.get_queue_by_name \
+        .return_value.receive_messages
+    receive_messages.return_value = messages
+    uploader.process_upload = mocker.Mock(return_value=12345)
+
+    handler(uploader, {})
+
+    # only as many as opencast has room for
+    assert receive_messages.call_args[1]["MaxNumberOfMessages"] == 3
+    assert uploader.process_upload.call_count == 3
+    assert all(m.delete.call_count == 1 for m in messages)
+
+
+def test_batch_upload_no_headroom(handler, mocker):
+    mocker.patch.object(uploader, 'sqs', mocker.Mock())
+    mocker.patch.object(uploader, 'UPLOAD_BATCH_SIZE', 5)
+    mocker.patch.object(uploader, 'OC_TRACK_UPLOAD_MAX', 5)
+    mocker.patch.object(uploader, 'get_current_upload_count',
+                        mocker.Mock(return_value=5))
+    receive_messages = uploader.sqs.get_queue_by_name \
+        .return_value.receive_messages
+    uploader.process_upload = mocker.Mock()
+
+    handler(uploader, {})
+
+    assert receive_messages.call_count == 0
+    assert uploader.process_upload.call_count == 0
+
+
+def test_batch_upload_error(handler, mocker, upload_message):
+    mocker.patch.object(uploader, 'sqs', mocker.Mock())
+    mocker.patch.object(uploader, 'UPLOAD_BATCH_SIZE', 2)
+    mocker.patch.object(uploader, 'get_current_upload_count',
+                        mocker.Mock(return_value=0))
+    messages = [upload_message({"fail": True}), upload_message({"fail": False})]
+    uploader.sqs.get_queue_by_name \
+        .return_value.receive_messages \
+        .return_value = messages
+    uploader.process_upload = mocker.Mock(
+        side_effect=lambda data, deadline: data["fail"] and 1 / 0
+    )
+
+    with pytest.raises(ZeroDivisionError):
+        handler(uploader, {})
+
+    # the other upload still goes through
+    assert messages[0].delete.call_count == 0
+    assert messages[1].delete.call_count == 1
+
+
+def test_upload_count_cached(mocker):
+    get_count = mocker.patch.object(uploader, 'get_current_upload_count',
+                                    mocker.Mock(side_effect=[3, 1]))
+    monotonic = mocker.patch.object(uploader.time, 'monotonic',
+                                    mocker.Mock(return_value=1000))
+    upload_count = uploader.UploadCount(ttl=60)
+
+    assert upload_count.get() == 3
+    # tracks we ingest are counted until the next fetch
+    upload_count.add(2)
+    monotonic.return_value = 1060
+    assert upload_count.get() == 5
+    assert get_count.call_count == 1
+
+    monotonic.return_value = 1061
+    assert upload_count.get() == 1
+    assert get_count.call_count == 2
+
+
+def test_upload_count_reused_by_next_invocation(handler, mocker,
+                                                upload_message):
+    mocker.patch.object(uploader, 'sqs', mocker.Mock())
+    mocker.patch.object(uploader, 'aws_lambda', mocker.Mock())
+    uploader.aws_lambda.invoke.return_value = {
+        "Payload": io.StringIO(json.dumps({"upload_ops": 1}))
+    }
+    mocker.patch.object(uploader, 'UPLOAD_OP_TYPES', ["upload_ops"])
+    mocker.patch.object(uploader, 'OC_TRACK_UPLOAD_MAX', 5)
+    monotonic = mocker.patch.object(uploader.time, 'monotonic',
+                                    mocker.Mock(return_value=1000))
+    uploader.sqs.get_queue_by_name \
+        .return_value.receive_messages \
+        .return_value = [upload_message()]
+    uploader.process_upload = mocker.Mock(return_value=12345)
+
+    handler(uploader, {})
+    # the uploader runs every 2 minutes
+    monotonic.return_value = 1120
+    handler(uploader, {})
+
+    assert uploader.process_upload.call_count == 2
+    assert uploader.aws_lambda.invoke.call_count == 1
+
+
+def test_upload_count_not_cached_when_unknown(mocker):
+    get_count = mocker.patch.object(uploader, 'get_current_upload_count',
+                                    mocker.Mock(side_effect=[None, 4]))
+    upload_count = uploader.UploadCount(ttl=60)
+
+    assert upload_count.get() is None
+    upload_count.add(2)
+    assert upload_count.get() == 4
+    assert get_count.call_count == 2
+
+
+def test_upload_count_single_flight(mocker):
+    fetching = threading.Event()
+    release = threading.Event()
+
+    def slow_count():
+        fetching.set()
+        release.wait(5)
+        return 2
+
+    get_count = mocker.patch.object(uploader, 'get_current_upload_count',
+                                    mocker.Mock(side_effect=slow_count))
+    upload_count = uploader.UploadCount(ttl=60)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = [executor.submit(upload_count.get) for _ in range(4)]
+        fetching.wait(5)
+        release.set()
+        counts = [f.result() for f in futures]
+
+    assert counts == [2, 2, 2, 2]
+    assert get_count.call_count == 1
+
+
+def test_upload_adds_track_count(mocker):
+    upload = uploader.Upload({
+        "uuid": "mock_uuid",
+        "opencast_series_id": "20200299999",
+        "allow_multiple_ingests": False,
+        "webhook_received_time": "2020-03-10T01:58:03Z",
+    })
+    upload._opencast_mpid = "mpid"
+    mocker.patch.object(upload, 'get_series_catalog')
+
+    def ingest():
+        upload.track_count = 2
+        upload._workflow_id = "12345"
+
+    mocker.patch.object(upload, 'ingest', mocker.Mock(side_effect=ingest))
+    upload_count = mocker.patch.object(uploader, 'UPLOAD_COUNT')
+
+    assert upload.upload() == "12345"
+    upload_count.add.assert_called_once_with(2)
+
+
+def test_digest_nonce_shared_between_threads():
+    session = requests.Session()
+    session.auth = uploader.SharedNonceDigestAuth("user", "pass")
+    challenge = {
+        "status_code": 401,
+        "headers": {
+            "WWW-Authenticate":
+                'Digest realm="Opencast", qop="auth", nonce="abc123"'
+        }
+    }
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get("http://oc/series", [challenge, {"status_code": 200}])
+        req_mock.get("http://oc/workflow", status_code=200)
+
+        # the first request anywhere gets challenged
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            resp = executor.submit(session.get, "http://oc/series").result()
+        assert resp.status_code == 200
+
+        # a request from a different thread reuses the nonce
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            resp = executor.submit(session.get, "http://oc/workflow").result()
+        assert resp.status_code == 200
+
+        assert req_mock.call_count == 3
+        auth = req_mock.last_request.headers["Authorization"]
+        assert 'nonce="abc123"' in auth
+        assert "nc=00000002" in auth
+
+
+def test_upload_lookups_concurrent(mocker):
+    upload = uploader.Upload({
+        "uuid": "mock_uuid",
+        "opencast_series_id": "20200299999",
+        "allow_multiple_ingests": False,
+    })
+    both_started = threading.Barrier(2, timeout=5)
+
+    def lookup(*args):
+        # fails unless the other lookup is running at the same time
+        both_started.wait()
+        return True
+
+    mocker.patch.object(upload, 'get_series_catalog',
+                        mocker.Mock(side_effect=lookup))
+    mocker.patch.object(upload, 'already_ingested',
+                        mocker.Mock(side_effect=lookup))
+    mocker.patch.object(upload, 'ingest')
+
+    # already ingested, so nothing to do
+    assert upload.upload() is None
+    assert upload.get_series_catalog.call_count == 1
+    assert upload.ingest.call_count == 0
+
+
+def series_catalog_json(publisher=None):
+    terms = {"title": [{"value": "TEST E-50"}]}
+    if publisher:
+        terms["publisher"] = [{"value": publisher}]
+    return json.dumps({"http://purl.org/dc/terms/": terms})
+
+
+def test_series_catalog_cached(mocker):
+    mocker.patch.object(uploader, 'OPENCAST_BASE_URL', "http://oc")
+    cache = uploader.SeriesCatalogCache(ttl=300)
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get("http://oc/series/20200299999.json",
+                     text=series_catalog_json("Harvard"))
+        first = cache.get("20200299999")
+        second = cache.get("20200299999")
+        assert req_mock.call_count == 1
+    assert first is second
+    assert first.publisher == "Harvard"
+
+
+def test_series_catalog_revalidated(mocker):
+    mocker.patch.object(uploader, 'OPENCAST_BASE_URL', "http://oc")
+    time_mock = mocker.patch.object(uploader.time, 'time',
+                                    mocker.Mock(return_value=1000))
+    cache = uploader.SeriesCatalogCache(ttl=300)
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get("http://oc/series/20200299999.json", [
+            {"text": series_catalog_json("Harvard"),
+             "headers": {"ETag": '"v1"',
+                         "Last-Modified": "Mon, 09 Mar 2020 23:19:20 GMT"}},
+            {"status_code": 304},
+            {"text": series_catalog_json("DCE"),
+             "headers": {"ETag": '"v2"'}},
+        ])
+        first = cache.get("20200299999")
+
+        # unchanged
+        time_mock.return_value = 1301
+        assert cache.get("20200299999") is first
+        headers = req_mock.last_request.headers
+        assert headers["If-None-Match"] == '"v1"'
+        assert headers["If-Modified-Since"] == "Mon, 09 Mar 2020 23:19:20 GMT"
+
+        # revalidation restarts the ttl
+        time_mock.return_value = 1601
+        assert cache.get("20200299999") is first
+        assert req_mock.call_count == 2
+
+        # changed
+        time_mock.return_value = 1602
+        changed = cache.get("20200299999")
+        assert changed.etag == '"v2"'
+        assert changed.publisher == "DCE"
+
+
+def test_series_catalog_shared(mocker):
+    mocker.patch.object(uploader, 'OPENCAST_BASE_URL', "http://oc")
+    mocker.patch.object(uploader, 's3', mocker.Mock())
+    shared = uploader.SeriesCatalog(series_catalog_json("Harvard"), etag='"v1"')
+    client = uploader.s3.meta.client
+    client.get_object.return_value = {
+        "Body": io.BytesIO(shared.to_json().encode())
+    }
+    cache = uploader.SeriesCatalogCache(ttl=300, prefix="series-catalogs/")
+
+    with requests_mock.Mocker() as req_mock:
+        catalog = cache.get("20200299999")
+        assert req_mock.call_count == 0
+    assert catalog.publisher == "Harvard"
+    client.get_object.assert_called_once_with(
+        Bucket=uploader.ZOOM_VIDEOS_BUCKET,
+        Key="series-catalogs/20200299999.json"
+    )
+    assert client.put_object.call_count == 0
+
+
+def test_series_catalog_publisher(mocker):
+    mocker.patch.object(uploader, 'DEFAULT_PUBLISHER', "Default")
+    mocker.patch.object(uploader, 'OVERRIDE_PUBLISHER', None)
+    catalog = uploader.SeriesCatalog(series_catalog_json())
+    assert catalog.publisher == "Default"
+
+    mocker.patch.object(uploader, 'OVERRIDE_PUBLISHER', "Override")
+    catalog = uploader.SeriesCatalog(series_catalog_json("Harvard"))
+    assert catalog.publisher == "Override"
+
+
+def test_oc_api_request_timeout_and_latency(mocker, caplog):
+    mocker.patch.object(uploader, 'OPENCAST_BASE_URL', "http://oc")
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get("http://oc/series/20200299999.json", text="{}")
+        uploader.oc_api_request(
+            "GET", "/series/20200299999.json", endpoint_name="series"
+        )
+        assert req_mock.last_request.timeout == (
+            uploader.OC_CONNECT_TIMEOUT, uploader.OC_READ_TIMEOUT
+        )
+
+        req_mock.get("http://oc/workflow/instances.json", status_code=500)
+        with pytest.raises(requests.HTTPError):
+            uploader.oc_api_request(
+                "GET", "/workflow/instances.json?mp=abc"
+            )
+
+        req_mock.post("http://oc/ingest", exc=requests.ConnectTimeout)
+        with pytest.raises(requests.ConnectTimeout):
+            uploader.oc_api_request("POST", "/ingest")
+
+    latencies = [r.msg["opencast_request"] for r in caplog.records
+                 if isinstance(r.msg, dict) and "opencast_request" in r.msg]
+    assert [(l["endpoint"], l["status"]) for l in latencies] == [
+        ("series", 200),
+        ("/workflow/instances.json", 500),
+        ("/ingest", "ConnectTimeout"),
+    ]
+    assert all(l["seconds"] >= 0 for l in latencies)
+
+
+def test_opencast_session_retries_gets_only(mocker):
+    mocker.patch.object(uploader, 'OC_GET_ATTEMPTS', 3)
+    session = uploader.opencast_session()
+    retries = session.get_adapter("https://oc").max_retries
+    assert retries.total == 2
+    assert retries.is_retry("GET", 503)
+    assert not retries.is_retry("POST", 503)
+    assert not retries.is_retry("GET", 404)
+
+
+def test_series_mediapackage_ids(mocker):
+    mocker.patch.object(uploader, 'OPENCAST_BASE_URL', "http://oc")
+    mocker.patch.object(uploader, 'OC_WORKFLOW_PAGE_SIZE', 2)
+
+    def workflows(total, *mpids):
+        instances = [{"id": 1, "mediapackage": {"id": m}} for m in mpids]
+        return {"json": {"workflows": {
+            "totalCount": str(total),
+            "workflow": instances[0] if len(instances) == 1 else instances
+        }}}
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get("http://oc/workflow/instances.json", [
+            workflows(3, "mp1", "mp2"),
+            workflows(3, "mp3"),
+        ])
+        mpids = uploader.series_mediapackage_ids("20200299999")
+        assert mpids == {"mp1", "mp2", "mp3"}
+        assert req_mock.call_count == 2
+        assert req_mock.last_request.qs == {
+            "seriesid": ["20200299999"], "count": ["2"], "startpage": ["1"]
+        }
+
+
+def test_batch_upload_rejects_duplicates(handler, mocker, upload_message):
+    mocker.patch.object(uploader, 'sqs', mocker.Mock())
+    mocker.patch.object(uploader, 'UPLOAD_BATCH_SIZE', 5)
+    mocker.patch.object(uploader, 'get_current_upload_count',
+                        mocker.Mock(return_value=0))
+    ingested_mpid = uploader.deterministic_mediapackage_id("ingested==")
+    list_mpids = mocker.patch.object(
+        uploader, 'series_mediapackage_ids',
+        mocker.Mock(return_value={ingested_mpid})
+    )
+    messages = [
+        upload_message({"uuid": "ingested=="}),
+        upload_message({"uuid": "ingested==",
+                        "allow_multiple_ingests": True}),
+        upload_message({"uuid": "new==", "allow_multiple_ingests": False}),
+    ]
+    uploader.sqs.get_queue_by_name \
+        .return_value.receive_messages \
+        .return_value = messages
+    uploader.process_upload = mocker.Mock(return_value=12345)
+
+    handler(uploader, {})
+
+    # one listing for the batch's one series
+    list_mpids.assert_called_once_with("20200299999")
+    assert messages[0].delete.call_count == 1
+    uploaded = [c[0][0]["uuid"] for c in
+                uploader.process_upload.call_args_list]
+    assert sorted(uploaded) == ["ingested==", "new=="]
+
+
+def test_mpid_from_ingested_index(mocker):
+    upload_data = {
+        "uuid": "mock_uuid",
+        "opencast_series_id": "20200299999",
+        "allow_multiple_ingests": False
+    }
+    mpid = uploader.deterministic_mediapackage_id("mock_uuid")
+    mocker.patch.object(uploader, 'series_mediapackage_ids', mocker.Mock(
+        side_effect=lambda series_id:
+            {mpid} if series_id == "20200299999" else set()
+    ))
+    uploader.INGESTED.load(["20200299999", "20200288888"])
+
+    upload = uploader.Upload(upload_data)
+    upload.already_ingested = mocker.Mock()
+    assert upload.mediapackage_id is None
+    # no per-mediapackage lookup needed
+    assert upload.already_ingested.call_count == 0
+
+    # not in this series, but already ingested into another one
+    upload = uploader.Upload(
+        dict(upload_data, opencast_series_id="20200288888")
+    )
+    upload.already_ingested = mocker.Mock(return_value=True)
+    assert upload.mediapackage_id is None
+    upload.already_ingested.assert_called_once_with(mpid)
+
+
+def mediapackage_xml(*track_ids):
+    tracks = "".join(
+        '<track id="{0}"><url>http://s3/{0}</url></track>'.format(t)
+        for t in track_ids
+    )
+    return (
+        '<mediapackage xmlns="http://mediapackage.opencastproject.org"'
+        ' id="mpid"><media>{}</media></mediapackage>'.format(tracks)
+    )
+
+
+def test_merge_tracks():
+    merged = uploader.merge_tracks(
+        mediapackage_xml(),
+        [mediapackage_xml("t1"), mediapackage_xml("t2"), mediapackage_xml("t1")]
+    )
+    ns = {"mp": uploader.MEDIAPACKAGE_NS}
+    root = uploader.ET.fromstring(merged)
+    assert root.get("id") == "mpid"
+    assert [t.get("id") for t in root.findall("mp:media/mp:track", ns)] == \
+        ["t1", "t2"]
+
+
+def test_series_catalog_dublin_core():
+    catalog = uploader.SeriesCatalog(series_catalog_json("Harvard & co"))
+    root = uploader.ET.fromstring(catalog.dublin_core)
+    terms = {el.tag: el.text for el in root}
+    assert terms == {
+        "{http://purl.org/dc/terms/}title": "TEST E-50",
+        "{http://purl.org/dc/terms/}publisher": "Harvard & co",
+    }
+
+
+def test_staged_ingest(mocker):
+    mocker.patch.object(uploader, 'OPENCAST_BASE_URL', "http://oc")
+    mocker.patch.object(uploader, 'OC_INGEST_MODE', "staged")
+    mocker.patch.object(uploader, 'ZOOM_OPENCAST_WORKFLOW', "DCE-zoom")
+    mocker.patch.object(uploader.time, 'sleep')
+    upload = uploader.Upload({
+        "uuid": "mock_uuid",
+        "host_name": "Angela Amari",
+        "created": "2020-03-09T23:19:20Z",
+        "zoom_series_id": 123456789,
+        "opencast_series_id": "20200299999",
+        "s3_files": {
+            "active_speaker": {"segments": [{"filename": "speaker.mp4"}]},
+            "shared_screen": {"segments": [{"filename": "screen.mp4"}]},
+        }
+    })
+    upload._opencast_mpid = "mpid"
+    upload._series_catalog = uploader.SeriesCatalog(
+        series_catalog_json("Harvard")
+    )
+    mocker.patch.object(
+        uploader.FileParamGenerator, '_generate_presigned_url',
+        lambda self, f: "http://s3/{}".format(f)
+    )
+
+    def add_track(request, context):
+        return mediapackage_xml(parse_qs(request.text)["url"][0])
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.put("http://oc/ingest/createMediaPackageWithID/mpid",
+                      text=mediapackage_xml())
+        req_mock.post("http://oc/ingest/addDCCatalog",
+                      text=mediapackage_xml())
+        # a track that couldn't connect is retried on its own
+        req_mock.post("http://oc/ingest/addTrack", [
+            {"exc": requests.ConnectionError},
+            {"text": add_track},
+            {"text": add_track},
+        ])
+        req_mock.post("http://oc/ingest/ingest/DCE-zoom",
+                      text='<workflow id="12345"/>')
+
+        upload.ingest()
+
+        paths = [r.path for r in req_mock.request_history]
+        assert req_mock.request_history[0].method == "PUT"
+        assert paths.count("/ingest/createmediapackagewithid/mpid") == 1
+        assert paths.count("/ingest/addtrack") == 3
+        assert paths[-1] == "/ingest/ingest/dce-zoom"
+        ingested = parse_qs(req_mock.last_request.text)["mediaPackage"][0]
+
+    assert upload.workflow_id == "12345"
+    assert upload.track_count == 2
+    assert "speaker.mp4" in ingested and "screen.mp4" in ingested
+
+
+def test_retryable_ingest_error(mocker):
+    def http_error(status):
+        return requests.HTTPError(response=mocker.Mock(status_code=status))
+
+    cases = [
+        (requests.ConnectTimeout(), True, True),
+        (requests.ConnectionError(), True, True),
+        (requests.ReadTimeout(), True, False),
+        (http_error(500), True, False),
+        (http_error(503), True, False),
+        (http_error(400), False, False),
+        (ValueError(), False, False),
+    ]
+    for error, idempotent, not_idempotent in cases:
+        assert uploader.retryable_ingest_error(error) == idempotent
+        assert uploader.retryable_ingest_error(error, idempotent=False) \
+            == not_idempotent
+
+
+def test_staged_ingest_not_retried_after_read_timeout(mocker):
+    mocker.patch.object(uploader, 'OPENCAST_BASE_URL', "http://oc")
+    mocker.patch.object(uploader.time, 'sleep')
+    with requests_mock.Mocker() as req_mock:
+        req_mock.post("http://oc/ingest/ingest/wf", exc=requests.ReadTimeout)
+        with pytest.raises(requests.ReadTimeout):
+            uploader.ingest_step(
+                "POST", "ingest/ingest", "/ingest/ingest/wf",
+                idempotent=False, data={"mediaPackage": "<mp/>"}
+            )
+        assert req_mock.call_count == 1
+
+
+def test_ingest_step_read_timeout_capped_at_deadline(mocker):
+    mocker.patch.object(uploader, 'OPENCAST_BASE_URL', "http://oc")
+    mocker.patch.object(uploader, 'OC_INGEST_READ_TIMEOUT', 240)
+    mocker.patch.object(uploader.time, 'monotonic',
+                        mocker.Mock(return_value=1000))
+    with requests_mock.Mocker() as req_mock:
+        req_mock.post("http://oc/ingest/addDCCatalog", text="<mp/>")
+        uploader.ingest_step("POST", "ingest/addDCCatalog",
+                             "/ingest/addDCCatalog", deadline=1090)
+        assert req_mock.last_request.timeout[1] == 90
+
+        uploader.ingest_step("POST", "ingest/addDCCatalog",
+                             "/ingest/addDCCatalog", deadline=2000)
+        assert req_mock.last_request.timeout[1] == 240
+
+        with pytest.raises(TimeoutError):
+            uploader.ingest_step("POST", "ingest/addDCCatalog",
+                                 "/ingest/addDCCatalog", deadline=1000)
+        assert req_mock.call_count == 2
+
+
+def test_ingest_step_not_retried_past_deadline(mocker):
+    mocker.patch.object(uploader, 'OPENCAST_BASE_URL', "http://oc")
+    sleep = mocker.patch.object(uploader.time, 'sleep')
+    mocker.patch.object(uploader.time, 'monotonic',
+                        mocker.Mock(return_value=1000))
+    # the backoff would run past the deadline
+    mocker.patch.object(uploader.random, 'uniform',
+                        mocker.Mock(return_value=2))
+    with requests_mock.Mocker() as req_mock:
+        req_mock.post("http://oc/ingest/addDCCatalog",
+                      exc=requests.ReadTimeout)
+        with pytest.raises(requests.ReadTimeout):
+            uploader.ingest_step("POST", "ingest/addDCCatalog",
+                                 "/ingest/addDCCatalog", deadline=1001)
+        assert req_mock.call_count == 1
+    assert sleep.call_count == 0
+
+
+def test_handler_ingest_deadline(handler, mocker, upload_message):
+    mocker.patch.object(uploader, 'sqs', mocker.Mock())
+    mocker.patch.object(uploader, 'get_current_upload_count',
+                        mocker.Mock(return_value=0))
+    mocker.patch.object(uploader, 'OC_INGEST_TIME_RESERVE', 15)
+    mocker.patch.object(uploader.time, 'monotonic',
+                        mocker.Mock(return_value=1000))
+    uploader.sqs.get_queue_by_name \
+        .return_value.receive_messages \
+        .return_value = [upload_message()]
+    uploader.process_upload = mocker.Mock(return_value=12345)
+    context = mocker.Mock(get_remaining_time_in_millis=mocker.Mock(
+        return_value=120000
+    ))
+
+    handler(uploader, {}, context)
+
+    assert uploader.process_upload.call_args[0][1] == 1105
+
+
+def test_staged_ingest_not_retried_after_gateway_error(mocker):
+    mocker.patch.object(uploader, 'OPENCAST_BASE_URL', "http://oc")
+    mocker.patch.object(uploader.time, 'sleep')
+    with requests_mock.Mocker() as req_mock:
+        req_mock.post("http://oc/ingest/ingest/wf", status_code=503)
+        with pytest.raises(requests.HTTPError):
+            uploader.ingest_step(
+                "POST", "ingest/ingest", "/ingest/ingest/wf",
+                idempotent=False, data={"mediaPackage": "<mp/>"}
+            )
+        assert req_mock.call_count == 1
+
+
+def test_series_catalog_shared_saved(mocker):
+    mocker.patch.object(uploader, 'OPENCAST_BASE_URL', "http://oc")
+    mocker.patch.object(uploader, 's3', mocker.Mock())
+    client = uploader.s3.meta.client
+    client.exceptions.NoSuchKey = KeyError
+    client.get_object.side_effect = KeyError("series-catalogs/20200299999.json")
+    cache = uploader.SeriesCatalogCache(ttl=300, prefix="series-catalogs/")
+
+    with requests_mock.Mocker() as req_mock:
+        req_mock.get("http://oc/series/20200299999.json",
+                     text=series_catalog_json("Harvard"),
+                     headers={"ETag": '"v1"'})
+        cache.get("20200299999")
+
+    saved = client.put_object.call_args[1]
+    assert saved["Key"] == "series-catalogs/20200299999.json"
+    assert json.loads(saved["Body"])["etag"] == '"v1"'
+    assert uploader.s3.Object.call_count == 0